@@ -49,47 +49,873 @@ import os
 import mne
 from scipy.io import loadmat
 from scipy.signal import firwin
-from numpy import array, flipud
+import numpy as np
+from numpy import array
+from scipy import fft as sp_fft
+from concurrent.futures import ThreadPoolExecutor
 from mne.filter import _overlap_add_filter as fftfilt
+from mne.filter import _smart_pad, resample
+from HANG_parallel import runSubjects
+from HANG_manifest import buildManifest
+from HANG_trials import trialRows, writeTrialTable
+from HANG_cache import BuildCache
+from HANG_epochs import saveEpochs
 
-def BPF(data, fs, norder, cf1, cf2):
+class BandpassFilter():
     '''
     Implement a version of the BPF.m function for Python
 
+    Reusable filter object version of the original BPF() function. The firwin
+    kernel (and its FFT for each FFT length used) is designed once per
+    (fs, norder, cf1, cf2) and cached, instead of on every call. Calling the
+    object works the same way as the old function:
+
+        BPF = BandpassFilter()
+        y = BPF(data=data, fs=2048, norder=256, cf1=1, cf2=57)
+
+    The old function did two fftfilt (MNE _overlap_add_filter) passes with
+    flipud copies in between. On channels x samples data flipud flips the
+    channel order (not time), and even for a single channel the firwin kernel
+    is symmetric and _overlap_add_filter is zero-phase with symmetric
+    (reflect_limited) padding, so the flips never changed the result. Here
+    each channel is simply filtered twice, in place, with the same overlap-add
+    method and padding as MNE (identical output to the old function, see
+    compareBandpassFilter). Blocks of channels are filtered in parallel
+    threads (scipy.fft releases the GIL).
+
+    If float32 is True the filtering is done in single precision. This halves
+    memory and is faster, at the cost of ~1e-7 relative precision.
+
+    Parameters
+    ----------
+    n_jobs : INT, optional
+        Number of threads used to filter channels in parallel. The default
+        is 4.
+    float32 : BOOL, optional
+        Filter in float32 instead of float64. The default is False.
+
+    '''
+    def __init__(self, n_jobs=4, float32=False):
+        self.n_jobs = n_jobs
+        self.float32 = float32
+        self._kernels = dict()
+        self._kernel_ffts = dict()
+
+    def kernel(self, fs, norder, cf1, cf2):
+        '''
+        The (cached) firwin kernel for the given filter parameters.
+
+        Parameters
+        ----------
+        fs : INT
+            The frequency at which data were sampled.
+        norder : INT
+            The n-th order for the filter, to generate n+1 numtaps.
+        cf1 : INT
+            The lower cutoff frequency for the bandpass filter.
+        cf2 : INT
+            The upper cutoff frequency for the bandpass filter.
+
+        Returns
+        -------
+        An array of the filter coefficients.
+
+        '''
+        key = (fs, norder, cf1, cf2)
+        if key not in self._kernels:
+            Ny = fs/2
+            cutoffs = array([cf1,cf2])
+            cutoffs = cutoffs / (Ny)
+            self._kernels[key] = firwin(numtaps=norder+1, cutoff=cutoffs, pass_zero='bandpass')
+        return self._kernels[key]
+
+    def __call__(self, data, fs, norder, cf1, cf2):
+        '''
+        Bandpass filter data (forward and backward, as BPF.m).
+
+        Parameters
+        ----------
+        data : ARRAY
+            The data to be bandpass filtered (channels x samples, or a single
+            channel). Filtered in place unless float32 is True and data are
+            float64, in which case a float32 copy is filtered and returned.
+        fs : INT
+            The frequency at which data were sampled.
+        norder : INT
+            The n-th order for the filter, to generate n+1 numtaps.
+        cf1 : INT
+            The lower cutoff frequency for the bandpass filter.
+        cf2 : INT
+            The upper cutoff frequency for the bandpass filter.
+
+        Returns
+        -------
+        An array of the bandpass filtered data.
+
+        '''
+        dtype = np.float32 if self.float32 else np.float64
+        if data.dtype != dtype:
+            data = data.astype(dtype)
+        channels = data if data.ndim == 2 else data[np.newaxis]
+        h = self.kernel(fs, norder, cf1, cf2)
+        n_edge = max(min(len(h), channels.shape[1]) - 1, 0)
+        n_fft = _fftLength(len(h), channels.shape[1] + 2 * n_edge)
+        key = (fs, norder, cf1, cf2, n_fft, dtype)
+        if key not in self._kernel_ffts:
+            self._kernel_ffts[key] = sp_fft.rfft(h.astype(dtype), n_fft)
+        h_fft = self._kernel_ffts[key]
+
+        def filterBlock(block):
+            for ch in block:
+                # Forward and backward pass
+                _zeroPhaseFilter(channels[ch], h_fft, len(h), n_edge, n_fft)
+                _zeroPhaseFilter(channels[ch], h_fft, len(h), n_edge, n_fft)
+
+        blocks = np.array_split(np.arange(channels.shape[0]), max(1, min(self.n_jobs, channels.shape[0])))
+        with ThreadPoolExecutor(max_workers=len(blocks)) as pool:
+            list(pool.map(filterBlock, blocks))
+        return data
+
+def _fftLength(n_h, n_x):
+    # Same FFT length choice as MNE's _overlap_add_filter
+    min_fft = 2 * n_h - 1
+    if n_x >= min_fft:
+        N = 2 ** np.arange(np.ceil(np.log2(min_fft)), np.ceil(np.log2(n_x)) + 1, dtype=int)
+        cost = np.ceil(n_x / (N - n_h + 1).astype(np.float64)) * N * (np.log2(N) + 1)
+        cost += 4e-5 * N * n_x
+        return int(N[np.argmin(cost)])
+    return sp_fft.next_fast_len(min_fft)
+
+def _zeroPhaseFilter(x, h_fft, n_h, n_edge, n_fft):
+    # One zero-phase overlap-add pass over a single channel, written back into
+    # x. Same padding and delay compensation as MNE's _overlap_add_filter.
+    x_ext = _smart_pad(x, (n_edge, n_edge), 'reflect_limited')
+    n_x = len(x_ext)
+    x_filtered = np.zeros(n_x, dtype=x.dtype)
+    n_seg = n_fft - n_h + 1
+    shift = (n_h - 1) // 2 + n_edge
+    for start in range(0, n_x, n_seg):
+        prod = sp_fft.irfft(sp_fft.rfft(x_ext[start:start+n_seg], n_fft) * h_fft, n_fft)
+        start_filt = max(0, start - shift)
+        stop_filt = min(start - shift + n_fft, n_x)
+        if stop_filt <= start_filt:
+            continue
+        start_prod = max(0, shift - start)
+        x_filtered[start_filt:stop_filt] += prod[start_prod:start_prod + stop_filt - start_filt]
+    x[:] = x_filtered[:n_x - 2 * n_edge]
+
+def detectTriggerScheme(raw_events):
+    '''
+    Work out which trigger encoding a recording uses. Three schemes have been
+    seen so far (see event_dict, alt_event_dict and offset_event_dict below):
+    MATLAB VALUE * 256, MATLAB VALUE + 65280 and 180 + MATLAB VALUE * 256. The
+    scheme whose trigger values match the most events is used.
+
     Parameters
     ----------
-    data : ARRAY
-        The data to be bandpass filtered.
-    fs : INT
-        The frequency at which data were sampled.
-    norder : INT
-        The n-th order for the filter, to generate n+1 numtaps.
-    cf1 : INT
-        The lower cutoff frequency for the bandpass filter.
-    cf2 : INT
-        The upper cutoff frequency for the bandpass filter.
+    raw_events : ARRAY
+        The events array from mne.find_events().
 
     Returns
     -------
-    An array of the bandpass filtered data.
+    scheme : STRING
+        Name of the scheme (key of trigger_schemes).
+    event_id : DICT
+        The event_id dictionary for that scheme.
 
     '''
-    
-    Ny = fs/2
-    cutoffs = array([cf1,cf2])
-    cutoffs = cutoffs / (Ny)
+    counts = dict()
+    for scheme, event_id in trigger_schemes.items():
+        counts[scheme] = np.isin(raw_events[:,2], list(event_id.values())).sum()
+    scheme = max(counts, key=counts.get)
+    if counts[scheme] == 0:
+        raise ValueError('Trigger values ' + str(np.unique(raw_events[:,2])) +
+                         ' do not match any known trigger scheme')
+    return scheme, trigger_schemes[scheme]
 
-    filter_design = firwin(numtaps=norder+1, cutoff=cutoffs, pass_zero='bandpass')
-    
-    y = flipud(fftfilt(flipud(fftfilt(data, filter_design)), filter_design))
-    return y
+def makeMetadata(raw_events, sfreq):
+    '''
+    Make the epochs metadata (response times, correct/incorrect) from the
+    events found in the raw data, using the trigger scheme found by
+    detectTriggerScheme().
+
+    Parameters
+    ----------
+    raw_events : ARRAY
+        The events array from mne.find_events().
+    sfreq : FLOAT
+        The sampling frequency of the raw data.
+
+    Returns
+    -------
+    metadata, events, event_id as returned by mne.epochs.make_metadata().
+
+    '''
+    scheme, scheme_event_id = detectTriggerScheme(raw_events)
+    metadata, events, event_id = mne.epochs.make_metadata(events=raw_events, event_id=scheme_event_id,
+                                                          tmin=-0.5, tmax=10.0, sfreq=sfreq,
+                                                          row_events = ['female/HighSNR', 'female/LowSNR',
+                                                                        'male/HighSNR', 'male/LowSNR'],
+                                                          keep_first = 'response')
+    return metadata, events, event_id
+
+def subjectEvents(sID, raw, manifest):
+    '''
+    Get the events for a subject, from the cached -eve.fif file in
+    epochsFolder if it is newer than the BDF file, otherwise with
+    mne.find_events() on the (unloaded) raw data and saved for next time.
+
+    With the data not loaded, find_events() only reads the Status channel,
+    so the events can be found before (and without) loading and filtering.
+
+    Parameters
+    ----------
+    sID : STRING
+        The subject ID.
+    raw : mne.io.Raw CLASS
+        The subject's raw data (not loaded), or None to read only the BDF
+        header if the cached events are out of date.
+    manifest : DICT
+        The subject manifest from HANG_manifest.buildManifest().
+
+    Returns
+    -------
+    The events ARRAY.
+
+    '''
+    eve_fname = os.path.join(cwd, epochsFolder, sID + '-eve.fif')
+    if (os.path.exists(eve_fname) and
+        os.path.getmtime(eve_fname) > manifest[sID]['bdf_mtime']):
+        return mne.read_events(eve_fname)
+    if raw is None:
+        raw = mne.io.read_raw_bdf(manifest[sID]['bdf'])
+    raw_events = mne.find_events(raw, shortest_event=1)
+    mne.write_events(eve_fname, raw_events, overwrite=True)
+    return raw_events
+
+def filteredSegment(raw, picks, start, stop, h):
+    '''
+    Read samples start:stop of the picked channels from disk and filter them
+    with the FIR kernel h (zero-phase, same as raw.filter() does).
+
+    len(h) extra samples are read on each side (where available) so that the
+    returned samples are identical to filtering the whole recording. At the
+    very beginning and end of the recording the same reflect_limited padding
+    as raw.filter() is used, so the edges match as well.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw CLASS
+        The raw data. Does not need to be loaded.
+    picks : ARRAY
+        Indices of the channels to read.
+    start : INT
+        First sample to return (relative to the start of the recording).
+    stop : INT
+        Sample after the last sample to return.
+    h : ARRAY
+        The FIR kernel from mne.filter.create_filter().
+
+    Returns
+    -------
+    An array (channels x samples) of the filtered data.
+
+    '''
+    read_start = max(start - len(h), 0)
+    read_stop = min(stop + len(h), raw.n_times)
+    data = raw.get_data(picks=picks, start=read_start, stop=read_stop)
+    data = fftfilt(data, h, copy=False)
+    return data[:, start - read_start:stop - read_start]
+
+def streamEpochs(raw, events, event_id, metadata, picks, tmin, tmax, l_freq, h_freq,
+                 sfreq_new, block_seconds=60.0):
+    '''
+    Streaming version of raw.load_data() + raw.filter() + mne.Epochs() +
+    epochs.resample(). The recording is read from disk in blocks of
+    block_seconds, each block is filtered (with enough overlap on each side
+    that the result is identical to filtering the whole recording) and epochs
+    are cut from the filtered blocks and downsampled straight away.
+
+    Only one filtered block (plus the part of the previous block that the next
+    epoch still needs) is held in memory at a time, so peak memory scales with
+    block_seconds rather than with the length of the recording. Blocks that no
+    epoch needs (e.g. breaks) are not read at all.
+
+    Epochs that would run past the start or end of the recording are dropped,
+    the same as mne.Epochs() does.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw CLASS
+        The raw data. Should NOT be loaded.
+    events : ARRAY
+        The events to epoch (from makeMetadata()).
+    event_id : DICT
+        The event_id for the events.
+    metadata : pandas DataFrame
+        The metadata with one row per event.
+    picks : ARRAY
+        Indices of the channels to epoch.
+    tmin : FLOAT
+        Start of each epoch relative to the event (s).
+    tmax : FLOAT
+        End of each epoch relative to the event (s).
+    l_freq : FLOAT
+        Highpass frequency, as for raw.filter().
+    h_freq : FLOAT
+        Lowpass frequency, as for raw.filter().
+    sfreq_new : FLOAT
+        Sampling frequency to resample the epochs to.
+    block_seconds : FLOAT, optional
+        Length of each block read from disk. The default is 60.0.
+
+    Returns
+    -------
+    An mne.EpochsArray CLASS of the filtered, downsampled epochs.
+
+    '''
+    sfreq = raw.info['sfreq']
+    h = mne.filter.create_filter(None, sfreq, l_freq, h_freq, verbose=False)
+    starts, keep, n_epoch = _epochStarts(raw, events, tmin, tmax)
+    block = max(int(block_seconds * sfreq), n_epoch)
+
+    epochs_data = []
+    buffer = np.empty((len(picks), 0))
+    buffer_start = 0
+    next_epoch = 0
+    for block_start in range(0, raw.n_times, block):
+        block_stop = min(block_start + block, raw.n_times)
+        if next_epoch == len(starts):
+            break
+        if starts[next_epoch] >= block_stop:
+            # No epoch needs anything from this block
+            buffer_start = block_stop
+            continue
+        filtered = filteredSegment(raw, picks, block_start, block_stop, h)
+        buffer = np.concatenate([buffer, filtered], axis=1)
+        del filtered
+        while next_epoch < len(starts) and starts[next_epoch] + n_epoch <= block_stop:
+            i = starts[next_epoch] - buffer_start
+            epochs_data.append(resample(buffer[:, i:i+n_epoch], sfreq_new, sfreq,
+                                        npad='auto', pad='edge'))
+            next_epoch += 1
+        # Only keep what the next epoch still needs
+        if next_epoch < len(starts):
+            i = min(starts[next_epoch], block_stop) - buffer_start
+            buffer = buffer[:, i:]
+            buffer_start += i
+
+    return _epochsArray(raw, picks, epochs_data, events, event_id, metadata, keep, tmin,
+                        l_freq, h_freq, sfreq_new)
+
+def fusedEpochs(raw, events, event_id, metadata, picks, tmin, tmax, l_freq, h_freq, decim=4,
+                max_run_seconds=60.0):
+    '''
+    Fused filter + epoch + downsample. Instead of filtering the whole
+    recording, only the samples inside the epochs (plus the filter length on
+    each side, so the result is identical to filtering everything) are read
+    from disk and filtered. Epochs close enough together to share padding are
+    read and filtered as one run (up to max_run_seconds long, so memory use
+    stays bounded when trials follow each other closely). The filtered epochs are then decimated (every
+    decim-th sample) while they are cut, instead of the FFT epochs.resample()
+    pass afterwards.
+
+    Decimating without a further anti-aliasing filter is fine because the
+    lowpass of the bandpass filter already removes everything above the new
+    Nyquist frequency. A ValueError is raised if that is not the case for the
+    given h_freq and decim.
+
+    epochs.resample() in the standard path pads each epoch to a power of 2
+    and removes round(pad / decim) resampled samples again, so its samples are
+    not at the epoch start + decim * k but shifted by the remainder (for the
+    5326 samples of -0.5 to 2.1 s at 2048 Hz, 1433 samples of padding, i.e.
+    one 2048 Hz sample early). The same phase is used here (see
+    _resamplePhase), with the first sample of the epoch repeated where the
+    shift falls before it (as the edge padding of epochs.resample() does), so
+    the result matches the standard path apart from decimation vs FFT
+    resampling (well below verify_tolerance). Use verify_epoching to check on
+    real data.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw CLASS
+        The raw data. Should NOT be loaded.
+    events : ARRAY
+        The events to epoch (from makeMetadata()).
+    event_id : DICT
+        The event_id for the events.
+    metadata : pandas DataFrame
+        The metadata with one row per event.
+    picks : ARRAY
+        Indices of the channels to epoch.
+    tmin : FLOAT
+        Start of each epoch relative to the event (s).
+    tmax : FLOAT
+        End of each epoch relative to the event (s).
+    l_freq : FLOAT
+        Highpass frequency, as for raw.filter().
+    h_freq : FLOAT
+        Lowpass frequency, as for raw.filter().
+    decim : INT, optional
+        Decimation factor. The default is 4 (2048 Hz to 512 Hz).
+    max_run_seconds : FLOAT, optional
+        Longest stretch of data filtered in one go. The default is 60.0.
+
+    Returns
+    -------
+    An mne.EpochsArray CLASS of the filtered, decimated epochs.
+
+    '''
+    sfreq = raw.info['sfreq']
+    sfreq_new = sfreq / decim
+    # Upper edge of the lowpass transition band (same rule as MNE's 'auto')
+    h_stop = h_freq + min(max(0.25 * h_freq, 2.), sfreq / 2. - h_freq)
+    if h_stop > sfreq_new / 2.:
+        raise ValueError('Lowpass transition band (up to ' + str(h_stop) + ' Hz) is above the ' +
+                         'Nyquist frequency after decimating (' + str(sfreq_new / 2.) + ' Hz)')
+    h = mne.filter.create_filter(None, sfreq, l_freq, h_freq, verbose=False)
+    starts, keep, n_epoch = _epochStarts(raw, events, tmin, tmax)
+    max_run = max(int(max_run_seconds * sfreq), n_epoch)
+    # Samples (relative to the epoch start) kept by decimation, lined up with
+    # and as many as epochs.resample() gives
+    samples = _resamplePhase(n_epoch, decim) + decim * np.arange(int(round(n_epoch / decim)))
+    samples = np.clip(samples, 0, n_epoch - 1)
+
+    epochs_data = []
+    run_first = 0
+    while run_first < len(starts):
+        # Extend the run while the next epoch's padded window overlaps it
+        run_last = run_first
+        while (run_last + 1 < len(starts) and
+               starts[run_last + 1] - len(h) <= starts[run_last] + n_epoch + len(h) and
+               starts[run_last + 1] + n_epoch - starts[run_first] <= max_run):
+            run_last += 1
+        run_start = starts[run_first]
+        filtered = filteredSegment(raw, picks, run_start, starts[run_last] + n_epoch, h)
+        for start in starts[run_first:run_last + 1]:
+            i = start - run_start
+            epochs_data.append(filtered[:, i + samples])
+        del filtered
+        run_first = run_last + 1
+
+    return _epochsArray(raw, picks, epochs_data, events, event_id, metadata, keep, tmin,
+                        l_freq, h_freq, sfreq_new)
+
+def standardEpochs(raw, picks, events, event_id, metadata):
+    '''
+    The original epoching method: load and filter the whole recording, find
+    events, epoch at full sampling rate and resample the epochs to 512 Hz.
+    Used by epoching_mode = 'standard' and as the reference for
+    verify_epoching.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw CLASS
+        The raw data. Is loaded and filtered in place.
+    picks : ARRAY
+        Indices of the channels to epoch.
+    events : ARRAY
+        The events to epoch (from makeMetadata()).
+    event_id : DICT
+        The event_id for the events.
+    metadata : pandas DataFrame
+        The metadata with one row per event.
+
+    Returns
+    -------
+    An mne.Epochs CLASS of the filtered, downsampled epochs.
+
+    '''
+    raw.load_data()
+
+    if epoch_filter == 'bpf':
+        # Custom version of BPF.m that is used in MATLAB to make a custom
+        # filter with much shorter length to account for potential ringing in
+        # the time domain of the CI artifact (see BandpassFilter and bpf_*
+        # settings). Only the epoched channels are filtered.
+        raw.apply_function(BPF, picks=picks, channel_wise=False, fs=raw.info['sfreq'], **bpf_params)
+    else:
+        # Reverting to using MNE Python's filter defaults to create an epochs
+        # object suitable for ICA
+        raw.filter(epoch_params['l_freq'], epoch_params['h_freq'])
+
+    epochs = mne.Epochs(raw=raw,events=events,event_id=event_id, metadata=metadata,
+                        tmin=epoch_params['tmin'],tmax=epoch_params['tmax'],baseline=None,
+                        picks=picks,preload=True)
+    # Downsample to 512 Hz
+    epochs.resample(epoch_params['sfreq'])
+    return epochs
+
+def compareBandpassFilter(raw, picks, sID, tolerance, seconds=60.0):
+    '''
+    Numerical check of BPF (BandpassFilter) against the original BPF()
+    function, i.e. two passes of MNE's overlap-add filter with the same firwin
+    kernel, which _fftLength() and _zeroPhaseFilter() copy. Filters the first
+    seconds of the picked channels both ways and prints the relative RMS
+    error (RMS of the difference divided by RMS of the original function).
+
+    Parameters
+    ----------
+    raw : mne.io.Raw CLASS
+        The raw data. Does not need to be loaded.
+    picks : ARRAY
+        Indices of the channels to check.
+    sID : STRING
+        Subject ID for the printed report.
+    tolerance : FLOAT
+        Largest acceptable relative RMS error, i.e. verify_tolerance.
+    seconds : FLOAT, optional
+        Length of data filtered. The default is 60.0.
+
+    Returns
+    -------
+    True if BPF matches the original function within tolerance, otherwise
+    False.
+
+    '''
+    data = raw.get_data(picks=picks, stop=min(int(seconds * raw.info['sfreq']), raw.n_times))
+    h = BPF.kernel(raw.info['sfreq'], **bpf_params)
+    reference = fftfilt(fftfilt(data, h), h)
+    filtered = BPF(data=data, fs=raw.info['sfreq'], **bpf_params)
+    error = np.sqrt(np.mean((filtered - reference)**2)) / np.sqrt(np.mean(reference**2))
+    passed = error <= tolerance
+    print(sID + ': relative RMS error of BPF vs the original BPF function = ' + str(error) +
+          ' - ' + ('PASSED' if passed else 'FAILED'))
+    return passed
+
+def compareEpochs(epochs, reference, sID, tolerance, edge_seconds=0.05):
+    '''
+    Numerical check that epochs made with the streaming/fused methods match
+    the standard method. Prints the relative RMS error (RMS of the difference
+    divided by RMS of the reference) over the whole epoch and excluding
+    edge_seconds at each end (where FFT resampling and decimation differ most).
+
+    Parameters
+    ----------
+    epochs : mne.Epochs CLASS
+        Epochs made with the streaming or fused method.
+    reference : mne.Epochs CLASS
+        Epochs made with standardEpochs() from the same recording.
+    sID : STRING
+        Subject ID for the printed report.
+    tolerance : FLOAT
+        Largest acceptable relative RMS error (excluding the edges), i.e.
+        verify_tolerance.
+    edge_seconds : FLOAT, optional
+        Time at each end of the epoch left out of the second error. The
+        default is 0.05.
+
+    Returns
+    -------
+    True if the epochs match within tolerance, otherwise False.
+
+    '''
+    if not np.array_equal(epochs.events, reference.events):
+        print(sID + ': epochs do not match the standard method (different events)')
+        return False
+    data = epochs.get_data()
+    ref = reference.get_data()
+    n_times = min(data.shape[2], ref.shape[2])
+    diff = data[:, :, :n_times] - ref[:, :, :n_times]
+    ref = ref[:, :, :n_times]
+    error = np.sqrt(np.mean(diff**2)) / np.sqrt(np.mean(ref**2))
+    edge = int(round(edge_seconds * epochs.info['sfreq']))
+    error_inner = (np.sqrt(np.mean(diff[:, :, edge:n_times-edge]**2)) /
+                   np.sqrt(np.mean(ref[:, :, edge:n_times-edge]**2)))
+    passed = error_inner <= tolerance
+    print(sID + ': relative RMS error vs standard epoching = ' + str(round(error, 6)) +
+          ' (' + str(round(error_inner, 6)) + ' excluding edges) - ' + ('PASSED' if passed else 'FAILED'))
+    return passed
+
+def _epochStarts(raw, events, tmin, tmax):
+    # First sample of each epoch (relative to the start of the recording),
+    # which events have a complete epoch inside the recording, and epoch length
+    sfreq = raw.info['sfreq']
+    start_offset = int(round(tmin * sfreq))
+    n_epoch = int(round(tmax * sfreq)) - start_offset + 1
+    starts = events[:,0] - raw.first_samp + start_offset
+    keep = (starts >= 0) & (starts + n_epoch <= raw.n_times)
+    return starts[keep], keep, n_epoch
+
+def _resamplePhase(n_epoch, decim):
+    # Epoch sample that the first sample of epochs.resample() (npad='auto')
+    # lines up with when downsampling n_epoch samples by decim. MNE pads to
+    # the next power of 2 (at least 2 * min(n_epoch // 8, 100) samples, half
+    # on each side) and then removes round(left pad / decim) resampled samples
+    min_add = min(n_epoch // 8, 100) * 2
+    npad = (2 ** int(np.ceil(np.log2(n_epoch + min_add))) - n_epoch) // 2
+    return decim * int(round(npad / decim)) - npad
+
+def _epochsArray(raw, picks, epochs_data, events, event_id, metadata, keep, tmin,
+                 l_freq, h_freq, sfreq_new):
+    # Build the EpochsArray with the info raw.filter() and epochs.resample()
+    # would have left behind
+    info = mne.pick_info(raw.info, picks)
+    with info._unlock():
+        info['highpass'] = float(l_freq)
+        info['lowpass'] = float(min(h_freq, sfreq_new / 2.))
+        info['sfreq'] = float(sfreq_new)
+    epochs = mne.EpochsArray(np.array(epochs_data), info, events=events[keep], tmin=tmin,
+                             event_id=event_id, metadata=metadata[keep].reset_index(drop=True),
+                             selection=np.flatnonzero(keep))
+    return epochs
+
+def targetWords(data_name):
+    '''
+    Reconstruct the target word of every trial from the .mat results file.
+
+    data['list'] is a 120 x 4 cell array storing 1-item "lists" in each cell.
+    Each row is an item set from ITCP. For the ISNT experiment script, the
+    target word is always the first column in each row - response order is
+    randomized per trial within the experiment script.
+
+    data['twOrderP'] and data['twOrderNP'] are both 1 x 121 arrays that
+    reference the row to reference in data['list'] for each trial of a
+    particular condition.
+
+    data['isPrimedSeq'] is a 1 x 242 array that references (high vs low SNR)
+    for each trial (e.g. which condition order set to check to lookup correct
+    row in item set list).
+
+    The n-th HighSNR trial uses the n-th entry of twOrderP (and the same for
+    LowSNR / twOrderNP), so the rows for all trials are looked up at once with
+    array indexing instead of walking through the trials with counters. Only
+    these four variables are read from the .mat file.
+
+    Parameters
+    ----------
+    data_name : STRING
+        Path of the .mat results file.
+
+    Returns
+    -------
+    A list of the target word (STRING) for each trial. If isPrimedSeq
+    contains a value other than 0 or 1 an error is printed and the list stops
+    at that trial (as the original loop did).
+
+    '''
+    data = loadmat(data_name, variable_names=['list', 'twOrderP', 'twOrderNP', 'isPrimedSeq'])
+    item_sets = data['list']
+    high_SNR_order = data['twOrderP'][0].astype(int)
+    low_SNR_order = data['twOrderNP'][0].astype(int)
+    condition_order = data['isPrimedSeq'][0]
+
+    unexpected = np.flatnonzero((condition_order != 0) & (condition_order != 1))
+    if len(unexpected) > 0:
+        print('ERROR - condition_order contains unexpected value (not 0 or 1)')
+        condition_order = condition_order[:unexpected[0]]
+    is_high = condition_order == 1
+
+    # Subtract 1 from the orders due to Python / Matlab indices
+    target_rows = np.empty(len(condition_order), dtype=int)
+    target_rows[is_high] = high_SNR_order[:is_high.sum()] - 1
+    target_rows[~is_high] = low_SNR_order[:(~is_high).sum()] - 1
+
+    # The first [0] of each cell references a 1x1 array, the second [0] gets
+    # the contents of the only cell in that array (the string of the target)
+    targets = array([str(cell[0]) for cell in item_sets[:, 0]])
+    return targets[target_rows].tolist()
+
+def epochSubject(sID, manifest):
+    '''
+    Run the full epoching step for a single subject: build the target word list
+    from the .mat file, read and filter the BDF, epoch, downsample and save the
+    -epo.fif file in epochsFolder.
+
+    Defined as a function (rather than directly in the for loop as before) so
+    that subjects can be sent to a pool of worker processes. See
+    parallel_processing below.
+
+    Parameters
+    ----------
+    sID : STRING
+        The subject ID (key of removed_channels).
+    manifest : DICT
+        The subject manifest from HANG_manifest.buildManifest(), used to look
+        up the subject's .mat and .bdf files without listing any folders.
+
+    Returns
+    -------
+    fname : STRING
+        The path of the saved -epo.fif file.
+    trials : pandas DataFrame
+        The subject's rows for the cross-subject trial table.
+
+    '''
+    # Folder matching (including a few wierd folder names) is done once for
+    # all subjects in buildManifest()
+    data_name = manifest[sID]['mat']
+    target_words = targetWords(data_name)
+
+    raw_name = manifest[sID]['bdf']
+    raw = mne.io.read_raw_bdf(raw_name)
+
+    if len(raw.info.ch_names) == 73:
+        raw.set_channel_types(mapping=
+                              {'EXG1': 'eog',
+                               'EXG2': 'eog',
+                               'EXG3': 'eog',
+                               'EXG4': 'eog',
+                               'EXG5': 'eog',
+                               'EXG6': 'eog',
+                               'EXG7': 'eog',
+                               'EXG8': 'eog'})
+
+    raw.set_montage(montage)
+    picks = mne.pick_types(raw.info, meg=False, eeg=True, stim=False, eog=False)
+
+    raw_events = subjectEvents(sID, raw, manifest)
+    metadata, events, event_id = makeMetadata(raw_events, raw.info['sfreq'])
+    if epoching_mode == 'standard':
+        if verify_epoching and epoch_filter == 'bpf':
+            compareBandpassFilter(raw, picks, sID, tolerance=verify_tolerance)
+        epochs = standardEpochs(raw, picks, events, event_id, metadata)
+    elif epoch_filter == 'bpf':
+        raise ValueError("epoch_filter = 'bpf' only works with epoching_mode = 'standard'")
+    else:
+        if epoching_mode == 'streaming':
+            epochs = streamEpochs(raw, events, event_id, metadata, picks,
+                                  tmin=epoch_params['tmin'], tmax=epoch_params['tmax'],
+                                  l_freq=epoch_params['l_freq'], h_freq=epoch_params['h_freq'],
+                                  sfreq_new=epoch_params['sfreq'], block_seconds=block_seconds)
+        elif epoching_mode == 'fused':
+            epochs = fusedEpochs(raw, events, event_id, metadata, picks,
+                                 tmin=epoch_params['tmin'], tmax=epoch_params['tmax'],
+                                 l_freq=epoch_params['l_freq'], h_freq=epoch_params['h_freq'],
+                                 decim=int(raw.info['sfreq'] / epoch_params['sfreq']),
+                                 max_run_seconds=block_seconds)
+        else:
+            raise ValueError('Unknown epoching_mode: ' + str(epoching_mode))
+        if verify_epoching:
+            compareEpochs(epochs, standardEpochs(raw, picks, events, event_id, metadata), sID,
+                          tolerance=verify_tolerance)
+    # Add removed channels information from subject log
+    epochs.info['bads'] = removed_channels[sID]
+    # Add target word order to metadata
+    if len(epochs) == len(target_words):
+        epochs.metadata['TargetWord'] = target_words
+    else:
+        print("Length of target_words (from .mat file) does not equal length of epochs for " +sID)
+        print("Metadata has not been updated to include target_words - recheck manually")
+    fname = os.path.join(cwd, epochsFolder, sID + '-epo.fif')
+    # Later steps memory-map the data in this file (see HANG_epochs)
+    saveEpochs(epochs, fname)
+    return fname, trialRows(sID, epochs)
+
+def rebuildMetadata(sID, manifest):
+    '''
+    Rebuild the metadata (including TargetWord) of an already saved -epo.fif
+    file from the cached -eve.fif events and the .mat file, without reading
+    any BDF data (only the BDF header, for the sampling frequency). Used when
+    metadata_only is True, e.g. after changing makeMetadata() or
+    targetWords().
+
+    Parameters
+    ----------
+    sID : STRING
+        The subject ID.
+    manifest : DICT
+        The subject manifest from HANG_manifest.buildManifest().
+
+    Returns
+    -------
+    fname : STRING
+        The path of the re-saved -epo.fif file.
+    trials : pandas DataFrame
+        The subject's rows for the cross-subject trial table.
+
+    '''
+    fname = os.path.join(cwd, epochsFolder, sID + '-epo.fif')
+    # Not HANG_epochs.readEpochs - the file is rewritten below and Windows
+    # will not replace a file that is memory-mapped
+    epochs = mne.read_epochs(fname, preload=True)
+    raw = mne.io.read_raw_bdf(manifest[sID]['bdf'])
+    raw_events = subjectEvents(sID, raw, manifest)
+    metadata, events, event_id = makeMetadata(raw_events, raw.info['sfreq'])
+    # epochs.selection holds the rows of events that made it into the epochs
+    epochs.metadata = metadata.iloc[epochs.selection].reset_index(drop=True)
+    target_words = targetWords(manifest[sID]['mat'])
+    if len(epochs) == len(target_words):
+        epochs.metadata['TargetWord'] = target_words
+    else:
+        print("Length of target_words (from .mat file) does not equal length of epochs for " +sID)
+        print("Metadata has not been updated to include target_words - recheck manually")
+    saveEpochs(epochs, fname)
+    return fname, trialRows(sID, epochs)
 
 #######################################
-# If reprocess_data is True, change file saving overwring to be True
-# And skip the check for already created -epo.fif files for each sID
-reprocess_data = True
+# Which subjects are (re)processed is decided by the build cache (see
+# HANG_cache): a subject is epoched again only if its -epo.fif is missing, its
+# .bdf or .mat file changed, or epoch_params / its bad channels changed.
+# If reprocess_data is True, every subject is reprocessed regardless.
+reprocess_data = False
+# Outputs made before the build cache existed have no record, so they are
+# rebuilt. Set adopt_existing to True for ONE run after switching to the cache
+# to record them as up to date with the current inputs and settings instead -
+# only if they were made with the settings below. Then set it back to False:
+# while it is True an output without a record is never rebuilt, whatever
+# settings it was made with.
+adopt_existing = False
+
+# Filter band, epoch window and final sampling frequency. Changing any of
+# these makes the build cache reprocess every subject (and later steps).
+epoch_params = dict(l_freq=2, h_freq=45, tmin=-0.5, tmax=2.1, sfreq=512)
+
+# If parallel_processing is True, subjects are sent to a pool of n_workers
+# worker processes instead of being run one at a time. worker_memory_gb is the
+# memory one worker needs (a 73 channel BDF filtered in float64 is several GB):
+# no more workers are started than fit in the available memory. It is not a
+# hard limit (see HANG_parallel), on Windows or elsewhere. Errors are
+# collected per subject and written to epoching_errors.txt in epochsFolder.
+# Set to False to run in the console one subject at a time (errors stop the
+# script, which is easier for debugging a single subject).
+parallel_processing = True
+n_workers = 16
+worker_memory_gb = 8
+
+# If metadata_only is True, no epoching is done. Instead the metadata (and
+# TargetWord) of every existing -epo.fif file is rebuilt from the cached
+# events (-eve.fif, saved in epochsFolder the first time a subject is epoched)
+# and the .mat file, without reading the BDF data. Rewriting the files changes
+# their content hashes, but rejection, ICA and CIAC do not use the metadata, so
+# 2-Rejection's build cache (in ICA_folder) is updated to the new files and
+# nothing is rejected again. The files made by the later steps keep their old
+# metadata - use the trial table written here for the new metadata.
+metadata_only = False
+
+# epoching_mode = 'standard' loads and filters the whole recording in memory
+# before epoching (original method). 'streaming' reads the BDF in blocks of
+# block_seconds, filters each block and cuts epochs straight from it, so
+# memory use depends on block_seconds rather than on recording length. Both
+# give the same filtered epochs. Streaming lets more workers run at once.
+# 'fused' only reads and filters the samples the epochs need (plus filter
+# padding) and decimates by 4 while cutting epochs instead of resampling.
+# If verify_epoching is True, every subject is also epoched the standard way
+# and the relative RMS difference is printed (PASSED if below
+# verify_tolerance). This doubles the run time - use it on a few subjects only.
+epoching_mode = 'standard'
+block_seconds = 60
+verify_epoching = False
+verify_tolerance = 0.01
+
+# epoch_filter = 'mne' filters with raw.filter(l_freq, h_freq) from
+# epoch_params. 'bpf' uses the custom BPF.m filter instead (see
+# BandpassFilter) with the bpf_params below - standard epoching_mode only.
+# With 'bpf', verify_epoching compares BPF with the original BPF function on
+# the first minute of every subject instead. bpf_threads channels blocks are
+# filtered in parallel and bpf_float32 filters in single precision. When
+# combined with parallel_processing, keep n_workers * bpf_threads <= number
+# of cores.
+epoch_filter = 'mne'
+bpf_params = dict(norder=256, cf1=1, cf2=57)
+bpf_threads = 4
+bpf_float32 = False
+BPF = BandpassFilter(n_jobs=bpf_threads, float32=bpf_float32)
 
 epochsFolder = '1_epochs_w_excluded_channel_info'
+# Output folder of 2-Rejection (only its build cache is used, see
+# metadata_only)
+ICA_folder = '2_ICA_set'
 cwd = os.getcwd()
 
 montage = mne.channels.montage.read_dig_fif('Biosemi64median206subjects10percentLarger_dig.fif')
@@ -108,6 +934,15 @@ alt_event_dict = event_dict.copy()
 for key, value in alt_event_dict.items():
     alt_event_dict[key] = int(value/256 + 65280)
 
+# OT0865 and OT0868 use a third scheme: 180 + (MATLAB VALUE*256)
+offset_event_dict = event_dict.copy()
+for key, value in offset_event_dict.items():
+    offset_event_dict[key] = value + 180
+
+# The scheme used by each recording is detected from its trigger values (see
+# detectTriggerScheme)
+trigger_schemes = {'standard': event_dict, 'alt': alt_event_dict, 'offset180': offset_event_dict}
+
 removed_channels = {'OT0421': ['A16,A23,A24'],
                     'OT0431': ['A16,A23,A24,B21,B28,B29'],
                     'OT0432': ['A16,A23,A24,B10,B21'],
@@ -280,12 +1115,13 @@ removed_channels = {'OT0421': ['A16,A23,A24'],
                     'OT0855': ['B20,B21,B22,B27,B28,B29,B31'],
                     'OT0859': ['A15,A17,A22,B19,B21,B22,B29'],
                     'OT0861': ['A15,A16,A17'],
-                    # 'OT0865': ['A16,A22,A23,B20,B21,A17'], # Odd trigger values - skip for now
-                    # 'OT0868': ['A14,A15,A16,A17,A18,A22,A23,A24,B20,B21,B22,B23,B26,B27,B28,B29,B24,B25'],
+                    'OT0865': ['A16,A22,A23,B20,B21,A17'],
+                    'OT0868': ['A14,A15,A16,A17,A18,A22,A23,A24,B20,B21,B22,B23,B26,B27,B28,B29,B24,B25'],
                     }
-# NOTE ABOUT ABOVE: Ask Inyong about why OT0865 and OT0868 seem to have a 
-# trigger scheme that is 180 + (MATLAB VALUE*256) as opposed to the previous
-# two patterns defined above
+# NOTE ABOUT ABOVE: OT0865 and OT0868 were skipped for a while because they
+# have a trigger scheme that is 180 + (MATLAB VALUE*256) as opposed to the
+# previous two patterns defined above. This is now detected automatically
+# (offset_event_dict). Still ask Inyong why.
 
 # For ease of importing from HANG data spreadsheet, above dictionary was created
 # by removing spaces from log entries and using a formula to create the dictionary.
@@ -298,123 +1134,70 @@ for subject in removed_channels:
 # NOTE: Several of these sIDs have folders with additional characters at the end
 sIDs = [subject for subject in removed_channels]
 
-# Check which sIDs already have -epo.fif files in epochsFolder
-if reprocess_data:
-    already_processed = []
-else:
-    already_processed = [file[0:6] for file in os.listdir(epochsFolder) if file.endswith('-epo.fif')]
+# Main loop is kept under __main__ so that worker processes (which re-import
+# this script on Windows) do not start processing subjects themselves
+if __name__ == '__main__':
+    # One scan of the data root (cached in subject_manifest.json) instead of
+    # listing folders for every subject
+    manifest = buildManifest(sIDs)
+    missing = [sID for sID in sIDs if sID not in manifest]
+    if missing:
+        print('No data folder found for: ' + ', '.join(missing))
+    sIDs = [sID for sID in sIDs if sID in manifest]
+    # Folders without the .bdf or the .mat cannot be epoched (and their None
+    # paths cannot be hashed below)
+    incomplete = [sID for sID in sIDs if manifest[sID]['bdf'] is None or manifest[sID]['mat'] is None]
+    if incomplete:
+        print('No .bdf or .mat file found for: ' + ', '.join(incomplete))
+    sIDs = [sID for sID in sIDs if sID not in incomplete]
 
-for sID in sIDs:
-    if sID in already_processed:
-        continue
+    # Check which sIDs have up to date -epo.fif files in epochsFolder
+    cache = BuildCache(os.path.join(cwd, epochsFolder, 'build_cache_epoching.json'))
+    inputs = {sID: [manifest[sID]['bdf'], manifest[sID]['mat']] for sID in sIDs}
+    params = {sID: dict(epoch_params, epoching_mode=epoching_mode, bads=removed_channels[sID]) for sID in sIDs}
+    if epoch_filter == 'bpf':
+        # Only added for BPF so the MNE filter runs keep their cache entries
+        for sID in sIDs:
+            params[sID].update(epoch_filter=epoch_filter, **bpf_params)
+    outputs = {sID: os.path.join(cwd, epochsFolder, sID + '-epo.fif') for sID in sIDs}
+    if metadata_only:
+        step = rebuildMetadata
+        sIDs = [sID for sID in sIDs if os.path.exists(outputs[sID])]
+        # Content hashes before the files are rewritten
+        cache.hashFiles([outputs[sID] for sID in sIDs])
+        old_hashes = {sID: cache.fileHash(outputs[sID]) for sID in sIDs}
     else:
-        # New method to match a few wierd folder names
-        directory = [folder for folder in os.listdir() if folder.startswith(sID)][0]
-        for file in os.listdir(directory):
-            if file.endswith(".mat"):
-                data_name = os.path.join(directory, file)
-                data = loadmat(data_name)
-    
-        # data['list'] is a 120 x 4 cell array storing 1-item "lists" in each cell
-        # Each row is an item set from ITCP
-        # For the ISNT experiment script, the target word is always the first column
-        # in each row - response order is randomized per trial within the experiment
-        # script
-        item_sets = data['list']
-        
-        # data['twOrderP'] and data['twOrderNP'] are both 1 x 121 arrays that
-        # reference the row to reference in data['list'] for each trial of a particular
-        # condition    
-        high_SNR_order = list(data['twOrderP'][0])
-        low_SNR_order = list(data['twOrderNP'][0])
-        
-        # data['isPrimedSeq'] is a 1 x 242 array that references (high vs low SNR) for
-        # each trial (e.g. which condition order set to check to lookup correct row in
-        # item set list)
-        condition_order = list(data['isPrimedSeq'][0])
-        
-        target_words = []
-        counter_high = 0
-        counter_low = 0
-        
-        for trial in condition_order:
-            if trial == 1:
-                condition = 'HighSNR'
-                # Subtract 1 from the high_SNR_order report due to Python / Matlab indices
-                target_row = high_SNR_order[counter_high] - 1
-                counter_high += 1
-                # The first [0] references a 1x1 array, the second [0] gets the
-                # contents of the only cell in that array (the string of the target)
-                target = str(item_sets[target_row][0][0])
-                target_words.append(target)
-            elif trial == 0:
-                condition = 'LowSNR'
-                # Subtract 1 from the low_SNR_order report due to Python / Matlab indices
-                target_row = low_SNR_order[counter_low] - 1
-                counter_low += 1
-                # The first [0] references a 1x1 array, the second [0] gets the
-                # contents of the only cell in that array (the string of the target)
-                target = str(item_sets[target_row][0][0])
-                target_words.append(target)
-            else:
-                print('ERROR - condition_order contains unexpected value (not 0 or 1)')
-                break
-            
-        for file in os.listdir(directory):
-            if file.endswith('.bdf'):
-                raw_name = os.path.join(directory, file)
-        
-        raw = mne.io.read_raw_bdf(raw_name)
-        
-        if len(raw.info.ch_names) == 73:
-            raw.set_channel_types(mapping=
-                                  {'EXG1': 'eog',
-                                   'EXG2': 'eog',
-                                   'EXG3': 'eog',
-                                   'EXG4': 'eog',
-                                   'EXG5': 'eog',
-                                   'EXG6': 'eog',
-                                   'EXG7': 'eog',
-                                   'EXG8': 'eog'})
-        
-        raw.set_montage(montage)
-        raw.load_data()
-        
-        # Now using a custom version of BPF.m that is used in MATLAB
-        # to make a custom filter with much shorter length to account for
-        # potential ringing in the time domain of the CI artifact
-        # data[:-1,:] gets all but the last channel for filtering (last channel is stimulus channel)
-        # raw._data[:-1,:] = BPF(data=raw._data[:-1,:], fs=2048, norder=256, cf1=1, cf2=57)
-        
-        # Reverting to using MNE Python's filter defaults to create an epochs
-        # object suitable for ICA
-        raw.filter(2,45)
-        
-        raw_events = mne.find_events(raw, shortest_event=1)
-        picks = mne.pick_types(raw.info, meg=False, eeg=True, stim=False, eog=False)
-        if min(raw_events[:,2]) > 64000:
-            metadata, events, event_id = mne.epochs.make_metadata(events=raw_events, event_id=alt_event_dict,
-                                                                  tmin=-0.5, tmax=10.0, sfreq=raw.info['sfreq'],
-                                                                  row_events = ['female/HighSNR', 'female/LowSNR',
-                                                                                'male/HighSNR', 'male/LowSNR'],
-                                                                  keep_first = 'response')
-        else:
-            metadata, events, event_id = mne.epochs.make_metadata(events=raw_events, event_id=event_dict,
-                                                                  tmin=-0.5, tmax=10.0, sfreq=raw.info['sfreq'],
-                                                                  row_events = ['female/HighSNR', 'female/LowSNR',
-                                                                                'male/HighSNR', 'male/LowSNR'],
-                                                                  keep_first = 'response')
-        epochs = mne.Epochs(raw=raw,events=events,event_id=event_id, metadata=metadata,
-                            tmin=-0.5,tmax=2.1,baseline=None,picks=picks,preload=True)
-        # Downsample to 512 Hz
-        epochs.resample(512)
-        # Add removed channels information from subject log
-        epochs.info['bads'] = removed_channels[sID]
-        # Add target word order to metadata
-        if len(epochs) == len(target_words):
-            epochs.metadata['TargetWord'] = target_words
-        else:
-            print("Length of target_words (from .mat file) does not equal length of epochs for " +sID)
-            print("Metadata has not been updated to include target_words - recheck manually")
-        fname = os.path.join(cwd, epochsFolder, sID + '-epo.fif')
-        epochs.save(fname, overwrite=reprocess_data)
\ No newline at end of file
+        step = epochSubject
+        if not reprocess_data:
+            cache.hashFiles([path for sID in sIDs for path in inputs[sID]])
+            sIDs = [sID for sID in sIDs if not cache.isCurrent(outputs[sID], inputs[sID], params[sID], adopt=adopt_existing)]
+    print(str(len(sIDs)) + ' subjects to process')
+
+    if parallel_processing:
+        results, errors = runSubjects(step, sIDs, n_workers=n_workers,
+                                      memory_gb=worker_memory_gb, args=(manifest,),
+                                      initializer=mne.set_log_level, initargs=('WARNING',))
+        if errors:
+            print('----------')
+            print('Epoching failed for ' + str(len(errors)) + ' subjects: ' + ', '.join(sorted(errors)))
+            with open(os.path.join(cwd, epochsFolder, 'epoching_errors.txt'), 'w') as file:
+                for sID in sorted(errors):
+                    file.write('##### ' + sID + '\n' + errors[sID] + '\n')
+    else:
+        results = dict()
+        for sID in sIDs:
+            results[sID] = step(sID, manifest)
+
+    rejection_cache_fname = os.path.join(cwd, ICA_folder, 'build_cache_rejection.json')
+    if metadata_only and os.path.exists(rejection_cache_fname):
+        # Only the metadata changed, so what 2-Rejection made from these files
+        # is still up to date (see metadata_only)
+        rejection_cache = BuildCache(rejection_cache_fname)
+        n_kept = sum(rejection_cache.replaceHash(outputs[sID], old_hashes[sID]) for sID in results)
+        print(str(n_kept) + ' 2-Rejection outputs kept up to date')
+    for sID in results:
+        cache.record(outputs[sID], inputs[sID], params[sID])
+
+    # One table with every subject's trials (metadata + TargetWord)
+    writeTrialTable([results[sID][1] for sID in sorted(results)],
+                    os.path.join(cwd, epochsFolder, 'trial_table'))
@@ -18,21 +18,29 @@ whichEpochs = [i for i in range(len(epochs.drop_log)) if len(epochs.drop_log[i])
 
 import mne
 import os
-import pandas as pd
 import matplotlib.pyplot as plt
+from HANG_cache import BuildCache
+from HANG_epochs import readEpochs, saveEpochs
+from HANG_parallel import runSubjects
+from HANG_rejection import PeakMatrix, suggestedCutoff, flagReasons, readRejectionLog, writeRejectionLog
 
-def epochRejection(epochs, baseline=(-0.2,0)):
+def epochRejection(epochs, baseline=(-0.2,0), peaks=None, rule=None):
     '''
     Function to implement the same histogram procedure as used in the MATLAB
-    processing pipeline. This function first creates a copy of the epochs
-    object and applies a baseline (see baseline parameter for more information)
-    after which a histogram is generated of the maximum voltage (absolute 
-    value) observed in each epoch across all non-excluded channels.
+    processing pipeline. A histogram is generated of the maximum voltage 
+    (absolute value, after applying a baseline - see baseline parameter for
+    more information) observed in each epoch across all non-excluded channels.
+    The baseline is only accounted for in the computed maxima, the epochs data
+    themselves are not changed or copied.
     
     Press "c" to exit debugging and continue to picking a rejection threshold.
     
-    Because MNE's Epochs drop() method operates in place, this function does 
-    not actually return any output.
+    If a rule is given, nothing is plotted and the threshold is picked by the
+    rule instead (for running without a reviewer, see interactive below).
+    
+    Because MNE's Epochs drop() method operates in place, the epochs are
+    changed in place. The threshold and dropped epochs are returned for the
+    rejection log.
     
     NOTE: This function is meant to be applied to data to which a baseline has
     not yet been applied (e.g. baseline=None during initial epoching). It has 
@@ -80,83 +88,108 @@ def epochRejection(epochs, baseline=(-0.2,0)):
         after ICA, but plotting a histogram of non-baselined voltages results 
         in data that are hard to interpret. This should be the same as the
         desired baseline for later processing. The default is (-0.2,0).
+    peaks : HANG_rejection.PeakMatrix CLASS, optional
+        The subject's peak matrix, shared between the rejection passes so the
+        epochs data are only used once. It is updated for the dropped epochs.
+        If None, it is computed from epochs. The default is None.
+    rule : DICT, optional
+        Keyword arguments for HANG_rejection.suggestedCutoff() (e.g.
+        dict(rule='iqr', k=1.5)). If given, the threshold is picked by this
+        rule without plotting or asking. The default is None (ask).
 
     Returns
     -------
-    None.
+    epochThreshold : INT
+        The threshold used.
+    dropped : LIST of INT
+        The dropped epochs (epoch numbers as in epochs.selection).
 
     '''
-    channels = [ch for ch in epochs.info['ch_names'] if ch not in epochs.info['bads']]
-    epochs_copy = epochs.copy()
-    epochs_copy.apply_baseline(baseline)
-    df = epochs_copy.to_data_frame()
-    epochMax = []
-    del epochs_copy
-    for epoch in df['epoch'].unique():
-        voltage = df.loc[df['epoch']==epoch]
-        voltage = voltage[channels].abs()
-        maxValue = voltage[channels].max(axis=1).max(axis=0)
-        result = [epoch, maxValue]
-        epochMax.append(result)
-    epochMax = pd.DataFrame(data=epochMax, columns=['Epoch', 'MaxValue'])
-    q1 = epochMax['MaxValue'].quantile(.25)
-    q3 = epochMax['MaxValue'].quantile(.75)
-    iqr = q3-q1
-    cutoff = int(q3+1.5*iqr)
-    plt.hist(epochMax['MaxValue'])
-    title_text = 'Automatic suggested threshold (dotted line): ' + str(cutoff)
-    plt.title(title_text)
-    plt.axvline(x=cutoff,linestyle='dotted',color='black')
-    plt.show()
-    breakpoint()
-    epochThreshold = input('What threshold for rejecting epochs?\n')
-    plt.close()
+    if peaks is None:
+        peaks = PeakMatrix(epochs, baseline)
+    else:
+        peaks.sync(epochs)
+    epochMax = peaks.epochMax()
+    if rule is None:
+        q1 = epochMax['MaxValue'].quantile(.25)
+        q3 = epochMax['MaxValue'].quantile(.75)
+        iqr = q3-q1
+        cutoff = int(q3+1.5*iqr)
+        plt.hist(epochMax['MaxValue'])
+        title_text = 'Automatic suggested threshold (dotted line): ' + str(cutoff)
+        plt.title(title_text)
+        plt.axvline(x=cutoff,linestyle='dotted',color='black')
+        plt.show()
+        breakpoint()
+        epochThreshold = input('What threshold for rejecting epochs?\n')
+        plt.close()
+    else:
+        epochThreshold = suggestedCutoff(epochMax['MaxValue'], **rule)
     whichEpochs = epochMax[epochMax.iloc[:,1] > int(epochThreshold)]
+    dropped = whichEpochs['Epoch'].tolist()
     epochs.drop(whichEpochs.index[:].tolist())
+    peaks.sync(epochs)
     if not epochs.info['description']:
         epochs.info['description'] = 'Initial epoch rejection threshold: ' + str(epochThreshold) + '.  '
     else:
         epochs.info['description'] = epochs.info['description'] + 'Second epoch rejection threshold: ' + str(epochThreshold) + '.'
+    return int(epochThreshold), dropped
 
-def channelRejection(epochs, baseline=(-0.2,0)):
+def channelRejection(epochs, baseline=(-0.2,0), peaks=None, rule=None):
     '''
     Function to implement the same histogram procedure as used in the MATLAB
-    processing pipeline. This function first creates a copy of the epochs
-    object and applies a baseline (see baseline parameter for more information)
-    after which a histogram is generated of the maximum voltage (absolute 
-    value) observed in each epoch across all non-excluded channels.
+    processing pipeline. A histogram is generated of the maximum voltage 
+    (absolute value, after applying a baseline - see baseline parameter for
+    more information) observed in each non-excluded channel across all epochs.
     
     Press "c" to exit debugging and continue to picking a rejection threshold.
     
-    Because MNE's Epochs drop() method operates in place, this function does 
-    not actually return any output.
+    If a rule is given, nothing is plotted and the threshold is picked by the
+    rule instead.
+    
+    Channels are marked bad in epochs.info['bads'] in place. The threshold and
+    new bad channels are returned for the rejection log.
     
     See epochRejection() function for further notes on potential changes / TODO
 
     Parameters
     ----------
-    epochs : TYPE
-        DESCRIPTION.
-    baseline : TYPE, optional
-        DESCRIPTION. The default is (-0.2,0).
+    epochs : mne.epochs.EpochsFIF CLASS
+        The epochs class to be used in processing.
+    baseline : TUPLE, optional
+        A tuple of the initial and final time to be used as the baseline. The
+        default is (-0.2,0).
+    peaks : HANG_rejection.PeakMatrix CLASS, optional
+        The subject's peak matrix (see epochRejection). It is updated for the
+        new bad channels. If None, it is computed from epochs. The default is
+        None.
+    rule : DICT, optional
+        Keyword arguments for HANG_rejection.suggestedCutoff() (e.g.
+        dict(rule='mad', k=5.0)). If given, the threshold is picked by this
+        rule without plotting or asking. The default is None (ask).
 
     Returns
     -------
-    None.
+    channelThreshold : INT
+        The threshold used.
+    badChannel : LIST of STRING
+        The channels marked bad.
 
     '''
-    channels = [ch for ch in epochs.info['ch_names'] if ch not in epochs.info['bads']]
-    epochs_copy = epochs.copy()
-    epochs_copy.apply_baseline(baseline)
-    df = epochs_copy.to_data_frame()
-    del epochs_copy
-    channelMax = []
-    for channel in channels:
-        temp = df[channel].abs()
-        maxValue = temp.max()
-        result = [channel, maxValue]
-        channelMax.append(result)
-    channelMax = pd.DataFrame(data=channelMax, columns=['Channel', 'MaxValue'])
+    if peaks is None:
+        peaks = PeakMatrix(epochs, baseline)
+    else:
+        peaks.sync(epochs)
+    channelMax = peaks.channelMax()
+    if rule is not None:
+        channelThreshold = suggestedCutoff(channelMax['MaxValue'], **rule)
+        whichChannels = channelMax[channelMax.iloc[:,1] > channelThreshold]
+        badChannel = whichChannels['Channel'].tolist()
+        for channel in badChannel:
+            epochs.info['bads'].append(channel)
+        peaks.sync(epochs)
+        epochs.info['description'] = epochs.info['description'] + 'Channel rejection threshold: ' + str(channelThreshold) + '.  '
+        return channelThreshold, badChannel
     plt.hist(channelMax['MaxValue'])
     plt.title('Choose a max voltage for rejecting channels')
     plt.show()
@@ -177,12 +210,157 @@ def channelRejection(epochs, baseline=(-0.2,0)):
     plt.close()
     for channel in badChannel:
         epochs.info['bads'].append(channel)
+    peaks.sync(epochs)
     epochs.info['description'] = epochs.info['description'] + 'Channel rejection threshold: ' + str(channelThreshold) + '.  '
+    return int(channelThreshold), badChannel
+
+def rejectSubject(sID, epoch_rule=None, channel_rule=None):
+    '''
+    Run the three rejection passes (epochs, channels, epochs again) for one
+    subject and save the result to ICA_folder.
+
+    Parameters
+    ----------
+    sID : STRING
+        The subject ID.
+    epoch_rule : DICT, optional
+        Rule for both epoch passes (see epochRejection). The default is None
+        (ask).
+    channel_rule : DICT, optional
+        Rule for the channel pass (see channelRejection). The default is None
+        (ask).
+
+    Returns
+    -------
+    entry : DICT
+        The subject's rejection log entry (see HANG_rejection).
+
+    '''
+    path = os.path.join(cwd, epochsFolder, sID + '-epo.fif')
+    fname_preICA = os.path.join(cwd, ICA_folder, sID + '-epo.fif')
+    sidecar = os.path.join(cwd, epochsFolder, sID + '-peaks.npz')
+    peaks = None
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+        # Review sidecar from the prepass - only the header of the epochs file
+        # is read now, the data are loaded once all rejections are picked
+        epochs = mne.read_epochs(path, preload=False)
+        peaks, summary = PeakMatrix.load(sidecar)
+        if not peaks.matches(epochs, rejection_params['baseline']):
+            print('Review sidecar for ' + sID + ' does not match its epochs - computing peaks again')
+            peaks = None
+        elif epoch_rule is None:
+            print('Suggested thresholds from prepass - epochs: ' + str(summary['epoch_cutoff']) +
+                  ', channels: ' + str(summary['channel_cutoff']))
+    if peaks is None:
+        # Data memory-mapped read-only (see HANG_epochs) - nothing below
+        # changes the data in place, dropping epochs makes a copy
+        epochs = readEpochs(path)
+        # Baselined peak of every epoch and channel - all three histograms
+        # come from this, the epochs data are not used again
+        peaks = PeakMatrix(epochs, baseline=rejection_params['baseline'])
+    n_epochs = len(epochs)
+
+    # Plot histogram of epoch max voltage values
+    epoch_threshold, dropped = epochRejection(epochs, peaks=peaks, rule=epoch_rule)
+    
+    # Plot histogram of channel max voltage values
+    channel_threshold, bad_channels = channelRejection(epochs, peaks=peaks, rule=channel_rule)
+
+    # Plot histogram of epoch max voltage levels - second time
+    second_threshold, dropped_second = epochRejection(epochs, peaks=peaks, rule=epoch_rule)
+    
+    if not epochs.preload:
+        # Only the epochs that are kept are read
+        epochs.load_data()
+    saveEpochs(epochs, fname_preICA)
+
+    entry = {'mode': 'interactive' if epoch_rule is None else 'auto',
+             'epoch_threshold': epoch_threshold,
+             'channel_threshold': channel_threshold,
+             'second_epoch_threshold': second_threshold,
+             'dropped_epochs': dropped + dropped_second,
+             'bad_channels': bad_channels,
+             'n_epochs': n_epochs,
+             'n_kept': len(epochs),
+             'description': epochs.info['description']}
+    if epoch_rule is not None:
+        entry['epoch_rule'] = epoch_rule
+        entry['channel_rule'] = channel_rule
+        entry['flagged'] = flagReasons(entry, max_dropped_fraction, max_bad_channels)
+    return entry
+
+def reviewSidecar(sID):
+    '''
+    Prepass for the interactive review: compute the subject's peak matrix and
+    suggested thresholds and save them as a small sidecar file
+    (sID-peaks.npz in epochsFolder). rejectSubject() then draws the
+    histograms from the sidecar and only loads the epochs data after the
+    reviewer picked all thresholds.
+
+    Parameters
+    ----------
+    sID : STRING
+        The subject ID.
+
+    Returns
+    -------
+    STRING of the sidecar path.
+
+    '''
+    path = os.path.join(cwd, epochsFolder, sID + '-epo.fif')
+    sidecar = os.path.join(cwd, epochsFolder, sID + '-peaks.npz')
+    epochs = readEpochs(path)
+    peaks = PeakMatrix(epochs, baseline=rejection_params['baseline'])
+    epochMax = peaks.epochMax()['MaxValue']
+    channelMax = peaks.channelMax()['MaxValue']
+    summary = {'n_epochs': len(epochs),
+               'epoch_cutoff': suggestedCutoff(epochMax, **epoch_rule),
+               'channel_cutoff': suggestedCutoff(channelMax, **channel_rule),
+               'epoch_quartiles': epochMax.quantile([.25, .5, .75]).tolist(),
+               'channel_quartiles': channelMax.quantile([.25, .5, .75]).tolist()}
+    peaks.save(sidecar, summary)
+    return sidecar
 
 #######################################
-# If reprocess_data is True, change file saving overwring to be True
-# And skip the check for already created -epo.fif files for each sID
+# Which subjects are (re)processed is decided by the build cache (see
+# HANG_cache): a subject is processed again only if its output is missing, one
+# of its input files changed or the parameters below changed.
+# If reprocess_data is True, every subject is reprocessed regardless.
 reprocess_data = False
+# Outputs made before the build cache existed have no record, so they are
+# rebuilt. Set adopt_existing to True for ONE run after switching to the cache
+# to record them as up to date with the current inputs and settings instead -
+# only if they were made with the settings below. Then set it back to False:
+# while it is True an output without a record is never rebuilt, whatever
+# settings it was made with.
+adopt_existing = False
+
+rejection_params = dict(baseline=(-0.2,0))
+
+# If interactive is False, nobody needs to sit through the histograms: every
+# threshold is picked by a rule (epoch_rule for both epoch passes - the same
+# Q3+1.5*IQR suggestion shown on the epoch histograms - and channel_rule for
+# the channel pass, see HANG_rejection.suggestedCutoff) and all subjects are
+# run in a pool of n_workers processes. The thresholds, dropped epochs and bad
+# channels of every subject go to rejection_log.json in ICA_folder. Subjects
+# losing more than max_dropped_fraction of their epochs or more than
+# max_bad_channels channels are flagged in the log.
+# With interactive = True and review_flagged = True, flagged subjects are
+# done again by hand (from the original epochs), everything else is skipped.
+interactive = True
+review_flagged = True
+epoch_rule = dict(rule='iqr', k=1.5)
+channel_rule = dict(rule='mad', k=5.0)
+max_dropped_fraction = 0.15
+max_bad_channels = 4
+n_workers = 8
+worker_memory_gb = 4
+
+# If prepass is True, nothing is rejected: the review sidecars (peak matrix
+# and suggested thresholds, see reviewSidecar) are written for every subject
+# still to be processed, in the same pool of workers (e.g. overnight). The
+# next interactive session then shows each histogram right away.
+prepass = False
 
 cwd = os.getcwd()
 epochsFolder = '1_epochs_w_excluded_channel_info'
@@ -193,32 +371,60 @@ event_dict = {'female/HighSNR': 2816, 'female/LowSNR': 3328,
               'male/HighSNR': 3072, 'male/LowSNR': 3584,
               'response/correct':25600, 'response/incorrect':12800}
 
-sIDs = [subject[:6] for subject in os.listdir(epochsFolder) if subject.endswith('-epo.fif')]
+# Main loop is kept under __main__ so that worker processes (which re-import
+# this script on Windows) do not start processing subjects themselves
+if __name__ == '__main__':
+    sIDs = [subject[:6] for subject in os.listdir(epochsFolder) if subject.endswith('-epo.fif')]
+    sIDs = [sID for sID in sIDs if 'noEEG' not in sID]
 
-# Check which sIDs already have -epo.fif files in epochsFolder
-if reprocess_data:
-    already_processed = []
-else:
-    already_processed = [file[0:6] for file in os.listdir(ICA_folder) if file.endswith('-epo.fif')]
+    # Check which sIDs have up to date -epo.fif files in ICA_folder (i.e. made
+    # from the current epochs in epochsFolder)
+    cache = BuildCache(os.path.join(cwd, ICA_folder, 'build_cache_rejection.json'))
+    log_fname = os.path.join(cwd, ICA_folder, 'rejection_log.json')
+    inputs = {sID: os.path.join(cwd, epochsFolder, sID + '-epo.fif') for sID in sIDs}
+    outputs = {sID: os.path.join(cwd, ICA_folder, sID + '-epo.fif') for sID in sIDs}
+    if not reprocess_data:
+        if interactive and review_flagged:
+            log = readRejectionLog(log_fname)
+            flagged = [sID for sID in sIDs if sID in log and log[sID]['mode'] == 'auto' and log[sID]['flagged']]
+        else:
+            flagged = []
+        sIDs = [sID for sID in sIDs if sID in flagged or
+                not cache.isCurrent(outputs[sID], [inputs[sID]], rejection_params, adopt=adopt_existing)]
+    print(str(len(sIDs)) + ' subjects to process')
 
-for sID in sIDs:
-    if 'noEEG' in sID:
-        continue
-    elif sID in already_processed:
-        continue
+    if prepass:
+        results, errors = runSubjects(reviewSidecar, sIDs, n_workers=n_workers,
+                                      memory_gb=worker_memory_gb,
+                                      initializer=mne.set_log_level, initargs=('WARNING',))
+        if errors:
+            print('----------')
+            print('Prepass failed for ' + str(len(errors)) + ' subjects: ' + ', '.join(sorted(errors)))
+            with open(os.path.join(cwd, epochsFolder, 'prepass_errors.txt'), 'w') as file:
+                for sID in sorted(errors):
+                    file.write('##### ' + sID + '\n' + errors[sID] + '\n')
+    elif interactive:
+        for sID in sIDs:
+            print('Current subject: ' + sID)
+            entry = rejectSubject(sID)
+            cache.record(outputs[sID], [inputs[sID]], rejection_params)
+            writeRejectionLog({sID: entry}, log_fname)
     else:
-        fname = sID + '-epo.fif'
-        path = os.path.join(cwd, epochsFolder, fname)
-        epochs = mne.read_epochs(path)
-            
-        # Plot histogram of epoch max voltage values
-        epochRejection(epochs, baseline=(-0.2,0))
-        
-        # Plot histogram of channel max voltage values
-        channelRejection(epochs, baseline=(-0.2,0))
-    
-        # Plot histogram of epoch max voltage levels - second time
-        epochRejection(epochs, baseline=(-0.2,0))
-        
-        fname_preICA = os.path.join(cwd, ICA_folder, sID + '-epo.fif')
-        epochs.save(fname_preICA, overwrite=reprocess_data)
\ No newline at end of file
+        results, errors = runSubjects(rejectSubject, sIDs, n_workers=n_workers,
+                                      memory_gb=worker_memory_gb,
+                                      kwargs=dict(epoch_rule=epoch_rule, channel_rule=channel_rule),
+                                      initializer=mne.set_log_level, initargs=('WARNING',))
+        for sID in results:
+            cache.record(outputs[sID], [inputs[sID]], rejection_params)
+        writeRejectionLog(results, log_fname)
+        if errors:
+            print('----------')
+            print('Rejection failed for ' + str(len(errors)) + ' subjects: ' + ', '.join(sorted(errors)))
+            with open(os.path.join(cwd, ICA_folder, 'rejection_errors.txt'), 'w') as file:
+                for sID in sorted(errors):
+                    file.write('##### ' + sID + '\n' + errors[sID] + '\n')
+        flagged = [sID for sID in sorted(results) if results[sID]['flagged']]
+        print('----------')
+        print(str(len(flagged)) + ' of ' + str(len(results)) + ' subjects flagged for review:')
+        for sID in flagged:
+            print(sID + ': ' + ', '.join(results[sID]['flagged']))
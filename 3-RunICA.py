@@ -26,39 +26,253 @@ shifts.
 
 import mne
 import os
+import json
+from HANG_manifest import scanFolder
+from HANG_cache import BuildCache
+from HANG_epochs import readEpochs, writableEpochs
+from HANG_parallel import runSubjects
+import pandas as pd
+from HANG_ICA import fitICA, warmStartICA, carryExclude, writeFitReport, reducedFit, compareICA
+
+def carryLabels(sID, ica):
+    '''
+    After a refit, match the components the reviewers excluded
+    (postICA/sID-XX-ica.fif) to the new components (see
+    HANG_ICA.carryExclude) and write them to ICA_folder/sID-carried.json.
+    The reviewers' files are not changed: their -ica.fif and cleaned
+    -epo.fif files belong together and stay as reviewed. 4b shows the carried
+    exclusions when the subject is reviewed again. CIAC is not carried, 4a
+    runs it again for the new -ica.fif.
+
+    Parameters
+    ----------
+    sID : STRING
+        The subject ID.
+    ica : mne.preprocessing.ICA CLASS
+        The refit ICA.
+
+    Returns
+    -------
+    carried : LIST of STRING
+        The reviewer files whose excluded components all have a match of at
+        least label_min_corr.
+    not_carried : LIST of STRING
+        The reviewer files with excluded components without such a match
+        (only the matched ones are in the sidecar).
+
+    '''
+    sidecar = os.path.join(cwd, ICA_folder, sID + '-carried.json')
+    files = scanFolder(postICA, '-ica.fif').get(sID, []) if os.path.isdir(postICA) else []
+    exclude = dict()
+    carried = []
+    not_carried = []
+    for file in files:
+        labelled_ica = mne.preprocessing.read_ica(os.path.join(cwd, postICA, file))
+        exclude[file], missing = carryExclude(labelled_ica, ica, min_corr=label_min_corr)
+        if missing:
+            print(file + ': excluded components ' + str(missing) + ' have no match in the refit ICA')
+            not_carried.append(file)
+        else:
+            carried.append(file)
+    if exclude:
+        with open(sidecar, 'w') as f:
+            json.dump(dict(exclude=exclude, not_carried=not_carried), f, indent=1)
+    elif os.path.exists(sidecar):
+        os.remove(sidecar)
+    return carried, not_carried
+
+def fitSubject(sID):
+    '''
+    Fit and save the ICA for one subject.
+
+    Parameters
+    ----------
+    sID : STRING
+        The subject ID.
+
+    Returns
+    -------
+    report : DICT
+        Fit time and convergence (see HANG_ICA.fitICA).
+
+    '''
+    path = os.path.join(cwd, ICA_folder, sID + '-epo.fif')
+    ica_fname = os.path.join(cwd, ICA_folder, sID + '-ica.fif')
+    # No longer need to apply baseline as data have a stronger highpass filter
+    # See 1-Epoching for details
+    epochs = readEpochs(path)
+    # Fitting on the float32 data gives a float32 ICA (slightly different
+    # unmixing matrix), so fit on a float64 copy as before
+    writableEpochs(epochs)
+    # epochs.apply_baseline((-0.2,0))
+    
+    # Decimated / subsampled / fewer components if set in fit_options
+    inst, params, fit_kwargs = reducedFit(epochs, ica_params, **fit_options)
+    if warm_start and os.path.exists(ica_fname):
+        # Refit starting from the previous solution, keeping its component
+        # numbers (see HANG_ICA.warmStartICA)
+        old_ica = mne.preprocessing.read_ica(ica_fname)
+        ica, report = warmStartICA(inst, params, old_ica, fit_kwargs)
+    else:
+        ica, report = fitICA(inst, params, fit_kwargs)
+    # The reviewers' labels are in their own files, not in -ica.fif. Matching
+    # does not need a warm start, and a from scratch fit must not leave an
+    # earlier sidecar behind
+    carried, not_carried = carryLabels(sID, ica)
+    report['labels_carried'] = ' '.join(carried)
+    report['labels_not_carried'] = ' '.join(not_carried)
+    if not report['converged']:
+        print(sID + ': ICA did not converge in ' + str(report['max_iter']) + ' iterations')
+    
+    ica.save(ica_fname, overwrite=True)
+    return report
+
+def compareSubject(sID, settings):
+    '''
+    Fit one subject's ICA in full and with each of the reduced settings and
+    compare them (see HANG_ICA.compareICA). Nothing is saved.
+
+    Parameters
+    ----------
+    sID : STRING
+        The subject ID.
+    settings : LIST of DICT
+        Keyword arguments for HANG_ICA.reducedFit() (decim, subsample,
+        n_components), one DICT per setting to try.
+
+    Returns
+    -------
+    A pandas DataFrame with one row per setting (the first row is the full
+    fit).
+
+    '''
+    epochs = writableEpochs(readEpochs(os.path.join(cwd, ICA_folder, sID + '-epo.fif')))
+    reference, report = fitICA(epochs, ica_params)
+    rows = [dict(sID=sID, setting='full', **report)]
+    for setting in settings:
+        inst, params, fit_kwargs = reducedFit(epochs, ica_params, **setting)
+        ica, report = fitICA(inst, params, fit_kwargs)
+        report['speedup'] = round(rows[0]['fit_seconds'] / report['fit_seconds'], 2)
+        report.update(compareICA(reference, ica, epochs, ciac_kwargs=compare_ciac_params if compare_ciac else None))
+        rows.append(dict(sID=sID, setting=str(setting), **report))
+        print(sID + ' ' + str(setting) + ': ' + str(report['fit_seconds']) + ' s, min topography correlation ' +
+              str(report['min_topo_corr']) + ('' if not compare_ciac else ', same CIAC components: ' + str(report['ciac_same'])))
+    return pd.DataFrame(rows)
 
 #######################################
-# If reprocess_data is True, change file saving overwring to be True
-# And skip the check for already created -epo.fif files for each sID
+# Which subjects are (re)processed is decided by the build cache (see
+# HANG_cache): a subject is processed again only if its output is missing, one
+# of its input files changed or the parameters below changed.
+# If reprocess_data is True, every subject is reprocessed regardless.
 reprocess_data = False
+# Outputs made before the build cache existed have no record, so they are
+# rebuilt. Set adopt_existing to True for ONE run after switching to the cache
+# to record them as up to date with the current inputs and settings instead -
+# only if they were made with the settings below. Then set it back to False:
+# while it is True an output without a record is never rebuilt, whatever
+# settings it was made with.
+adopt_existing = False
+
+ica_params = dict(random_state=97, max_iter=800)
+
+# If warm_start is True, subjects that already have an -ica.fif file (and are
+# refit because their epochs changed, e.g. a few more epochs dropped or a
+# channel marked bad) start from that solution instead of from scratch. This
+# needs far fewer iterations, and the components keep their numbers (the fit
+# report lists how well the components matched - min_match_corr - and
+# whether they had to be renumbered because there are fewer of them). Note the
+# result is not exactly what a fit from scratch would give.
+# After every refit (warm start or not), the components excluded in the
+# reviewers' postICA/sID-XX-ica.fif files are matched to the new components
+# (absolute topography correlation of at least label_min_corr) and written to
+# ICA_folder/sID-carried.json, which 4b shows when the subject is reviewed
+# again (see labels_carried / labels_not_carried in the fit report). The
+# reviewers' files themselves are never changed, and CIAC is run again by 4a.
+warm_start = False
+label_min_corr = 0.9
+
+# Cheaper fits: fit on every decim-th sample, on a random fraction
+# (subsample) of all time points, and/or with n_components components. The
+# unmixing is still applied to the full data later. Leave all at None for the
+# normal full fit. Use the comparison below to check a setting first.
+fit_options = dict(decim=None, subsample=None, n_components=None)
+
+# If compare_settings is not empty, nothing is saved: the subjects in
+# compare_sIDs are fit in full and with every setting in compare_settings,
+# and fit time, topography correlation with the full fit and (with
+# compare_ciac, which needs the fsaverage head model on RDSS) the components
+# CIAC excludes are written to ica_fit_comparison.csv in ICA_folder.
+compare_settings = []
+# compare_settings = [dict(decim=2), dict(decim=4), dict(subsample=0.25), dict(n_components=30)]
+compare_sIDs = ['OT0704']
+compare_ciac = False
+SUBJECTS_DIR='\\\\iowa.uiowa.edu\\shared\\ResearchData\\rdss_inychoi\\StructuralMRIdata\\'
+# Same as ciac_params in 4a-CIAC-ICA
+compare_ciac_params = dict(path_bem=SUBJECTS_DIR + 'fsaverage/bem/fsaverage-5120-5120-5120-bem-sol.fif',
+                           path_trans=os.path.join(os.getcwd(), 'Biosemi64median206subjects10percentLarger-trans.fif'),
+                           auditory_offset=2.0)
+
+# If parallel_processing is True, n_workers subjects are fit at the same time,
+# each with blas_threads BLAS/OpenMP threads (keep n_workers * blas_threads at
+# about the number of cores - one FastICA fit does not keep all cores busy,
+# several fits with fewer threads each do). worker_memory_gb as in 1-Epoching.
+# Fit time and convergence of every subject go to ica_fit_report.csv.
+parallel_processing = True
+n_workers = 4
+blas_threads = max(1, (os.cpu_count() or 1) // n_workers)
+worker_memory_gb = 6
 
 cwd = os.getcwd()
 ICA_folder = '2_ICA_set'
+postICA = '3_mne_epochs_after_rejection'
 
-sIDs = [subject[:6] for subject in os.listdir(ICA_folder) if subject.endswith('-epo.fif')]
+# Main loop is kept under __main__ so that worker processes (which re-import
+# this script on Windows) do not start processing subjects themselves
+if __name__ == '__main__':
+    # One listing of ICA_folder for the -epo.fif files (whether the -ica.fif
+    # files are up to date is checked by the build cache below)
+    ica_folder_files = scanFolder(ICA_folder, '-epo.fif')
+    sIDs = [sID for sID in ica_folder_files if 'noEEG' not in sID]
 
-# Check which sIDs already have -epo.fif files in epochsFolder
-if reprocess_data:
-    already_processed = []
-else:
-    already_processed = [file[0:6] for file in os.listdir(ICA_folder) if file.endswith('-ica.fif')]
+    if compare_settings:
+        comparison = pd.concat([compareSubject(sID, compare_settings) for sID in compare_sIDs], ignore_index=True)
+        comparison.to_csv(os.path.join(cwd, ICA_folder, 'ica_fit_comparison.csv'), index=False)
+        sIDs = []
 
-for sID in sIDs:
-    if 'noEEG' in sID:
-        continue
-    elif sID in already_processed:
-        continue
+    # Check which sIDs have an -ica.fif file fit to their current -epo.fif file
+    # (fit_options only count once they are used, so that existing fits are
+    # not redone)
+    cache = BuildCache(os.path.join(cwd, ICA_folder, 'build_cache_ica.json'))
+    if any(value is not None for value in fit_options.values()):
+        cache_params = dict(ica_params, fit_options=fit_options)
     else:
-        fname = sID + '-epo.fif'
-        path = os.path.join(cwd, ICA_folder, fname)
-        # No longer need to apply baseline as data have a stronger highpass filter
-        # See 1-Epoching for details
-        epochs = mne.read_epochs(path, preload=False)
-        # epochs.apply_baseline((-0.2,0))
-        epochs.load_data()
-        
-        ica = mne.preprocessing.ICA(random_state=97, max_iter=800)
-        ica.fit(epochs)
-        
-        ica_fname = os.path.join(cwd, ICA_folder, sID + '-ica.fif')
-        ica.save(ica_fname, overwrite=reprocess_data)
\ No newline at end of file
+        cache_params = ica_params
+    inputs = {sID: os.path.join(cwd, ICA_folder, sID + '-epo.fif') for sID in sIDs}
+    outputs = {sID: os.path.join(cwd, ICA_folder, sID + '-ica.fif') for sID in sIDs}
+    if not reprocess_data:
+        sIDs = [sID for sID in sIDs if not cache.isCurrent(outputs[sID], [inputs[sID]], cache_params, adopt=adopt_existing)]
+    print(str(len(sIDs)) + ' subjects to process')
+
+    if parallel_processing:
+        results, errors = runSubjects(fitSubject, sIDs, n_workers=n_workers,
+                                      memory_gb=worker_memory_gb, blas_threads=blas_threads,
+                                      initializer=mne.set_log_level, initargs=('WARNING',))
+        if errors:
+            print('----------')
+            print('ICA failed for ' + str(len(errors)) + ' subjects: ' + ', '.join(sorted(errors)))
+            with open(os.path.join(cwd, ICA_folder, 'ica_errors.txt'), 'w') as file:
+                for sID in sorted(errors):
+                    file.write('##### ' + sID + '\n' + errors[sID] + '\n')
+    else:
+        results = dict()
+        for sID in sIDs:
+            results[sID] = fitSubject(sID)
+
+    for sID in results:
+        cache.record(outputs[sID], [inputs[sID]], cache_params)
+        results[sID]['fit_options'] = str(fit_options) if cache_params is not ica_params else None
+        results[sID]['blas_threads'] = blas_threads if parallel_processing else None
+        print(sID + ': ' + str(results[sID]['n_iter']) + ' iterations, ' +
+              str(results[sID]['fit_seconds']) + ' s' +
+              ('' if results[sID]['converged'] else ' - DID NOT CONVERGE'))
+    writeFitReport(results, os.path.join(cwd, ICA_folder, 'ica_fit_report.csv'))
@@ -22,18 +22,21 @@ artifact that was missed on first pass (ICA013)
 
 import mne
 import os
-import pickle
-import pandas as pd
+import json
 import matplotlib.pyplot as plt
+from HANG_epochs import readEpochs, writableEpochs
+from HANG_rejection import PeakMatrix
+from HANG_review import Prefetcher, ReviewQueue
 
 # Lazily changed final epochs.info['description'] to be 'Final threshold'
 def epochRejection(epochs, baseline=(-0.2,0)):
     '''
     Function to implement the same histogram procedure as used in the MATLAB
-    processing pipeline. This function first creates a copy of the epochs
-    object and applies a baseline (see baseline parameter for more information)
-    after which a histogram is generated of the maximum voltage (absolute 
-    value) observed in each epoch across all non-excluded channels.
+    processing pipeline. A histogram is generated of the maximum voltage 
+    (absolute value, after applying a baseline - see baseline parameter for
+    more information) observed in each epoch across all non-excluded channels.
+    The baseline is only accounted for in the computed maxima, the epochs data
+    themselves are not changed or copied.
     
     Press "c" to exit debugging and continue to picking a rejection threshold.
     
@@ -92,19 +95,7 @@ def epochRejection(epochs, baseline=(-0.2,0)):
     None.
 
     '''
-    channels = [ch for ch in epochs.info['ch_names'] if ch not in epochs.info['bads']]
-    epochs_copy = epochs.copy()
-    epochs_copy.apply_baseline(baseline)
-    df = epochs_copy.to_data_frame()
-    epochMax = []
-    del epochs_copy
-    for epoch in df['epoch'].unique():
-        voltage = df.loc[df['epoch']==epoch]
-        voltage = voltage[channels].abs()
-        maxValue = voltage[channels].max(axis=1).max(axis=0)
-        result = [epoch, maxValue]
-        epochMax.append(result)
-    epochMax = pd.DataFrame(data=epochMax, columns=['Epoch', 'MaxValue'])
+    epochMax = PeakMatrix(epochs, baseline).epochMax()
     q1 = epochMax['MaxValue'].quantile(.25)
     q3 = epochMax['MaxValue'].quantile(.75)
     iqr = q3-q1
@@ -121,100 +112,161 @@ def epochRejection(epochs, baseline=(-0.2,0)):
     epochs.drop(whichEpochs.index[:].tolist())
     epochs.info['description'] = epochs.info['description'] + 'Final epoch rejection threshold: ' + str(epochThreshold) + '.'
 
+def loadSubject(sID):
+    '''
+    Read and prepare everything the review of one subject needs. Runs in the
+    prefetch thread (see HANG_review) while the previous subject is reviewed.
+
+    Parameters
+    ----------
+    sID : STRING
+        The subject.
+
+    The component sources and their PSDs are not prepared here: they are only
+    used by the component properties window (clicking a topography in
+    plot_components), which computes them itself when it opens and has no
+    public way to take them precomputed.
+
+    Returns
+    -------
+    DICT with 'epochs' (memory-mapped), 'evoked' (their average, for the
+    previews), 'ica' and 'carried' (reviewer file -> components of the
+    current ICA matching the ones excluded there, from sID-carried.json).
+
+    '''
+    fname = sID + '-epo.fif'
+    # Data memory-mapped read-only - the ICA is only applied to a copy once
+    # the reviewer confirms the exclusions
+    epochs = readEpochs(os.path.join(cwd, ICA_folder, fname))
+    if ciac_preprocessed:
+        fname_ica = sID + '-CIAC-ica.fif'
+    else:
+        fname_ica = sID + '-ica.fif'
+    ica = mne.preprocessing.read_ica(os.path.join(cwd, ICA_folder, fname_ica))
+    # Exclusions of earlier reviews matched to the current ICA if it was
+    # refit after them (see 3-RunICA)
+    carried = dict()
+    fname_carried = os.path.join(cwd, ICA_folder, sID + '-carried.json')
+    if os.path.exists(fname_carried):
+        with open(fname_carried, 'r') as file:
+            carried = json.load(file)['exclude']
+    return dict(epochs=epochs, evoked=epochs.average(), ica=ica, carried=carried)
+
 #######################################
 # If reprocess_data is True, change file saving overwring to be True
 # And skip the check for already created -epo.fif files for each sID
 reprocess_data = False
 # Do we want to use CIAC pre-processed ICA files?
 ciac_preprocessed = True
+# How many of the next subjects to load in the background while reviewing
+n_prefetch = 2
 
 cwd = os.getcwd()
 ICA_folder = '2_ICA_set'
 postICA = '3_mne_epochs_after_rejection'
 
-try:
-    with open('lab_members.pickle', 'rb') as file:
-        lab_members = pickle.load(file)
-except:
-    lab_members = dict()
+# Which reviewer has claimed and finished which subject is kept in a shared
+# SQLite database (see HANG_review) instead of lab_members.pickle and listing
+# postICA for every subject
+queue = ReviewQueue(os.path.join(cwd, postICA, 'review_queue.sqlite'), reviews_per_subject=2)
+# Import the reviews in postICA (sID-XX-epo.fif files, XX being the reviewer's
+# initials) on every start - reviews already in the queue are skipped, so
+# this also picks up reviews saved before the queue existed or by a session
+# that stopped before marking them done
+for file in os.listdir(postICA):
+    if file.endswith('-epo.fif') and file[6] == '-':
+        queue.recordDone(file[0:6], file[7:-len('-epo.fif')])
 
 lab_member = input('Please enter your first and last initial with no spaces (e.g. FS for Francis Smith):\n')
-if lab_member not in lab_members:
-    print('Lab member ' + lab_member + ' is not in stored file - adding lab member')
-    lab_members[lab_member] = []
-already_processed = [file[0:6] for file in os.listdir(postICA) if file.endswith('-epo.fif')]
-already_processed = [file for file in already_processed if already_processed.count(file) > 1]
-self_fnames = lab_member + '-epo.fif'
-self_already_processed = [file[0:6] for file in os.listdir(postICA) if file.endswith(self_fnames)]
-lab_members[lab_member] = self_already_processed
 print('----------')
-print('You have processed ' +str(len(lab_members[lab_member])) + ' in previous sessions.')
+print('You have processed ' +str(queue.doneCount(lab_member)) + ' in previous sessions.')
 print('----------')
 
-with open('lab_members.pickle', 'wb') as file:
-    pickle.dump(lab_members, file)
-
-# Get list of all subjects who have had ICA run
-all_sIDs = list(set([subject[:6] for subject in os.listdir(ICA_folder) if subject.endswith('-ica.fif')]))
-
-while True:
-    # Get list of all subjects who have had two people process already
-    already_processed = [file[0:6] for file in os.listdir(postICA) if file.endswith('-epo.fif')]
-    already_processed = [file for file in already_processed if already_processed.count(file) > 1]
+# Add all subjects who have had ICA run to the queue (already queued subjects
+# keep their reviews)
+queue.addSubjects(set([subject[:6] for subject in os.listdir(ICA_folder) if subject.endswith('-ica.fif')]))
 
-    # Also get list of all subjects this lab member has processed
-    self_fnames = lab_member + '-epo.fif'
-    self_already_processed = [file[0:6] for file in os.listdir(postICA) if file.endswith(self_fnames)]
+prefetcher = Prefetcher(loadSubject, n_ahead=n_prefetch)
 
-    # Find subjects who have ICA run but have not been processed twice
-    sIDs = [file for file in all_sIDs if file not in already_processed]
-    sIDs = [file for file in sIDs if file not in self_already_processed]
-    sID = sIDs[0]
-    fname = sID + '-epo.fif'
-    epochs = mne.read_epochs(os.path.join(cwd, ICA_folder, fname))
-    epochs.load_data()
-    if ciac_preprocessed:
-        fname_ica = sID + '-CIAC-ica.fif'
-    else:
-        fname_ica = sID + '-ica.fif'
-    ica = mne.preprocessing.read_ica(os.path.join(cwd, ICA_folder, fname_ica))
-    
-    epochs2 = epochs.copy()
-    print('Current subject: ' + sID)
-    ica.plot_components(inst=epochs2, psd_args=dict(fmin=0, fmax=60))
-    print('------')
-    print('Currently excluded components: ', ica.exclude)
-    print(str(len(ica.exclude)) + ' components currently marked for exclusion.')
-    ica.plot_overlay(inst=epochs2.average())
+# Closed however the loop ends (including Ctrl-C or quitting the debugger),
+# so the prefetch thread and the database connection are not left open
+try:
+    while True:
+        # Next subject that has not been reviewed twice and not by this lab
+        # member (or the one this lab member claimed but did not finish last time)
+        sID = queue.claimNext(lab_member)
+        if sID is None:
+            print('There are no subjects left for you to review.')
+            break
+        # If the review is not finished (an error, or quitting the debugger at
+        # breakpoint()) the subject goes back to the queue
+        try:
+            # Usually already loaded in the background while the previous subject
+            # was reviewed - then start on the next ones
+            subject = prefetcher.get(sID)
+            prefetcher.prefetch(queue.peekNext(lab_member, n_prefetch))
+            epochs = subject['epochs']
+            evoked = subject['evoked']
+            ica = subject['ica']
+            print('Current subject: ' + sID)
+            ica.plot_components(inst=epochs, psd_args=dict(fmin=0, fmax=60))
+            print('------')
+            print('Currently excluded components: ', ica.exclude)
+            print(str(len(ica.exclude)) + ' components currently marked for exclusion.')
+            for review, exclude in subject['carried'].items():
+                print('Earlier review ' + review + ' (before the ICA was refit) excluded what are now components: ', exclude)
+            ica.plot_overlay(inst=evoked)
     
-    breakpoint()
-    # NOTE: YOU CAN CLICK ICA COMPONENT NAMES ON MULTIPLOT WINDOW TO MARK THEM
-    # FOR REMOVAL (light gray font color) or INCLUSION (black font color)
-    ica_ex_string = input("What components do you wanna remove? Use comma for multiple components.\n")
-    if len(ica_ex_string)>0:
-        ica.exclude += [int(i) for i in ica_ex_string.split(',')]
-    ica.apply(epochs2)
+            breakpoint()
+            # NOTE: YOU CAN CLICK ICA COMPONENT NAMES ON MULTIPLOT WINDOW TO MARK THEM
+            # FOR REMOVAL (light gray font color) or INCLUSION (black font color)
+            ica_ex_string = input("What components do you wanna remove? Use comma for multiple components.\n")
+            if len(ica_ex_string)>0:
+                ica.exclude += [int(i) for i in ica_ex_string.split(',')]
 
-    plt.close('all')
+            # Preview the exclusions on the average only (applying the ICA to the
+            # average is the same as averaging the cleaned epochs, and takes
+            # milliseconds) until the reviewer confirms them
+            while True:
+                plt.close('all')
+                print('Currently excluded components: ', ica.exclude)
+                ica.plot_overlay(inst=evoked)
+                plt.pause(1)
+                ica_ex_string = input('Press enter to apply these exclusions, or list ALL components to exclude instead (comma separated).\n')
+                if len(ica_ex_string) == 0:
+                    break
+                ica.exclude = [int(i) for i in ica_ex_string.split(',')]
+            plt.close('all')
 
-    epochRejection(epochs2, baseline=(-0.2,0))
-    
-    ica_fname = os.path.join(cwd, postICA, sID + '-' + lab_member + '-ica.fif')
-    ica.save(ica_fname, overwrite=reprocess_data)
-    fname = os.path.join(cwd, postICA, sID + '-' + lab_member + '-epo.fif')
-    epochs2.save(fname, overwrite=reprocess_data)
+            # Exclusions confirmed - now apply the ICA to a float64 copy of all epochs
+            # (MNE cannot save float32 epochs)
+            epochs2 = writableEpochs(epochs.copy())
+            ica.apply(epochs2)
+
+            epochRejection(epochs2, baseline=(-0.2,0))
     
-    epochs.apply_baseline((-0.2,0))
-    epochs2.apply_baseline((-0.2,0))
+            ica_fname = os.path.join(cwd, postICA, sID + '-' + lab_member + '-ica.fif')
+            ica.save(ica_fname, overwrite=reprocess_data)
+            fname = os.path.join(cwd, postICA, sID + '-' + lab_member + '-epo.fif')
+            epochs2.save(fname, overwrite=reprocess_data)
     
-    fig, axes = plt.subplots(nrows=2, ncols=1, figsize=(8, 6.))
-    fig.tight_layout(pad=5.0)
-    epochs.average().plot(axes=axes[0], spatial_colors=True)
-    epochs2.average().plot(axes=axes[1], spatial_colors=True)
-    fig_fname = os.path.join(cwd, postICA, sID + '-' + lab_member + '_BeforeAfter.pdf')
-    plt.savefig(fig_fname)
-    plt.close()
+            # Averaging and baselining are linear, so the averages can be baselined
+            # instead of baselining copies of all epochs
+            fig, axes = plt.subplots(nrows=2, ncols=1, figsize=(8, 6.))
+            fig.tight_layout(pad=5.0)
+            evoked.copy().apply_baseline((-0.2,0)).plot(axes=axes[0], spatial_colors=True)
+            epochs2.average().apply_baseline((-0.2,0)).plot(axes=axes[1], spatial_colors=True)
+            fig_fname = os.path.join(cwd, postICA, sID + '-' + lab_member + '_BeforeAfter.pdf')
+            plt.savefig(fig_fname)
+            plt.close()
+            queue.complete(sID, lab_member)
+        except BaseException:
+            queue.release(sID, lab_member)
+            raise
     
-    continue_processing = input('Would you like to process the next subject? (y/n):\n')
-    if continue_processing == 'n':
-        break
\ No newline at end of file
+        continue_processing = input('Would you like to process the next subject? (y/n):\n')
+        if continue_processing == 'n':
+            break
+finally:
+    prefetcher.close()
+    queue.close()
\ No newline at end of file
@@ -0,0 +1,593 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 21 09:30:47 2026
+
+The CIAC algorithm (automatic identification of CI artifact ICA components),
+moved here from 4a-CIAC-ICA so other scripts (3-RunICA's fit comparison, the
+ICA benchmark) can run it too. 4a-CIAC-ICA imports it from here.
+
+CIAC() is split in two steps: ciacFeatures() computes the residual variance,
+RMS ratio and topography of every component (the slow part), and
+ciacDecision() applies the thresholds to those arrays. The features can be
+saved per subject (saveFeatures), so sweepCIAC() can try many threshold
+settings on all subjects in seconds without touching the epochs again.
+
+The dipole fit is by far the slowest part of CIAC. If CIAC() is given a
+dipole_fname, the fitted dipoles are saved there and reused the next time
+CIAC() runs with the same ICA topographies, noise covariance and BEM/trans
+files (recorded in build_cache_dipoles.json next to the dipole file, see
+HANG_cache), so re-reviewing a subject or retuning the thresholds does not fit
+the dipoles again.
+
+All subjects are fitted against the same fsaverage BEM and trans files, so the
+BEM solution is read once per process and shared (readBem). With
+dipole_method='fit' (the default) mne.fit_dipole is used as before, fitting the
+components in parallel with n_jobs. That is all the default gets: there is NO
+forward cache for 'fit'. mne.fit_dipole still sets up its 20 mm guess grid
+and computes the forward solution for it for every subject - it has no way to
+pass them in, and it whitens the guess forward with each subject's noise
+covariance.
+
+dipole_method='grid' instead scans a fixed 5 mm grid of dipole positions
+whose forward solution is computed once per BEM/trans/channel set and saved
+in forward_folder (gridForward), so subjects with the same bad channels
+reuse it. The grid scan finds the best position on the grid (mne.fit_dipole
+refines the best guess and can end in a local optimum), so residual variances
+differ between the two methods and so can the excluded components. It is not
+part of the 4a-CIAC-ICA configuration: it has not been validated on our
+subjects, which needs compare_dipole_methods in 4a-CIAC-ICA
+(compareDipoleMethods) to give the same exclusions as 'fit'.
+
+@author: Francis
+"""
+
+import os
+import hashlib
+import itertools
+import mne
+import pandas as pd
+import numpy as np
+from HANG_cache import BuildCache
+
+def dipoleKey(ica, noise_cov):
+    '''
+    Hash of everything the CIAC dipole fit depends on apart from the BEM and
+    trans files: the ICA topographies (from the unmixing), the channel
+    positions and the noise covariance.
+
+    Parameters
+    ----------
+    ica : mne.preprocessing.ICA CLASS
+        The fitted ICA.
+    noise_cov : mne.Covariance CLASS
+        The noise covariance used for the dipole fit.
+
+    Returns
+    -------
+    STRING of the sha1 hex digest.
+
+    '''
+    sha1 = hashlib.sha1()
+    positions = np.array([ch['loc'][:3] for ch in ica.info['chs']])
+    for array in [ica.get_components(), positions, noise_cov.data]:
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        sha1.update(str(array.shape).encode())
+        sha1.update(array.tobytes())
+    sha1.update(' '.join(ica.ch_names + noise_cov.ch_names).encode())
+    return sha1.hexdigest()
+
+# BEM solutions read so far in this process (path -> (size, mtime, model))
+_bem_models = dict()
+
+def readBem(path_bem):
+    '''
+    Read a BEM solution once per process and share it between subjects.
+
+    Parameters
+    ----------
+    path_bem : STRING or mne.bem.ConductorModel CLASS
+        Path of the -bem-sol.fif file (a ConductorModel is returned as is).
+
+    Returns
+    -------
+    mne.bem.ConductorModel CLASS
+
+    '''
+    if not isinstance(path_bem, str):
+        return path_bem
+    stat = os.stat(path_bem)
+    known = _bem_models.get(path_bem)
+    if known is None or known[:2] != (stat.st_size, stat.st_mtime):
+        known = (stat.st_size, stat.st_mtime, mne.read_bem_solution(path_bem))
+        _bem_models[path_bem] = known
+    return known[2]
+
+def _pathInputs(*paths):
+    # Files the build cache can hash (a ConductorModel or trans=None can not)
+    return [path for path in paths if isinstance(path, str)]
+
+def gridForward(info, path_bem, path_trans, forward_folder=None, spacing=5.0,
+                min_dist=5.0, n_jobs=1):
+    '''
+    Forward solution for a volume grid of dipole positions inside the inner
+    skull, saved in forward_folder and reused for every subject with the same
+    channels (names, positions and bads) and BEM/trans files.
+
+    Parameters
+    ----------
+    info : mne.Info CLASS
+        The channel info (e.g. ica.info).
+    path_bem : STRING or mne.bem.ConductorModel CLASS
+        The BEM solution.
+    path_trans : STRING
+        The head <-> MRI transform file.
+    forward_folder : STRING, optional
+        Folder for the cached -fwd.fif files. The default is None (compute
+        it, nothing is saved).
+    spacing : FLOAT, optional
+        Grid spacing in mm. The default is 5.0.
+    min_dist : FLOAT, optional
+        Minimum distance of the grid to the inner skull in mm. The default is
+        5.0 (as mne.fit_dipole).
+    n_jobs : INT, optional
+        Jobs for the forward computation. The default is 1.
+
+    Returns
+    -------
+    mne.Forward CLASS (free orientation, head coordinates)
+
+    '''
+    picks = mne.pick_types(info, eeg=True)
+    sha1 = hashlib.sha1()
+    sha1.update(' '.join(info['ch_names'][pick] for pick in picks).encode())
+    sha1.update(np.ascontiguousarray([info['chs'][pick]['loc'][:3] for pick in picks], dtype=np.float64).tobytes())
+    params = dict(channels=sha1.hexdigest(), spacing=spacing, min_dist=min_dist)
+    if forward_folder is not None:
+        if not os.path.exists(forward_folder):
+            os.mkdir(forward_folder)
+        fname = os.path.join(forward_folder, 'grid-' + params['channels'][:12] + '-fwd.fif')
+        cache = BuildCache(os.path.join(forward_folder, 'build_cache_forward.json'))
+        if cache.isCurrent(fname, _pathInputs(path_bem, path_trans), params):
+            return mne.read_forward_solution(fname)
+    bem = readBem(path_bem)
+    if bem['is_sphere']:
+        src = mne.setup_volume_source_space(pos=spacing, sphere=bem, mindist=min_dist)
+    else:
+        src = mne.setup_volume_source_space(pos=spacing, bem=bem, mindist=min_dist)
+    fwd = mne.make_forward_solution(mne.pick_info(info, picks), path_trans, src, bem,
+                                    meg=False, eeg=True, mindist=0.0, n_jobs=n_jobs)
+    if forward_folder is not None:
+        mne.write_forward_solution(fname, fwd, overwrite=True)
+        cache.record(fname, _pathInputs(path_bem, path_trans), params)
+    return fwd
+
+def gridDipoles(evoked, noise_cov, fwd):
+    '''
+    Best fitting dipole on the forward grid for every time point (component)
+    of evoked, with the goodness of fit computed like mne.fit_dipole
+    (whitened, free orientation).
+
+    Parameters
+    ----------
+    evoked : mne.Evoked CLASS
+        The component topographies (average referenced, the forward solution
+        is average referenced here to match).
+    noise_cov : mne.Covariance CLASS
+        The noise covariance.
+    fwd : mne.Forward CLASS
+        The grid forward solution from gridForward().
+
+    Returns
+    -------
+    mne.Dipole CLASS
+
+    '''
+    picks = mne.pick_types(evoked.info, eeg=True)
+    ch_names = [evoked.ch_names[pick] for pick in picks]
+    whitener = mne.cov.compute_whitener(noise_cov, evoked.info, picks=picks)[0]
+    rows = [fwd['sol']['row_names'].index(name) for name in ch_names]
+    # The data are average referenced, so the gain has to be too - otherwise
+    # its common mode biases the position and the goodness of fit
+    gain = fwd['sol']['data'][rows]
+    gain = whitener @ (gain - gain.mean(axis=0))
+    data = whitener @ evoked.data[picks]
+    # Orthonormal basis of the 3 orientations at every grid position, so the
+    # explained power of a free dipole there is the squared projection
+    n_sources = gain.shape[1] // 3
+    gain = gain.reshape(len(picks), n_sources, 3).transpose(1, 0, 2)
+    # The sphere model forward is not defined at the sphere's centre
+    valid = np.flatnonzero(np.isfinite(gain).all(axis=(1, 2)))
+    gain = gain[valid]
+    basis = np.linalg.qr(gain)[0]
+    explained = np.sum(np.einsum('sck,ct->skt', basis, data)**2, axis=1)
+    best = np.argmax(explained, axis=0)
+    total = np.sum(data**2, axis=0)
+    # Dipole moments at the best positions (least squares)
+    moments = np.array([np.linalg.lstsq(gain[source], data[:, time], rcond=None)[0]
+                        for time, source in enumerate(best)])
+    amplitude = np.sqrt(np.sum(moments**2, axis=1))
+    ori = moments / np.where(amplitude > 0, amplitude, 1.0)[:, np.newaxis]
+    gof = 100 * explained[best, np.arange(len(best))] / total
+    return mne.Dipole(evoked.times.copy(), fwd['source_rr'][valid[best]], amplitude, ori, gof,
+                      name='CIAC grid')
+
+def ciacFeatures(epochs, ica, path_bem, path_trans, auditory_onset = 0.0,
+                 auditory_offset = None, aep_window = (0.080, 0.250), dipole_fname = None,
+                 dipole_method = 'fit', n_jobs = 1, forward_folder = None, noise_cov = None):
+    '''
+    Compute the per-component numbers CIAC decides on (see CIAC() for the
+    parameters).
+
+    Returns
+    -------
+    features : DICT of ARRAY
+        'residual' (residual variance of the dipole fit in %), 'ratio' (RMS of
+        the first derivative in the CI artifact window(s) over that in the AEP
+        window), 'ci_rms', 'n1_rms' (one value per component) and
+        'topographies' (channels x components).
+    dipole : mne.Dipole CLASS
+        The dipoles fitted to the ICA components.
+
+    '''
+    # Get ICA sources for estimating CI artifact and N1 derivatives. Unmixing
+    # is linear, so the average of the ICA sources (the data for the AU
+    # timecourse plots for each component) is the same as the sources of the
+    # average of the epochs - and only the one average has to be unmixed
+    evoked = epochs.average(picks=ica.ch_names)
+    source_avg = ica.get_sources(inst=evoked)
+    data = source_avg.data
+    times = source_avg.times
+    # CI artifact window(s) and AEP window. The onset and offset windows are
+    # joined before taking the derivative, like in the original implementation
+    data_ci = data[:, (times >= auditory_onset) & (times <= auditory_onset+0.050)]
+    if auditory_offset:
+        data_ci_off = data[:, (times >= auditory_offset) & (times <= auditory_offset +0.050)]
+        data_ci = np.concatenate([data_ci, data_ci_off], axis=1)
+    data_n1 = data[:, (times >= aep_window[0]) & (times <= aep_window[1])]
+    # Compute RMS ratio for first derivative of components during CI artifact 
+    # window and AEP window (all components at once)
+    ci_rms = np.sqrt(np.mean(np.gradient(data_ci, axis=1)**2, axis=1))
+    n1_rms = np.sqrt(np.mean(np.gradient(data_n1, axis=1)**2, axis=1))
+    # Fit dipoles to each component (this step takes a while)
+    topographies = ica.get_components()
+    if noise_cov is None:
+        noise_cov = mne.compute_covariance(epochs, tmin=-0.4, tmax=-0.2)
+    components = mne.EvokedArray(topographies, ica.info, tmin=0.0, nave=len(epochs))
+    components.set_eeg_reference()
+    dipole = None
+    if dipole_fname is not None:
+        cache = BuildCache(os.path.join(os.path.dirname(os.path.abspath(dipole_fname)), 'build_cache_dipoles.json'))
+        dipole_params = dict(topographies=dipoleKey(ica, noise_cov))
+        if dipole_method != 'fit':
+            dipole_params['method'] = dipole_method
+        if cache.isCurrent(dipole_fname, _pathInputs(path_bem, path_trans), dipole_params):
+            dipole = mne.read_dipole(dipole_fname)
+    if dipole is None:
+        if dipole_method == 'grid':
+            fwd = gridForward(ica.info, path_bem, path_trans, forward_folder=forward_folder, n_jobs=n_jobs)
+            dipole = gridDipoles(components, noise_cov, fwd)
+        else:
+            dipole, res = mne.fit_dipole(components, noise_cov, readBem(path_bem), trans=path_trans,
+                                         n_jobs=n_jobs)
+        if dipole_fname is not None:
+            dipole.save(dipole_fname, overwrite=True)
+            cache.record(dipole_fname, _pathInputs(path_bem, path_trans), dipole_params)
+    features = dict(residual=100-dipole.gof, ratio=ci_rms / n1_rms, ci_rms=ci_rms,
+                    n1_rms=n1_rms, topographies=topographies)
+    return features, dipole
+
+def saveFeatures(features, fname):
+    '''
+    Save the features from ciacFeatures() as a small .npz file.
+
+    Parameters
+    ----------
+    features : DICT of ARRAY
+        The features.
+    fname : STRING
+        Path of the .npz file (sID-CIAC-features.npz).
+
+    Returns
+    -------
+    None.
+
+    '''
+    # np.savez adds .npz to names without it, so keep the ending on the
+    # temporary file
+    tmp_fname = fname[:-len('.npz')] + '.tmp.npz'
+    np.savez(tmp_fname, **features)
+    os.replace(tmp_fname, fname)
+
+def readFeatures(fname):
+    '''
+    Read features saved by saveFeatures().
+
+    Parameters
+    ----------
+    fname : STRING
+        Path of the .npz file.
+
+    Returns
+    -------
+    DICT of ARRAY
+
+    '''
+    with np.load(fname) as saved:
+        return {key: saved[key] for key in saved.files}
+
+def templateCorrelation(topographies, template):
+    '''
+    Absolute correlation (over channels) of every component's topography
+    with the template component's topography - only the one column of the
+    full correlation matrix that CIAC needs.
+
+    Parameters
+    ----------
+    topographies : ARRAY
+        Channels x components.
+    template : INT
+        The template component.
+
+    Returns
+    -------
+    ARRAY of FLOAT, one per component.
+
+    '''
+    centered = topographies - topographies.mean(axis=0)
+    norms = np.sqrt(np.sum(centered**2, axis=0))
+    return np.abs(centered.T @ centered[:, template]) / (norms * norms[template])
+
+def ciacDecision(residual, ratio, topographies, rv_thresh = 20.0, ratio_thresh = 1.5,
+                 corr_thresh = 0.9, joint_ratio_thresh = 1.2, joint_corr_thresh = 0.4,
+                 ratio_extreme = 5.0):
+    '''
+    Apply the CIAC criteria (see CIAC() for the steps and thresholds) to the
+    features of all components at once.
+
+    Parameters
+    ----------
+    residual : ARRAY
+        Residual variance (%) of each component's dipole fit.
+    ratio : ARRAY
+        RMS ratio of each component.
+    topographies : ARRAY
+        Channels x components.
+
+    Returns
+    -------
+    LIST of INT of the components to exclude, in the order CIAC finds them:
+    the template, then components passing rv_thresh and ratio_thresh or
+    corr_thresh, then the joint thresholds, then ratio_extreme.
+
+    '''
+    # First pass - choose all components with residual variance > threshold
+    options = residual > rv_thresh
+    if not options.any():
+        raise ValueError('No component has a residual variance above rv_thresh = ' + str(rv_thresh))
+    # Template is the option with the highest ratio
+    template = np.flatnonzero(options)[np.argmax(ratio[options])]
+    corr = templateCorrelation(topographies, template)
+    excluded = np.zeros(len(ratio), dtype=bool)
+    excluded[template] = True
+    # Other options with a high ratio OR a topography like the template
+    stage = options & ~excluded & ((ratio > ratio_thresh) | (corr > corr_thresh))
+    to_exclude = [template] + list(np.flatnonzero(stage))
+    excluded |= stage
+    # Any component with both a fairly high ratio AND a similar topography
+    stage = ~excluded & (ratio > joint_ratio_thresh) & (corr > joint_corr_thresh)
+    to_exclude += list(np.flatnonzero(stage))
+    excluded |= stage
+    # Any component with an extreme ratio
+    to_exclude += list(np.flatnonzero(~excluded & (ratio > ratio_extreme)))
+    return [int(component) for component in to_exclude]
+
+def compareDipoleMethods(features_fit, features_grid, rv_thresh = 20.0, **thresholds):
+    '''
+    Compare the CIAC decision for the features of one subject computed with
+    dipole_method='fit' and with dipole_method='grid'.
+
+    Parameters
+    ----------
+    features_fit : DICT of ARRAY
+        ciacFeatures() with dipole_method='fit'.
+    features_grid : DICT of ARRAY
+        ciacFeatures() with dipole_method='grid' (same epochs and ICA).
+    rv_thresh : FLOAT, optional
+        As for CIAC(). The default is 20.0.
+    **thresholds
+        The other thresholds of ciacDecision().
+
+    Returns
+    -------
+    DICT with 'exclude_fit' and 'exclude_grid' (sorted), 'same_exclude',
+    'max_rv_diff' (largest difference in residual variance, %) and
+    'n_rv_crossing' (components on different sides of rv_thresh).
+
+    '''
+    excluded = dict()
+    for method, features in [('fit', features_fit), ('grid', features_grid)]:
+        excluded[method] = sorted(ciacDecision(features['residual'], features['ratio'], features['topographies'],
+                                               rv_thresh=rv_thresh, **thresholds))
+    residual_fit = features_fit['residual']
+    residual_grid = features_grid['residual']
+    return {'exclude_fit': excluded['fit'],
+            'exclude_grid': excluded['grid'],
+            'same_exclude': excluded['fit'] == excluded['grid'],
+            'max_rv_diff': round(float(np.max(np.abs(residual_fit - residual_grid))), 2),
+            'n_rv_crossing': int(np.sum((residual_fit > rv_thresh) != (residual_grid > rv_thresh)))}
+
+def sweepCIAC(features, grid):
+    '''
+    Evaluate every combination of CIAC thresholds on saved features.
+
+    Parameters
+    ----------
+    features : DICT
+        sID -> features DICT (from ciacFeatures() or readFeatures()).
+    grid : DICT
+        Threshold name (as in ciacDecision) -> LIST of values to try.
+        Thresholds not in grid keep their defaults.
+
+    Returns
+    -------
+    pandas.DataFrame CLASS with one row per setting and subject: the
+    thresholds, 'sID', 'n_excluded' and 'excluded' (n_excluded is None if no
+    component passes rv_thresh).
+
+    '''
+    names = list(grid)
+    rows = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        setting = dict(zip(names, values))
+        for sID, subject in features.items():
+            try:
+                excluded = ciacDecision(subject['residual'], subject['ratio'], subject['topographies'], **setting)
+            except ValueError:
+                excluded = None
+            rows.append(dict(setting, sID=sID, n_excluded=None if excluded is None else len(excluded),
+                             excluded=excluded))
+    return pd.DataFrame(rows)
+
+def CIAC(epochs, ica, path_bem, path_trans, auditory_onset = 0.0, auditory_offset = None,
+         aep_window = (0.080, 0.250), rv_thresh = 20.0, ratio_thresh = 1.5, 
+         corr_thresh = 0.9, joint_ratio_thresh = 1.2, joint_corr_thresh = 0.4,
+         ratio_extreme = 5.0, dipole_fname = None, features_fname = None,
+         dipole_method = 'fit', n_jobs = 1, forward_folder = None, noise_cov = None):
+    '''
+    A Python implementation of the CIAC algorithm as described in 
+    https://doi.org/10.1016/j.heares.2011.12.010
+    
+    After some initial testing with lab-internal data I have decided to add a 
+    final couple of steps to identify additional CI component candidates.
+    
+    As in CIAC, the first step is to identify CI artifact components based on
+    the residual variance of dipoles fitted for each ICA component.
+    
+    A CI artifact topography template is computed based on the component (among
+    those selected in the previous step) with the highest ratio of the 
+    component's root-mean-square first derivative during the 50ms following the
+    onset and offset of auditory stimuli compared to that component's 
+    root-mean-square first derivative during the AEP window. This component is
+    also marked as a CI artifact.
+    
+    All components above the residual variance threshold are evaluated. If they
+    EITHER have a RMS ratio greater than ratio_thresh OR have a correlation
+    to the template topography greater than corr_thresh they are marked as a CI
+    artifact.
+    
+    My additional steps (based on internal testing) is to then do a final pass
+    of all components not already marked as CI artifacts. If these components
+    have BOTH a ratio greater than joint_ratio_thresh AND a correlation to the
+    template topography greatern joint_corr_thresh they are marked as a CI 
+    artifact.
+    
+    In addition, if any component (regardless of residual variance) has a ratio
+    greater than ratio_extreme it is also marked as a CI artifact.
+    
+    These final two steps probably need more extensive testing. Also note that
+    in the current HANG pipeline, the ICAs being used will still need to be
+    manually reviewed for eyeblinks, eye movements, etc.
+    
+    NOTE: Give a dipole_fname to save the dipole fit and reuse it the next time
+    (see top of file). The .dip file keeps the goodness of fit to 0.01%, so a
+    reused fit can only differ from a new one for residual variances within
+    0.005% of rv_thresh.
+
+    Parameters
+    ----------
+    epochs : Instance of mne.Epochs class object
+        The epochs object for which CI artifacts should be removed/corrected.
+    ica : Instance of mne.preprocessing.ICA class object
+        The ICA which has been fit in a previous processing step to the epoched
+        data - in order to identify components which reflect the CI artifact.
+    path_bem : STRING
+        Path to the BEM files needed for dipole fitting (a ConductorModel,
+        e.g. a sphere model, also works).
+    path_trans : STRING
+        Path to the head <-> MRI transform file.
+    auditory_onset : FLOAT, optional
+        The time (relative to the epoched stimuli) of the auditory stimulus 
+        onset. The default is 0.0.
+    auditory_offset : FLOAT, optional
+        If the auditory stimuli in the current experiment are of uniform 
+        duration, this should reflect the time (relative to the epoched
+        stimuli) of the auditory stimulus offset. If your stimuli are of 
+        non-uniform length, use the default value of None. The default is None.
+    aep_window : TUPLE of FLOAT, optional
+        The time window during which the Auditory Evoked Potential (N1/P2) is
+        expected to occur. The default is (0.080, 0.250).
+    rv_thresh : FLOAT, optional
+        The threshold for residual variance of ICA component dipole fits to 
+        consder for CI artifacts. Dipoles with low residual variance are more
+        likely to represent neural components Anything over this threshold is
+        included in the initial pass considering potential CI artifacts. This 
+        value should not be changed within a given study-set of participants.
+        The default is 20.
+    ratio_thresh : FLOAT, optional
+        The threshold for considering an ICA component as a potential CI 
+        artifact. This is the ratio of the RMS of the first derivative of a 
+        given ICA component during the 50ms after auditory onset + offset 
+        compared to the first derivative of that component during the AEP 
+        window. The default is 1.5.
+    corr_thresh : FLOAT, optional
+        The threshold for considering an ICA component as a potential CI 
+        artifact. This is the correlation between the topography of a given
+        ICA component and the "template topography for a given participant. The
+        default is 0.9.
+    joint_ratio_thresh : FLOAT, optional
+        A lower threshold for considering ICA components in combination with
+        joint_corr_thresh. This is intended to catch components which are 
+        likely CI artifacts but are not caught individually by either ratio or 
+        correlation. The default is 1.2.
+    joint_corr_thresh : FLOAT, optional
+        A lower threshold for considering ICA components in combination with
+        joint_ratio_thresh. This is intended to catch components which are 
+        likely CI artifacts but are not caught individually by either ratio or
+        correlation. The default is 0.4.
+    ratio_extreme : FLOAT, optional
+        A higher ratio threshold for considering ICA components which, based on
+        residual variance, was not considered on the first pass but still 
+        reflects much more activity during the CI artifact window than during
+        the AEP window. The default is 5.0.
+    dipole_fname : STRING, optional
+        Path of the -CIAC.dip file to save the dipole fit to and reuse it from
+        if it was made from the same ICA, noise covariance and BEM/trans files.
+        The default is None (always fit the dipoles, nothing is saved).
+    features_fname : STRING, optional
+        Path of a -CIAC-features.npz file to save the component features to
+        (see ciacFeatures), for sweepCIAC(). The default is None.
+    dipole_method : STRING, optional
+        'fit' for mne.fit_dipole or 'grid' for the best dipole on a fixed grid
+        (see top of file). The default is 'fit'.
+    n_jobs : INT, optional
+        Number of components fitted in parallel (and jobs for the grid forward
+        solution). The default is 1.
+    forward_folder : STRING, optional
+        Folder to keep the grid forward solutions in (dipole_method='grid').
+        The default is None (computed for every call).
+    noise_cov : mne.Covariance CLASS, optional
+        The noise covariance for the dipole fits, e.g. from
+        HANG_epochs.noiseCovariance(). The default is None (computed from the
+        epochs from -0.4 to -0.2 s).
+
+    Returns
+    -------
+    dipole : mne.Dipole CLASS
+        The dipoles fitted to the ICA components (reloaded from dipole_fname
+        if that was up to date).
+    
+    This modifies the ICA in place. You will still need to save the modified
+    ICA object.
+
+    '''
+    features, dipole = ciacFeatures(epochs, ica, path_bem, path_trans, auditory_onset=auditory_onset,
+                                    auditory_offset=auditory_offset, aep_window=aep_window,
+                                    dipole_fname=dipole_fname, dipole_method=dipole_method,
+                                    n_jobs=n_jobs, forward_folder=forward_folder, noise_cov=noise_cov)
+    if features_fname is not None:
+        saveFeatures(features, features_fname)
+    ica.exclude = ciacDecision(features['residual'], features['ratio'], features['topographies'],
+                               rv_thresh=rv_thresh, ratio_thresh=ratio_thresh, corr_thresh=corr_thresh,
+                               joint_ratio_thresh=joint_ratio_thresh, joint_corr_thresh=joint_corr_thresh,
+                               ratio_extreme=ratio_extreme)
+    return dipole
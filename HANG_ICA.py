@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 10:12:55 2026
+
+ICA fitting helpers for 3-RunICA (and the ICA benchmark).
+
+fitICA() fits one subject's ICA and reports how long the fit took and
+whether it converged (FastICA, Picard and Infomax all stop at max_iter and
+only give a warning if they did not converge). writeFitReport() keeps these
+numbers for every subject in one table (ica_fit_report.csv in 2_ICA_set) so
+slow or non-converging subjects are easy to find.
+
+warmStartICA() refits a subject starting from its earlier -ica.fif solution
+and keeps the component numbers (and ica.exclude) of the earlier fit.
+carryExclude() moves the components excluded in another file of the earlier
+fit (the -CIAC-ica.fif file and the reviewers' -ica.fif files, which are the
+ones with labels - the -ica.fif file itself has none) onto the refit's
+components.
+
+reducedFit() returns what to fit on for a cheaper fit: every decim-th sample,
+a random subsample of all time points, and/or fewer PCA components. The
+unmixing found is applied to the full data as usual (get_sources, apply).
+compareICA() checks such a fit against a full fit: topography correlation of
+matched components and whether CIAC excludes the same components.
+
+@author: Francis
+"""
+
+import os
+import time
+import datetime
+import warnings
+import numpy as np
+import pandas as pd
+import mne
+from scipy.optimize import linear_sum_assignment
+from HANG_CIAC import CIAC
+
+def fitICA(epochs, ica_params, fit_kwargs=None):
+    '''
+    Fit an ICA and time it.
+
+    Parameters
+    ----------
+    epochs : mne.epochs.EpochsFIF CLASS
+        The (preloaded) epochs to fit on.
+    ica_params : DICT
+        Keyword arguments for mne.preprocessing.ICA (e.g. random_state and
+        max_iter).
+    fit_kwargs : DICT, optional
+        Keyword arguments for ICA.fit(). The default is None.
+
+    Returns
+    -------
+    ica : mne.preprocessing.ICA CLASS
+        The fitted ICA.
+    report : DICT
+        'method', 'n_components', 'n_samples', 'n_iter', 'max_iter',
+        'converged' (n_iter < max_iter) and 'fit_seconds' (wall time).
+
+    '''
+    if fit_kwargs is None:
+        fit_kwargs = dict()
+    ica = mne.preprocessing.ICA(**ica_params)
+    start = time.perf_counter()
+    ica.fit(epochs, **fit_kwargs)
+    fit_seconds = time.perf_counter() - start
+    max_iter = ica.fit_params.get('max_iter', ica.max_iter)
+    report = {'method': ica.method,
+              'n_components': ica.n_components_,
+              'n_samples': ica.n_samples_,
+              'n_iter': ica.n_iter_,
+              'max_iter': max_iter,
+              'converged': bool(ica.n_iter_ < max_iter),
+              'fit_seconds': round(fit_seconds, 2)}
+    return ica, report
+
+def writeFitReport(reports, fname):
+    '''
+    Add (or replace) subjects in the ICA fit report and save it as .csv.
+
+    Parameters
+    ----------
+    reports : DICT
+        sID -> report DICT from fitICA() (plus any extra columns).
+    fname : STRING
+        Path of the .csv file.
+
+    Returns
+    -------
+    The full report as a pandas DataFrame.
+
+    '''
+    if not reports:
+        return None
+    new = pd.DataFrame.from_dict(reports, orient='index')
+    new.index.name = 'sID'
+    new = new.reset_index()
+    new['date'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
+    if os.path.exists(fname):
+        old = pd.read_csv(fname)
+        old = old[~old['sID'].isin(new['sID'])]
+        new = pd.concat([old, new], ignore_index=True)
+    new = new.sort_values('sID').reset_index(drop=True)
+    new.to_csv(fname, index=False)
+    return new
+
+def _projectUnmixing(old_ica, probe, random_state=None):
+    # Sensor-space unmixing of the old ICA (acting on the pre-whitened data)
+    n_old = old_ica.n_components_
+    unmixing = old_ica.unmixing_matrix_ @ old_ica.pca_components_[:n_old]
+    # Moved onto the current channels (channels that are new or were not in
+    # the old fit get zero weight), rescaled for the new pre-whitener
+    n_new = probe.n_components_
+    sensor = np.zeros((n_old, len(probe.ch_names)))
+    for jj, ch in enumerate(probe.ch_names):
+        if ch in old_ica.ch_names:
+            ii = old_ica.ch_names.index(ch)
+            sensor[:, jj] = unmixing[:, ii] * probe.pre_whitener_[jj, 0] / old_ica.pre_whitener_[ii, 0]
+    # ... and into the whitened PCA space the new fit works in
+    w_init = (sensor @ probe.pca_components_[:n_new].T) * np.sqrt(probe.pca_explained_variance_[:n_new])
+    if n_old > n_new:
+        # Fewer components now (e.g. a channel went bad) - keep the old
+        # components that are best represented in the new space
+        keep = np.sort(np.argsort(np.linalg.norm(w_init, axis=1))[::-1][:n_new])
+        w_init = w_init[keep]
+    elif n_old < n_new:
+        rng = np.random.RandomState(random_state)
+        w_init = np.vstack([w_init, rng.standard_normal((n_new - n_old, n_new))])
+    # Symmetric decorrelation (W W^T)^-1/2 W - FastICA does this itself, but
+    # Picard (orthogonal version, the default) needs an orthogonal start
+    eigvals, eigvecs = np.linalg.eigh(w_init @ w_init.T)
+    if eigvals.min() <= 1e-12 * eigvals.max():
+        # Rank deficient - the old ICA does not fit the current channels
+        return None
+    return (eigvecs / np.sqrt(eigvals)) @ eigvecs.T @ w_init
+
+def matchComponents(reference, ica):
+    '''
+    Match the components of ica to those of a reference ICA by their
+    topographies (absolute correlation over the channels both have, best
+    one-to-one matching with the Hungarian algorithm).
+
+    Parameters
+    ----------
+    reference : mne.preprocessing.ICA CLASS
+        The ICA to match to (e.g. the subject's previous -ica.fif).
+    ica : mne.preprocessing.ICA CLASS
+        The ICA whose components are matched.
+
+    Returns
+    -------
+    matches : DICT
+        reference component -> (ica component, correlation). The
+        correlation is signed (negative if the topography is flipped).
+
+    '''
+    common = [ch for ch in reference.ch_names if ch in ica.ch_names]
+    ref_topo = reference.get_components()[[reference.ch_names.index(ch) for ch in common]]
+    topo = ica.get_components()[[ica.ch_names.index(ch) for ch in common]]
+    corr = np.corrcoef(ref_topo.T, topo.T)[:ref_topo.shape[1], ref_topo.shape[1]:]
+    rows, cols = linear_sum_assignment(-np.abs(corr))
+    return {int(row): (int(col), float(corr[row, col])) for row, col in zip(rows, cols)}
+
+def carryExclude(labelled_ica, ica, min_corr=0.9):
+    '''
+    Map the excluded components of an earlier ICA of a subject (e.g. its
+    -CIAC-ica.fif or a reviewer's -ica.fif) onto the components of a new fit,
+    by their best one-to-one topography match (see matchComponents).
+
+    Parameters
+    ----------
+    labelled_ica : mne.preprocessing.ICA CLASS
+        The earlier ICA with the excluded components.
+    ica : mne.preprocessing.ICA CLASS
+        The new ICA.
+    min_corr : FLOAT, optional
+        Lowest absolute topography correlation for an excluded component to
+        be carried over. The default is 0.9.
+
+    Returns
+    -------
+    exclude : LIST of INT
+        The components of ica matching the excluded components of
+        labelled_ica (in the same order).
+    not_carried : LIST of INT
+        Excluded components of labelled_ica without a match of at least
+        min_corr.
+
+    '''
+    matches = matchComponents(labelled_ica, ica)
+    exclude = []
+    not_carried = []
+    for comp in labelled_ica.exclude:
+        if comp in matches and abs(matches[comp][1]) >= min_corr:
+            exclude.append(matches[comp][0])
+        else:
+            not_carried.append(comp)
+    return exclude, not_carried
+
+def warmStartICA(epochs, ica_params, old_ica, fit_kwargs=None):
+    '''
+    Refit an ICA starting from an earlier solution (e.g. after a few more
+    epochs were dropped or a channel was marked bad).
+
+    A first fit with max_iter=1 gives the pre-whitening and PCA of the current
+    data. The old unmixing matrix is moved onto the current channels and into
+    that PCA space and used as the starting point (w_init) of the real fit,
+    which then needs far fewer iterations. Afterwards the components are put
+    in the order (and sign) of their best match in the old ICA, so component
+    numbers - and the old ica.exclude - stay the same. If the new ICA has
+    fewer components (e.g. a channel went bad) that is not possible: the
+    matched components are then numbered in the order of the old ones, the
+    excluded components follow them and report['renumbered'] is True.
+
+    Only FastICA and Picard take a starting point. For Infomax a normal fit is
+    done.
+
+    Parameters
+    ----------
+    epochs : mne.epochs.EpochsFIF CLASS
+        The (preloaded) epochs to fit on.
+    ica_params : DICT
+        Keyword arguments for mne.preprocessing.ICA.
+    old_ica : mne.preprocessing.ICA CLASS
+        The earlier ICA of the same subject.
+    fit_kwargs : DICT, optional
+        Keyword arguments for ICA.fit(). The default is None.
+
+    Returns
+    -------
+    ica : mne.preprocessing.ICA CLASS
+        The fitted ICA, with exclude copied from old_ica for the matched
+        components.
+    report : DICT
+        As for fitICA(), plus 'warm_start' (BOOL), 'probe_seconds' (included
+        in fit_seconds), 'min_match_corr' (worst absolute topography
+        correlation between matched components) and 'renumbered' (BOOL, see
+        above).
+
+    '''
+    if fit_kwargs is None:
+        fit_kwargs = dict()
+    method = ica_params.get('method', 'fastica')
+    if method not in ('fastica', 'picard'):
+        print('No warm start for ' + method + ' - fitting from scratch')
+        ica, report = fitICA(epochs, ica_params, fit_kwargs)
+        report['warm_start'] = False
+        return ica, report
+
+    start = time.perf_counter()
+    probe = mne.preprocessing.ICA(**dict(ica_params, max_iter=1))
+    with warnings.catch_warnings():
+        # One iteration never converges
+        warnings.simplefilter('ignore')
+        probe.fit(epochs, **fit_kwargs)
+    w_init = _projectUnmixing(old_ica, probe, ica_params.get('random_state'))
+    probe_seconds = time.perf_counter() - start
+    if w_init is None:
+        print('Old ICA does not fit the current channels - fitting from scratch')
+        ica, report = fitICA(epochs, ica_params, fit_kwargs)
+        report['warm_start'] = False
+        return ica, report
+
+    fit_params = dict(ica_params.get('fit_params') or dict(), w_init=w_init)
+    ica, report = fitICA(epochs, dict(ica_params, fit_params=fit_params), fit_kwargs)
+    # The starting point is not needed (or savable) in the -ica.fif file
+    del ica.fit_params['w_init']
+
+    # Same order and sign as the old components. With fewer components than
+    # before, the matched old components are numbered in their order, so
+    # components after an unmatched one get lower numbers
+    matches = matchComponents(old_ica, ica)
+    matched = sorted(matches)
+    order = [matches[old][0] for old in matched]
+    order += [comp for comp in range(ica.n_components_) if comp not in order]
+    signs = np.ones(ica.n_components_)
+    signs[:len(matched)] = np.where(np.array([matches[old][1] for old in matched]) < 0, -1.0, 1.0)
+    ica.unmixing_matrix_ = ica.unmixing_matrix_[order] * signs[:, np.newaxis]
+    ica._update_mixing_matrix()
+    number = {old: new for new, old in enumerate(matched)}
+    ica.exclude = [number[old] for old in old_ica.exclude if old in number]
+    renumbered = any(old != new for old, new in number.items())
+    if renumbered:
+        print('Fewer components than the old ICA - matched components renumbered, ' +
+              'excluded components ' + str(old_ica.exclude) + ' are now ' + str(ica.exclude))
+
+    report['warm_start'] = True
+    report['probe_seconds'] = round(probe_seconds, 2)
+    report['fit_seconds'] = round(report['fit_seconds'] + probe_seconds, 2)
+    report['min_match_corr'] = round(min(abs(corr) for _, corr in matches.values()), 3)
+    report['renumbered'] = renumbered
+    return ica, report
+
+def reducedFit(epochs, ica_params, decim=None, subsample=None, n_components=None):
+    '''
+    Set up a cheaper ICA fit. ICA does not use the order of the samples, so
+    fitting on fewer time points (or fewer PCA components) mostly costs
+    accuracy in the unmixing, which compareICA() measures.
+
+    Parameters
+    ----------
+    epochs : mne.epochs.EpochsFIF CLASS
+        The (preloaded) epochs.
+    ica_params : DICT
+        Keyword arguments for mne.preprocessing.ICA.
+    decim : INT, optional
+        Fit on every decim-th sample of each epoch (ICA.fit's decim). With
+        the 45 Hz lowpass and 512 Hz sampling, decim=2 or 4 still keeps the
+        whole band. The default is None.
+    subsample : FLOAT, optional
+        Fit on this fraction (0-1) of all time points of all epochs, picked at
+        random (with ica_params' random_state). The default is None.
+    n_components : INT or FLOAT, optional
+        Number of ICA components (or fraction of variance) instead of the one
+        in ica_params. The default is None.
+
+    Returns
+    -------
+    inst : mne.epochs.EpochsFIF CLASS
+        What to fit on (epochs, or one long epoch of the subsampled time
+        points).
+    params : DICT
+        ica_params with n_components changed.
+    fit_kwargs : DICT
+        Keyword arguments for ICA.fit().
+
+    '''
+    params = dict(ica_params)
+    if n_components is not None:
+        params['n_components'] = n_components
+    fit_kwargs = dict()
+    if decim:
+        fit_kwargs['decim'] = decim
+    inst = epochs
+    if subsample:
+        rng = np.random.RandomState(ica_params.get('random_state'))
+        data = epochs.get_data()
+        n_epochs, _, n_times = data.shape
+        keep = np.sort(rng.choice(n_epochs * n_times, int(round(subsample * n_epochs * n_times)), replace=False))
+        epoch_idx, time_idx = np.divmod(keep, n_times)
+        inst = mne.EpochsArray(data[epoch_idx, :, time_idx].T[np.newaxis], epochs.info, verbose=False)
+    return inst, params, fit_kwargs
+
+def compareICA(reference, ica, epochs=None, ciac_kwargs=None):
+    '''
+    Compare an ICA (e.g. a reduced fit) with a reference ICA (the full fit).
+
+    Parameters
+    ----------
+    reference : mne.preprocessing.ICA CLASS
+        The reference ICA.
+    ica : mne.preprocessing.ICA CLASS
+        The ICA to check.
+    epochs : mne.epochs.EpochsFIF CLASS, optional
+        The epochs, needed for the CIAC comparison. The default is None.
+    ciac_kwargs : DICT, optional
+        Arguments for CIAC() (path_bem, path_trans and the CIAC settings). If
+        given, CIAC is run on copies of both ICAs. The default is None.
+
+    Returns
+    -------
+    DICT with 'min_topo_corr', 'median_topo_corr', 'n_topo_below_0.9'
+    (absolute topography correlations of the matched components) and, with
+    ciac_kwargs, 'ciac_reference' and 'ciac_ica' (excluded components, the
+    latter numbered as their matches in the reference) and 'ciac_same'.
+
+    '''
+    matches = matchComponents(reference, ica)
+    corrs = np.abs([corr for _, corr in matches.values()])
+    result = {'n_components_reference': reference.n_components_,
+              'n_components': ica.n_components_,
+              'min_topo_corr': round(float(corrs.min()), 3),
+              'median_topo_corr': round(float(np.median(corrs)), 3),
+              'n_topo_below_0.9': int((corrs < 0.9).sum())}
+    if ciac_kwargs is not None:
+        reference = reference.copy()
+        ica = ica.copy()
+        CIAC(epochs, reference, **ciac_kwargs)
+        CIAC(epochs, ica, **ciac_kwargs)
+        to_reference = {new: old for old, (new, _) in matches.items()}
+        # Components without a match in the reference are given as -1
+        ciac_ica = sorted(to_reference.get(comp, -1) for comp in ica.exclude)
+        result['ciac_reference'] = sorted(reference.exclude)
+        result['ciac_ica'] = ciac_ica
+        result['ciac_same'] = result['ciac_reference'] == ciac_ica
+    return result
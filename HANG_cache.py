@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:21:14 2026
+
+Build cache shared by the pipeline steps, replacing the old check of which
+6-character sID prefixes already have files in the output folder.
+
+For every output file the cache records a content hash (sha1) of each input
+file and the parameters used to make it (filter band, tmin/tmax, ICA and CIAC
+settings, ...). A subject is only rebuilt in a step if its output is missing,
+one of its inputs changed, or the parameters changed. Because each step's
+outputs are the next step's inputs, rebuilding a subject in one step makes it
+out of date in the later steps automatically.
+
+Hashing a BDF file takes a while, so hashes are remembered together with the
+file size and modification time and only recomputed when those change.
+
+Each step keeps its own cache file (build_cache_<step>.json) next to its
+outputs, so two steps can run at the same time.
+
+NOTE: Outputs made before the cache existed have no record and are rebuilt.
+isCurrent(..., adopt=True) instead takes an existing output without a record
+as up to date and records it with its current inputs and parameters - meant
+for one run after switching to the cache (adopt_existing in each step), as
+it cannot tell which parameters the output was really made with. Set
+reprocess_data = True in a step to force a full rebuild.
+
+NOTE2: replaceHash() is for files rewritten without changing anything the
+outputs made from them depend on (1-Epoching's metadata_only), so those
+outputs stay up to date.
+
+@author: Francis
+"""
+
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+def _jsonParams(params):
+    # Round trip through JSON so tuples/lists and numpy numbers compare equal
+    # to what was stored
+    return json.loads(json.dumps(params, sort_keys=True, default=str))
+
+class BuildCache():
+    '''
+    Record of the inputs and parameters used to make each output file.
+
+    Parameters
+    ----------
+    fname : STRING
+        Path of the cache file (created if it does not exist).
+
+    '''
+    def __init__(self, fname):
+        self.fname = fname
+        if os.path.exists(fname):
+            with open(fname, 'r') as file:
+                cache = json.load(file)
+        else:
+            cache = dict()
+        self._outputs = cache.get('outputs', dict())
+        self._hashes = cache.get('hashes', dict())
+
+    def _key(self, path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def fileHash(self, path):
+        '''
+        Content hash of a file (reused while size and mtime are unchanged).
+
+        Parameters
+        ----------
+        path : STRING
+            The file to hash.
+
+        Returns
+        -------
+        STRING of the sha1 hex digest, or None if the file does not exist.
+
+        '''
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        key = self._key(path)
+        known = self._hashes.get(key)
+        if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+            return known['hash']
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(4 * 1024**2), b''):
+                sha1.update(chunk)
+        self._hashes[key] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': sha1.hexdigest()}
+        return sha1.hexdigest()
+
+    def hashFiles(self, paths, n_threads=8):
+        '''
+        Hash several files at once in threads (hashing mostly waits on the
+        network share). Results are remembered, so later isCurrent() and
+        record() calls do not hash them again.
+
+        Parameters
+        ----------
+        paths : LIST of STRING
+            The files to hash.
+        n_threads : INT, optional
+            Number of files hashed at the same time. The default is 8.
+
+        Returns
+        -------
+        None.
+
+        '''
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(self.fileHash, paths))
+        self.save()
+
+    def isCurrent(self, output, inputs, params, adopt=False):
+        '''
+        Check whether an output is up to date.
+
+        Parameters
+        ----------
+        output : STRING
+            Path of the output file.
+        inputs : LIST of STRING
+            Paths of the files the output is made from.
+        params : DICT
+            The parameters the output is made with (must be JSON-able; tuples
+            are compared as lists).
+        adopt : BOOL, optional
+            If the output exists but has no record (made before the cache
+            existed), record it as up to date. The default is False.
+
+        Returns
+        -------
+        True if the output exists and was made from the same input contents
+        with the same parameters, otherwise False.
+
+        '''
+        if not os.path.exists(output):
+            return False
+        known = self._outputs.get(self._key(output))
+        if known is None:
+            if adopt:
+                self.record(output, inputs, params)
+                return True
+            return False
+        if known['params'] != _jsonParams(params):
+            return False
+        if sorted(known['inputs']) != sorted(self._key(path) for path in inputs):
+            return False
+        for path in inputs:
+            if known['inputs'][self._key(path)] != self.fileHash(path):
+                return False
+        return True
+
+    def replaceHash(self, path, old_hash):
+        '''
+        Keep outputs made from an earlier version of a file up to date after
+        the file was rewritten with changes they do not depend on (see NOTE2
+        at top of file): every record with old_hash for path gets the new
+        hash of path.
+
+        Parameters
+        ----------
+        path : STRING
+            The rewritten file.
+        old_hash : STRING
+            fileHash() of path before it was rewritten.
+
+        Returns
+        -------
+        INT of the number of records updated.
+
+        '''
+        key = self._key(path)
+        new_hash = self.fileHash(path)
+        n_updated = 0
+        for known in self._outputs.values():
+            if known['inputs'].get(key) == old_hash:
+                known['inputs'][key] = new_hash
+                n_updated += 1
+        self.save()
+        return n_updated
+
+    def record(self, output, inputs, params):
+        '''
+        Record that output was made from inputs with params, and save the
+        cache file.
+
+        Parameters
+        ----------
+        output : STRING
+            Path of the output file.
+        inputs : LIST of STRING
+            Paths of the files the output was made from.
+        params : DICT
+            The parameters the output was made with.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self._outputs[self._key(output)] = {'inputs': {self._key(path): self.fileHash(path) for path in inputs},
+                                            'params': _jsonParams(params)}
+        self.save()
+
+    def save(self):
+        '''
+        Write the cache file (to a temporary file first, so an interrupted
+        run never leaves a half-written cache).
+        '''
+        tmp_fname = self.fname + '.tmp'
+        with open(tmp_fname, 'w') as file:
+            json.dump({'outputs': self._outputs, 'hashes': self._hashes}, file, indent=1)
+        os.replace(tmp_fname, self.fname)
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 14:37:09 2026
+
+Memory-mapped reading of the sID-epo.fif files shared by the pipeline
+steps. MNE saves epochs data as one contiguous float32 array (a single
+FIFF_EPOCH tag) inside the -epo.fif file. readEpochs() reads the file for
+everything except the data (info, events, metadata, drop log) and
+memory-maps that array read-only instead of loading a float64 copy of all
+epochs. The files are written once, by MNE, in its normal format (see
+saveEpochs), so they can be used without this module (MNE, EEGLAB, other lab
+scripts) and no second copy of the data is written.
+
+With the data memory-mapped, only the parts of the file that are actually
+used are read from the share, and the data stay float32 (half the size of
+MNE's float64 copy) in the OS file cache instead of in each Python process.
+Most of what the pipeline does with the epochs only reads the data
+(histograms, averages, plots, ICA fitting copies the data anyway), so no copy
+is made until the data are changed. The array is big-endian as in the file;
+NumPy converts it whenever it is used in a calculation.
+
+NOTE: MNE changes epochs data in place (apply_baseline, ica.apply, filter,
+...), which raises "ValueError: assignment destination is read-only" on
+memory-mapped epochs. Call writableEpochs() first, which swaps in a normal
+float64 copy of the data the first time it is needed. epochs.copy() and
+dropping epochs give writable data too, but still float32, and MNE (1.3)
+refuses to save epochs that are not float64 (AssertionError in
+epochs.save). saveEpochs() takes care of this; use writableEpochs() before
+saving epochs with epochs.save().
+
+NOTE2: MNE has no public way to give epochs read from a file memory-mapped
+data (mne.EpochsArray always makes a float64 copy), so readEpochs() and
+writableEpochs() set epochs._data directly and the position of the data in
+the file is found by reading the FIF tags. Both are MNE internals, so all of
+this is gated on the MNE version of the lab environment (mmapSupported(),
+mmap_mne_version, see mne-package-list.txt). With any other MNE version
+readEpochs() is mne.read_epochs(fname, preload=True) and writableEpochs()
+does nothing - slower and twice the memory, but nothing depends on MNE
+internals. The same happens if the data in the file are split over several
+files, scaled (channel cal other than 1) or do not match the header.
+Update mmap_mne_version only after checking readEpochs() against
+mne.read_epochs on the new version.
+
+NOTE3: On Windows a file cannot be replaced while any process has it
+memory-mapped. saveEpochs() then raises a PermissionError - close the other
+step (or the Spyder console holding the epochs) and save again. On Linux and
+macOS the other process keeps reading the old data.
+
+NOTE4: noiseCovariance() keeps the noise covariance of each subject's epochs
+(sID-cov.fif, used by CIAC for the dipole fits) next to the -epo.fif file and
+only recomputes it when the epochs or the time window change. It only reads
+the time window of every epoch (memory-mapped, or epoch by epoch from the
+-epo.fif file), not the whole epochs.
+
+@author: Francis
+"""
+
+import os
+import numpy as np
+import mne
+from mne.io.constants import FIFF
+from HANG_cache import BuildCache
+
+# MNE version (major.minor) whose epochs internals readEpochs() relies on
+# (see NOTE2)
+mmap_mne_version = (1, 3)
+
+def mmapSupported():
+    '''
+    Returns
+    -------
+    BOOL, True if the installed MNE is the version the memory-mapping was
+    written for (mmap_mne_version, see NOTE2 at top of file).
+    '''
+    return tuple(int(part) for part in mne.__version__.split('.')[:2]) == mmap_mne_version
+
+def _dataBlock(fname):
+    # Position, shape and dtype of the epochs data (the FIFF_EPOCH tag) in an
+    # -epo.fif file, or None if there is not exactly one. FIF tags are a
+    # 16 byte big-endian header (kind, type, size, next) followed by size bytes
+    # of data; a matrix tag ends with its dimensions (reversed) and their
+    # number
+    dtypes = {FIFF.FIFFT_FLOAT: '>f4', FIFF.FIFFT_DOUBLE: '>f8'}
+    blocks = []
+    with open(fname, 'rb') as fid:
+        pos = 0
+        while True:
+            fid.seek(pos)
+            header = fid.read(16)
+            if len(header) < 16:
+                break
+            kind, tag_type, size, next_pos = np.frombuffer(header, dtype='>i4')
+            if kind == FIFF.FIFF_EPOCH:
+                base_type = int(tag_type) & ~(1 << 30)
+                if not int(tag_type) & (1 << 30) or base_type not in dtypes:
+                    return None
+                fid.seek(pos + 16 + size - 4)
+                ndim = int(np.frombuffer(fid.read(4), dtype='>i4')[0])
+                fid.seek(pos + 16 + size - 4 * (ndim + 1))
+                shape = tuple(int(n) for n in np.frombuffer(fid.read(4 * ndim), dtype='>i4')[::-1])
+                blocks.append((pos + 16, shape, dtypes[base_type]))
+            pos = next_pos if next_pos > 0 else pos + 16 + size
+    return blocks[0] if len(blocks) == 1 else None
+
+def _currentData(fname, epochs):
+    # The memory-mapped data for epochs read (header only) from fname, or None
+    # if they cannot be memory-mapped (see NOTE2)
+    if not mmapSupported():
+        return None
+    cals = np.array([ch['cal'] * ch.get('scale', 1.0) for ch in epochs.info['chs']])
+    block = _dataBlock(fname)
+    if block is None or not np.all(cals == 1):
+        return None
+    offset, shape, dtype = block
+    if shape != (len(epochs), len(epochs.ch_names), len(epochs.times)):
+        print('Epochs data in ' + fname + ' do not match its header - loading the file normally')
+        return None
+    return np.memmap(fname, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+def saveEpochs(epochs, fname, overwrite=True):
+    '''
+    Save epochs as an -epo.fif file (float64 data are converted first, see
+    NOTE at top of file). The file is written under a temporary name and then
+    renamed, so no step ever reads a half-written file (see NOTE3 for files
+    other steps have memory-mapped).
+
+    Parameters
+    ----------
+    epochs : mne.epochs.EpochsFIF CLASS
+        The (preloaded) epochs to save.
+    fname : STRING
+        Path of the -epo.fif file.
+    overwrite : BOOL, optional
+        Overwrite an existing file. The default is True.
+
+    Returns
+    -------
+    None.
+
+    '''
+    if os.path.exists(fname) and not overwrite:
+        raise FileExistsError(fname + ' already exists and overwrite is False')
+    writableEpochs(epochs)
+    tmp_fname = fname[:-len('.fif')] + '.tmp-epo.fif'
+    epochs.save(tmp_fname, overwrite=True)
+    try:
+        os.replace(tmp_fname, fname)
+    except PermissionError:
+        os.remove(tmp_fname)
+        raise PermissionError(fname + ' is open in another step or process (on Windows memory-mapped files '
+                              'cannot be replaced, see HANG_epochs) - close it and save again')
+
+def readEpochs(fname, mmap=True):
+    '''
+    Read -epo.fif epochs with the data memory-mapped read-only.
+
+    Parameters
+    ----------
+    fname : STRING
+        Path of the -epo.fif file.
+    mmap : BOOL, optional
+        Memory-map the float32 data in the file. If False (or the data cannot
+        be memory-mapped, see NOTE2 at top of file) the -epo.fif file is
+        loaded normally. The default is True.
+
+    Returns
+    -------
+    epochs : mne.epochs.EpochsFIF CLASS
+        The preloaded epochs. See NOTE at top of file before changing the
+        data in place.
+
+    '''
+    if not mmap or not mmapSupported():
+        return mne.read_epochs(fname, preload=True)
+    # With preload=False only the header of the -epo.fif file is read
+    epochs = mne.read_epochs(fname, preload=False)
+    data = _currentData(fname, epochs)
+    if data is None:
+        epochs.load_data()
+        return epochs
+    # See NOTE2 at top of file
+    epochs._data = data
+    epochs.preload = True
+    return epochs
+
+def writableEpochs(epochs):
+    '''
+    Make sure the epochs data can be changed in place and saved, replacing
+    memory-mapped or float32 data with a float64 copy (once - later calls do
+    nothing).
+
+    Parameters
+    ----------
+    epochs : mne.epochs.EpochsFIF CLASS
+        The epochs, e.g. from readEpochs().
+
+    Returns
+    -------
+    The same epochs object (changed in place), so it can be chained:
+    writableEpochs(epochs).apply_baseline((-0.2,0))
+
+    '''
+    # Only readEpochs() with mmapSupported() gives such data (see NOTE2)
+    if not mmapSupported() or not epochs.preload:
+        return epochs
+    if not epochs._data.flags['WRITEABLE'] or epochs._data.dtype != np.float64:
+        epochs._data = np.array(epochs._data, dtype=np.float64)
+    return epochs
+
+def baselineCovariance(fname, tmin=-0.4, tmax=-0.2):
+    '''
+    Compute the noise covariance of the tmin to tmax window of saved epochs
+    without loading the whole epochs (same result as
+    mne.compute_covariance(epochs, tmin=tmin, tmax=tmax)).
+
+    Parameters
+    ----------
+    fname : STRING
+        Path of the -epo.fif file.
+    tmin : FLOAT, optional
+        Start of the window. The default is -0.4.
+    tmax : FLOAT, optional
+        End of the window. The default is -0.2.
+
+    Returns
+    -------
+    mne.Covariance CLASS
+
+    '''
+    epochs = mne.read_epochs(fname, preload=False)
+    # Samples in the window (rounded to samples like mne.compute_covariance)
+    sfreq = epochs.info['sfreq']
+    samples = np.round(epochs.times * sfreq)
+    mask = (samples >= np.round(tmin * sfreq)) & (samples <= np.round(tmax * sfreq))
+    data = _currentData(fname, epochs)
+    if data is not None:
+        # Only the window is read from the memory-mapped data
+        data = np.array(data[:, :, mask], dtype=np.float64)
+    else:
+        # Epochs that are not loaded are read from the file one at a time
+        data = np.array([epoch[:, mask] for epoch in epochs])
+    window = mne.EpochsArray(data, epochs.info, tmin=epochs.times[mask][0], baseline=None, verbose=False)
+    return mne.compute_covariance(window)
+
+def noiseCovariance(fname, tmin=-0.4, tmax=-0.2, cache=None):
+    '''
+    Noise covariance of saved epochs, kept as sID-cov.fif next to the
+    -epo.fif file and only recomputed when the epochs or the window change.
+
+    Parameters
+    ----------
+    fname : STRING
+        Path of the -epo.fif file.
+    tmin : FLOAT, optional
+        Start of the window. The default is -0.4.
+    tmax : FLOAT, optional
+        End of the window. The default is -0.2.
+    cache : BuildCache CLASS, optional
+        The build cache to record the covariance in (e.g. the step's own, so
+        the -epo.fif file is not hashed twice). The default is None
+        (build_cache_cov.json next to the epochs).
+
+    Returns
+    -------
+    mne.Covariance CLASS
+
+    '''
+    cov_fname = fname[:-len('-epo.fif')] + '-cov.fif'
+    if cache is None:
+        cache = BuildCache(os.path.join(os.path.dirname(os.path.abspath(fname)), 'build_cache_cov.json'))
+    params = dict(tmin=tmin, tmax=tmax)
+    if cache.isCurrent(cov_fname, [fname], params):
+        return mne.read_cov(cov_fname)
+    cov = baselineCovariance(fname, tmin=tmin, tmax=tmax)
+    cov.save(cov_fname, overwrite=True)
+    cache.record(cov_fname, [fname], params)
+    return cov
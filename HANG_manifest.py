@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 13:40:02 2026
+
+Subject manifest for the raw data folders. Instead of listing the data root
+and each subject folder again for every subject (which is slow on the RDSS
+share), the data root is scanned once and each sID is mapped to its folder,
+.mat and .bdf files (with file sizes and modification times).
+
+The manifest is cached on disk (subject_manifest.json in the data root). On
+the next run only subject folders whose modification time changed (files
+added, removed or renamed) or that are new are listed again, and those are
+listed concurrently in a few threads since each listing mostly waits on the
+network.
+
+NOTE: Overwriting a file inside a subject folder does not always change the
+folder's modification time. Use refresh=True to rescan everything if files
+were replaced in place.
+
+@author: Francis
+"""
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+def _scanSubjectFolder(path):
+    # Same rule as the original loops in 1-Epoching: if several files have the
+    # same extension, the last one listed is used
+    entry = dict()
+    with os.scandir(path) as files:
+        for file in files:
+            for ext in ['mat', 'bdf']:
+                if file.name.endswith('.' + ext):
+                    stat = file.stat()
+                    entry[ext] = file.name
+                    entry[ext + '_size'] = stat.st_size
+                    entry[ext + '_mtime'] = stat.st_mtime
+    return entry
+
+def buildManifest(sIDs, root='.', cache_fname='subject_manifest.json', n_threads=8,
+                  refresh=False):
+    '''
+    Map each sID to its raw data folder and files.
+
+    Parameters
+    ----------
+    sIDs : LIST of STRING
+        The subject IDs to look up. As in 1-Epoching, the folder for a sID is
+        the first folder (in sorted order) whose name starts with the sID, so
+        folders with additional characters at the end are matched too.
+    root : STRING, optional
+        The data root containing one folder per subject. The default is '.'.
+    cache_fname : STRING, optional
+        Name of the cached manifest file (inside root). The default is
+        'subject_manifest.json'.
+    n_threads : INT, optional
+        Number of threads listing changed subject folders at the same time.
+        The default is 8.
+    refresh : BOOL, optional
+        Ignore the cache and list every subject folder again. The default is
+        False.
+
+    Returns
+    -------
+    manifest : DICT
+        sID -> DICT with keys 'folder', 'mat', 'bdf' (paths, or None if not
+        found), 'mat_size', 'bdf_size' (bytes) and 'mat_mtime', 'bdf_mtime'.
+        sIDs without a folder are left out.
+
+    '''
+    cache_path = os.path.join(root, cache_fname)
+    cached = dict()
+    if not refresh and os.path.exists(cache_path):
+        with open(cache_path, 'r') as file:
+            cached = json.load(file)
+
+    # The one listing of the data root (DirEntry.stat() is free on Windows)
+    folders = dict()
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                folders[entry.name] = entry.stat().st_mtime
+
+    # Only subject folders are needed
+    matched = dict()
+    for folder in sorted(folders):
+        for sID in sIDs:
+            if folder.startswith(sID) and sID not in matched:
+                matched[sID] = folder
+
+    to_scan = [folder for folder in matched.values()
+               if folder not in cached or cached[folder]['folder_mtime'] != folders[folder]]
+    if to_scan:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            scanned = pool.map(_scanSubjectFolder, [os.path.join(root, folder) for folder in to_scan])
+            for folder, entry in zip(to_scan, scanned):
+                entry['folder_mtime'] = folders[folder]
+                cached[folder] = entry
+
+    # Forget folders that no longer exist
+    cached = {folder: cached[folder] for folder in cached if folder in folders}
+    with open(cache_path, 'w') as file:
+        json.dump(cached, file, indent=1)
+
+    manifest = dict()
+    for sID, folder in matched.items():
+        entry = cached[folder]
+        manifest[sID] = {'folder': os.path.join(root, folder)}
+        for ext in ['mat', 'bdf']:
+            if ext in entry:
+                manifest[sID][ext] = os.path.join(root, folder, entry[ext])
+                manifest[sID][ext + '_size'] = entry[ext + '_size']
+                manifest[sID][ext + '_mtime'] = entry[ext + '_mtime']
+            else:
+                manifest[sID][ext] = None
+    return manifest
+
+def scanFolder(folder, suffix):
+    '''
+    List a pipeline output folder once and return the files ending in suffix,
+    grouped by sID (first 6 characters of the file name).
+
+    Parameters
+    ----------
+    folder : STRING
+        The folder to list (e.g. '2_ICA_set').
+    suffix : STRING or TUPLE of STRING
+        File ending(s) to keep (e.g. '-epo.fif').
+
+    Returns
+    -------
+    DICT of sID -> LIST of file names.
+
+    '''
+    files = dict()
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.endswith(suffix):
+                files.setdefault(entry.name[0:6], []).append(entry.name)
+    return files
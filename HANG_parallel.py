@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 09:12:40 2026
+
+Helpers for running a per-subject pipeline step in a pool of worker processes
+instead of the usual one-subject-at-a-time for loop.
+
+Every worker runs the step for one sID at a time. Any error raised for a
+subject is caught and stored (with the full traceback) so that one bad
+recording does not stop the rest of the batch. The errors are returned at the
+end so they can be checked manually.
+
+NOTE: Scripts using runSubjects() need to keep their main loop under an
+if __name__ == '__main__': block. On Windows, every worker re-imports the
+script that started it and would otherwise start running the whole loop again.
+
+NOTE2: The per-worker memory budget (memory_gb) only sets the number of
+workers: no more are started than fit in the memory available when the step
+starts (psutil, which is in the lab environment). It is not a hard limit on
+any platform - a worker that needs more than its budget still gets it, and
+if the machine runs out of memory Windows pages to disk (slow) and Linux
+kills a worker (that subject is then reported as failed). Capping each
+worker's address space (RLIMIT_AS) is not used: it limits virtual memory,
+so BLAS/OpenMP thread arenas and memory-mapped epochs gave MemoryErrors far
+below the budget, and it does not exist on Windows.
+
+NOTE3: numpy/scipy (BLAS) and numba (OpenMP) start one thread per core in
+every process by default, so n_workers processes each running BLAS on all
+cores fight over the CPU. Use blas_threads so that n_workers * blas_threads
+is about the number of cores (limited with threadpoolctl in each worker).
+
+@author: Francis
+"""
+
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+_thread_variables = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                     'NUMEXPR_NUM_THREADS', 'NUMBA_NUM_THREADS']
+
+def workerCount(n_workers, memory_gb=None):
+    '''
+    Work out how many worker processes can actually be started.
+
+    Parameters
+    ----------
+    n_workers : INT
+        The requested number of worker processes.
+    memory_gb : FLOAT, optional
+        The memory budget for each worker in GB. If given, the number of
+        workers is lowered so that all workers fit in the memory currently
+        available (see NOTE2 at top of file). The default is None.
+
+    Returns
+    -------
+    INT of the number of workers to use (at least 1).
+
+    '''
+    n_workers = min(n_workers, os.cpu_count() or 1)
+    if memory_gb:
+        if psutil is None:
+            print('psutil not installed - the number of workers is not checked against the available memory')
+        else:
+            available_gb = psutil.virtual_memory().available / 1024**3
+            n_workers = min(n_workers, int(available_gb // memory_gb))
+    return max(1, n_workers)
+
+def limitThreads(n_threads):
+    '''
+    Limit the number of BLAS/OpenMP threads used by this process.
+
+    Parameters
+    ----------
+    n_threads : INT
+        The number of threads.
+
+    Returns
+    -------
+    None.
+
+    '''
+    # Libraries loaded from now on read the environment variables, the ones
+    # already loaded (numpy's BLAS) are limited with threadpoolctl
+    for variable in _thread_variables:
+        os.environ[variable] = str(n_threads)
+    if threadpool_limits is not None:
+        threadpool_limits(limits=n_threads)
+    else:
+        print('threadpoolctl not installed - BLAS threads are only limited for libraries loaded later')
+
+def _initWorker(blas_threads, initializer, initargs):
+    if blas_threads:
+        limitThreads(blas_threads)
+    if initializer is not None:
+        initializer(*initargs)
+
+def _runSubject(func, sID, args, kwargs):
+    try:
+        return sID, func(sID, *args, **kwargs), None
+    except Exception:
+        return sID, None, traceback.format_exc()
+
+def runSubjects(func, sIDs, n_workers=4, memory_gb=None, args=(), kwargs=None,
+                initializer=None, initargs=(), blas_threads=None):
+    '''
+    Run func(sID, *args, **kwargs) for every sID in a pool of worker processes.
+
+    Parameters
+    ----------
+    func : FUNCTION
+        The per-subject function to run. Must be defined at the top level of a
+        module (or script) so that it can be sent to the workers.
+    sIDs : LIST of STRING
+        The subjects to process.
+    n_workers : INT, optional
+        The number of worker processes. The default is 4.
+    memory_gb : FLOAT, optional
+        Memory budget for each worker in GB, used to choose the number of
+        workers (see NOTE2 at top of file). The default is None (no budget).
+    args : TUPLE, optional
+        Extra positional arguments passed to func after the sID. The default
+        is ().
+    kwargs : DICT, optional
+        Extra keyword arguments passed to func. The default is None.
+    initializer : FUNCTION, optional
+        Function called once in each worker when it starts (e.g. to set the
+        MNE log level). The default is None.
+    initargs : TUPLE, optional
+        Arguments for initializer. The default is ().
+    blas_threads : INT, optional
+        Number of BLAS/OpenMP threads in each worker. See NOTE3 at top of
+        file. The default is None (library default, usually all cores).
+
+    Returns
+    -------
+    results : DICT
+        sID -> return value of func for every subject that finished.
+    errors : DICT
+        sID -> traceback STRING for every subject that failed.
+
+    '''
+    if kwargs is None:
+        kwargs = dict()
+    results = dict()
+    errors = dict()
+    if len(sIDs) == 0:
+        return results, errors
+    n_workers = min(workerCount(n_workers, memory_gb), len(sIDs))
+    print('Processing ' + str(len(sIDs)) + ' subjects with ' + str(n_workers) + ' workers' +
+          (' (' + str(blas_threads) + ' BLAS threads each)' if blas_threads else ''))
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_initWorker,
+                             initargs=(blas_threads, initializer, initargs)) as pool:
+        futures = {pool.submit(_runSubject, func, sID, args, kwargs): sID for sID in sIDs}
+        for future in as_completed(futures):
+            sID = futures[future]
+            # A worker that dies outright (e.g. killed by the OS when out of
+            # memory) breaks the pool and raises here instead of in _runSubject
+            try:
+                sID, result, error = future.result()
+            except Exception:
+                result, error = None, traceback.format_exc()
+            if error is None:
+                results[sID] = result
+            else:
+                errors[sID] = error
+            print(sID + ' done (' + str(len(results) + len(errors)) + '/' + str(len(sIDs)) + ')' +
+                  (' - FAILED' if error is not None else ''))
+    return results, errors
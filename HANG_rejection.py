@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:48:26 2026
+
+Shared data for the rejection histograms in 2-Rejection and 4b-ManualICA.
+
+Every histogram (epochs and channels) is based on the same numbers: the
+largest absolute voltage of each channel in each epoch after applying the
+baseline. PeakMatrix computes this epochs x channels matrix once per subject
+(in uV, like epochs.to_data_frame()) straight from the epochs data, without
+making a baselined copy. The epoch histogram is the max over good channels
+of each row, the channel histogram the max over epochs of each column.
+
+When epochs are dropped or channels are marked bad, call sync(epochs) and
+the matrix drops the same rows / stops using those columns, so later passes
+never go back to the epochs data.
+
+For running step 2 without a reviewer, suggestedCutoff() gives the threshold
+a rule picks from a histogram (the Q3+1.5*IQR suggestion shown on the epoch
+histograms, or median + k*MAD), flagReasons() lists why a subject should
+still be checked by hand, and writeRejectionLog() keeps the thresholds and
+dropped epochs / channels of every subject in one JSON file.
+
+PeakMatrix.save() writes the matrix (plus the suggested cutoffs and a few
+summary numbers) to a small .npz review sidecar, and PeakMatrix.load() reads
+it back without needing the epochs, so the histograms can be shown before
+the epochs file is loaded.
+
+@author: Francis
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+class PeakMatrix():
+    '''
+    Baselined absolute peak voltage of every epoch and channel.
+
+    Parameters
+    ----------
+    epochs : mne.epochs.EpochsFIF CLASS
+        The (preloaded) epochs. The data are not changed or copied.
+    baseline : TUPLE, optional
+        Initial and final time of the baseline, same as for apply_baseline().
+        The default is (-0.2,0).
+
+    '''
+    def __init__(self, epochs, baseline=(-0.2,0)):
+        # Same baseline samples as apply_baseline() (both ends included)
+        window = np.flatnonzero((epochs.times >= baseline[0]) & (epochs.times <= baseline[1]))
+        data = epochs.get_data()
+        # The max of |voltage - baseline| over time is either the max voltage
+        # minus the baseline or the baseline minus the min voltage, so the
+        # baselined data never need to be made
+        base = data[:, :, window[0]:window[-1]+1].mean(axis=2)
+        peaks = np.maximum(data.max(axis=2) - base, base - data.min(axis=2))
+        # Same units as to_data_frame() (uV)
+        self.peaks = peaks * 1e6
+        self.baseline = baseline
+        self.ch_names = list(epochs.info['ch_names'])
+        self.selection = np.array(epochs.selection)
+        self.bads = list(epochs.info['bads'])
+
+    @classmethod
+    def load(cls, fname):
+        '''
+        Read a peak matrix saved by save().
+
+        Parameters
+        ----------
+        fname : STRING
+            Path of the .npz file.
+
+        Returns
+        -------
+        peaks : PeakMatrix CLASS
+            The peak matrix (no epochs needed).
+        summary : DICT
+            The summary numbers saved with it.
+
+        '''
+        peaks = cls.__new__(cls)
+        with np.load(fname) as sidecar:
+            peaks.peaks = sidecar['peaks']
+            peaks.baseline = tuple(sidecar['baseline'].tolist())
+            peaks.ch_names = sidecar['ch_names'].tolist()
+            peaks.selection = sidecar['selection']
+            peaks.bads = sidecar['bads'].tolist()
+            summary = json.loads(str(sidecar['summary']))
+        return peaks, summary
+
+    def save(self, fname, summary=None):
+        '''
+        Save the peak matrix as a small .npz file (the review sidecar).
+
+        Parameters
+        ----------
+        fname : STRING
+            Path of the .npz file.
+        summary : DICT, optional
+            Extra numbers to store with the matrix (must be JSON-able), e.g.
+            the suggested cutoffs. The default is None.
+
+        Returns
+        -------
+        None.
+
+        '''
+        if summary is None:
+            summary = dict()
+        # np.savez adds .npz to names without it, so keep the ending on the
+        # temporary file
+        tmp_fname = fname[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_fname, peaks=self.peaks, baseline=np.array(self.baseline, dtype=float),
+                 ch_names=np.array(self.ch_names), selection=self.selection,
+                 bads=np.array(self.bads, dtype=str),
+                 summary=np.array(json.dumps(summary, default=str)))
+        os.replace(tmp_fname, fname)
+
+    def matches(self, epochs, baseline):
+        '''
+        Check that the matrix belongs to epochs (same epochs and channels, same
+        baseline), e.g. before using a sidecar from an earlier prepass.
+
+        Returns
+        -------
+        BOOL
+        '''
+        return (tuple(self.baseline) == tuple(float(x) for x in baseline) and
+                self.ch_names == list(epochs.info['ch_names']) and
+                np.array_equal(self.selection, epochs.selection) and
+                self.bads == list(epochs.info['bads']))
+
+    def goodChannels(self):
+        '''
+        Returns
+        -------
+        LIST of STRING of the channels not marked bad (in channel order).
+        '''
+        return [ch for ch in self.ch_names if ch not in self.bads]
+
+    def _goodPicks(self):
+        return np.array([self.ch_names.index(ch) for ch in self.goodChannels()], dtype=int)
+
+    def epochMax(self):
+        '''
+        Largest baselined absolute voltage of each epoch over good channels.
+
+        Returns
+        -------
+        A pandas DataFrame with columns 'Epoch' (epochs.selection) and
+        'MaxValue' (uV), one row per remaining epoch in epochs order.
+
+        '''
+        return pd.DataFrame({'Epoch': self.selection,
+                             'MaxValue': self.peaks[:, self._goodPicks()].max(axis=1)})
+
+    def channelMax(self):
+        '''
+        Largest baselined absolute voltage of each good channel over all
+        remaining epochs.
+
+        Returns
+        -------
+        A pandas DataFrame with columns 'Channel' and 'MaxValue' (uV).
+
+        '''
+        return pd.DataFrame({'Channel': self.goodChannels(),
+                             'MaxValue': self.peaks[:, self._goodPicks()].max(axis=0)})
+
+    def sync(self, epochs):
+        '''
+        Update the matrix after epochs were dropped or channels were marked
+        bad in the epochs.
+
+        Parameters
+        ----------
+        epochs : mne.epochs.EpochsFIF CLASS
+            The epochs the matrix was made from (epochs can only have been
+            removed, not added).
+
+        Returns
+        -------
+        None.
+
+        '''
+        keep = np.isin(self.selection, epochs.selection)
+        if not keep.all():
+            self.peaks = self.peaks[keep]
+            self.selection = self.selection[keep]
+        self.bads = list(epochs.info['bads'])
+
+def suggestedCutoff(values, rule='iqr', k=1.5):
+    '''
+    Threshold suggested by a robust rule for a set of peak voltages.
+
+    Parameters
+    ----------
+    values : pandas Series or ARRAY
+        The peak voltages (e.g. the MaxValue column of epochMax()).
+    rule : STRING, optional
+        'iqr' for Q3 + k*IQR (with k=1.5 the suggestion on the epoch
+        histograms), 'mad' for median + k*MAD (MAD scaled by 1.4826 to match
+        the standard deviation of normal data). The default is 'iqr'.
+    k : FLOAT, optional
+        Multiplier of the IQR or MAD. The default is 1.5.
+
+    Returns
+    -------
+    INT of the threshold (voltages above it are rejected).
+
+    '''
+    values = pd.Series(np.asarray(values, dtype=float))
+    if rule == 'iqr':
+        q1 = values.quantile(.25)
+        q3 = values.quantile(.75)
+        return int(q3 + k*(q3-q1))
+    elif rule == 'mad':
+        median = values.median()
+        mad = 1.4826 * (values - median).abs().median()
+        return int(median + k*mad)
+    else:
+        raise ValueError('Unknown rule ' + str(rule) + " - use 'iqr' or 'mad'")
+
+def flagReasons(entry, max_dropped_fraction=0.15, max_bad_channels=4):
+    '''
+    Check an automatic rejection result for anything a reviewer should look
+    at.
+
+    Parameters
+    ----------
+    entry : DICT
+        The subject's rejection log entry (see writeRejectionLog).
+    max_dropped_fraction : FLOAT, optional
+        Flag subjects losing more than this fraction of their epochs. The
+        default is 0.15.
+    max_bad_channels : INT, optional
+        Flag subjects with more than this many bad channels after rejection.
+        The default is 4.
+
+    Returns
+    -------
+    LIST of STRING of reasons (empty if nothing stands out).
+
+    '''
+    reasons = []
+    dropped_fraction = 1 - entry['n_kept'] / entry['n_epochs']
+    if dropped_fraction > max_dropped_fraction:
+        reasons.append('{:.0%} of epochs dropped'.format(dropped_fraction))
+    if len(entry['bad_channels']) > max_bad_channels:
+        reasons.append(str(len(entry['bad_channels'])) + ' bad channels')
+    return reasons
+
+def readRejectionLog(fname):
+    '''
+    Read the rejection log written by writeRejectionLog().
+
+    Parameters
+    ----------
+    fname : STRING
+        Path of the JSON log file.
+
+    Returns
+    -------
+    DICT of sID -> log entry (empty if there is no log yet).
+
+    '''
+    if not os.path.exists(fname):
+        return dict()
+    with open(fname, 'r') as file:
+        return json.load(file)
+
+def writeRejectionLog(entries, fname):
+    '''
+    Add (or replace) subjects in the rejection log and save it.
+
+    Parameters
+    ----------
+    entries : DICT
+        sID -> DICT with (at least) 'mode' ('auto' or 'interactive'),
+        'epoch_threshold', 'channel_threshold', 'second_epoch_threshold',
+        'dropped_epochs' (epoch numbers as in epochs.selection),
+        'bad_channels', 'n_epochs', 'n_kept', and for automatic runs 'flagged'
+        (LIST of reasons from flagReasons()).
+    fname : STRING
+        Path of the JSON log file.
+
+    Returns
+    -------
+    The full log as a DICT.
+
+    '''
+    log = readRejectionLog(fname)
+    log.update(entries)
+    # Write to a temporary file first so an interrupted run never leaves a
+    # half-written log
+    with open(fname + '.tmp', 'w') as file:
+        json.dump(log, file, indent=1, sort_keys=True, default=str)
+    os.replace(fname + '.tmp', fname)
+    return log
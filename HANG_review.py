@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 23 10:12:36 2026
+
+Helpers for the manual review in 4b-ManualICA.
+
+While a reviewer looks at one subject, Prefetcher loads the next subjects in
+the queue (epochs, ICA, average) in a background thread, so
+moving on to the next subject does not wait on the network share. Loading
+mostly waits on file reads (and NumPy copies, which release the GIL), so a
+thread is enough and the plots stay in the main thread as matplotlib needs.
+
+ReviewQueue keeps track of which reviewer has claimed and finished which
+subject in a small SQLite database (review_queue.sqlite in the output folder),
+replacing lab_members.pickle and listing the output folder on every loop.
+Every subject is reviewed by two different reviewers. Claiming a subject is a
+single transaction, so two reviewers running 4b at the same time never get the
+same subject and the file cannot be left half-written. A claim that is neither
+finished nor released (e.g. 4b was killed) expires after claim_hours, so the
+subject goes back to the queue.
+
+NOTE: Each prefetched subject is held until it is reviewed or no longer next
+in the queue. Whatever load returns stays in memory (in 4b only the average
+and the ICA, the epochs data are memory-mapped), so keep n_ahead small if it
+returns full copies of the data.
+
+NOTE2: SQLite locks the database file while a claim is made. This works on
+the SMB share as long as the database stays in the default (rollback journal)
+mode - do not switch it to WAL mode, which needs shared memory and does not
+work over a network share.
+
+@author: Francis
+"""
+
+import sqlite3
+import contextlib
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+class Prefetcher():
+    '''
+    Load the next subjects in a background thread.
+
+    Parameters
+    ----------
+    load : FUNCTION
+        Called with a sID, returns whatever the review needs for it.
+    n_ahead : INT, optional
+        How many of the next subjects to keep loaded. The default is 2.
+
+    '''
+    def __init__(self, load, n_ahead=2):
+        self.load = load
+        self.n_ahead = n_ahead
+        # One thread, so the subjects are loaded in queue order
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._pending = dict()
+
+    def prefetch(self, sIDs):
+        '''
+        Start loading the first n_ahead of sIDs (in the background) and drop
+        subjects that are no longer among them.
+
+        Parameters
+        ----------
+        sIDs : LIST of STRING
+            The next subjects in the queue, in order.
+
+        Returns
+        -------
+        None.
+
+        '''
+        wanted = list(sIDs)[:self.n_ahead]
+        for sID in list(self._pending):
+            if sID not in wanted:
+                # Not started yet -> never loaded, otherwise the result is
+                # just dropped
+                self._pending.pop(sID).cancel()
+        for sID in wanted:
+            if sID not in self._pending:
+                self._pending[sID] = self._pool.submit(self.load, sID)
+
+    def get(self, sID):
+        '''
+        The loaded subject (waits if it is still loading, loads it now if it
+        was not prefetched).
+
+        Parameters
+        ----------
+        sID : STRING
+            The subject.
+
+        Returns
+        -------
+        Whatever load returns for sID. Errors while loading in the background
+        are raised here.
+
+        '''
+        future = self._pending.pop(sID, None)
+        if future is None or future.cancelled():
+            return self.load(sID)
+        return future.result()
+
+    def close(self):
+        '''
+        Drop everything not loaded yet and stop the thread.
+        '''
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = dict()
+        self._pool.shutdown(wait=False)
+
+class ReviewQueue():
+    '''
+    Work queue of subjects to review, shared by all reviewers.
+
+    Parameters
+    ----------
+    fname : STRING
+        Path of the SQLite database (created if it does not exist).
+    reviews_per_subject : INT, optional
+        Number of different reviewers each subject is assigned to. The
+        default is 2.
+    timeout : FLOAT, optional
+        Seconds to wait for another reviewer's claim to finish. The default
+        is 60.
+    claim_hours : FLOAT, optional
+        Claims older than this that were neither completed nor released are
+        given back to the queue. The default is 24.
+
+    '''
+    def __init__(self, fname, reviews_per_subject=2, timeout=60, claim_hours=24):
+        self.fname = fname
+        self.reviews_per_subject = reviews_per_subject
+        self.claim_hours = claim_hours
+        # Autocommit - transactions are started explicitly where needed
+        self._db = sqlite3.connect(fname, timeout=timeout, isolation_level=None)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS subjects (
+                            sID TEXT PRIMARY KEY, n_reviews INTEGER NOT NULL DEFAULT 0)""")
+        self._db.execute('CREATE INDEX IF NOT EXISTS subjects_open ON subjects (n_reviews, sID)')
+        self._db.execute("""CREATE TABLE IF NOT EXISTS reviews (
+                            sID TEXT NOT NULL, reviewer TEXT NOT NULL, status TEXT NOT NULL,
+                            claimed TEXT, completed TEXT, PRIMARY KEY (sID, reviewer))""")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the database's write lock at the start (waiting
+        # up to timeout for other reviewers), so the whole block is atomic
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def _now(self):
+        return datetime.datetime.now().isoformat(timespec='seconds')
+
+    def addSubjects(self, sIDs):
+        '''
+        Add subjects to the queue (subjects already in it are left as they
+        are).
+
+        Parameters
+        ----------
+        sIDs : LIST of STRING
+            The subjects ready for review.
+
+        Returns
+        -------
+        None.
+
+        '''
+        with self._transaction():
+            self._db.executemany('INSERT OR IGNORE INTO subjects (sID) VALUES (?)',
+                                 [(sID,) for sID in sIDs])
+
+    def recordDone(self, sID, reviewer):
+        '''
+        Record a review that was finished outside the queue (4b imports the
+        reviews in the output folder on every start). Recording the same
+        review again does nothing, and a claim of the subject by reviewer is
+        marked as done (the review was saved but not completed in the queue).
+
+        Parameters
+        ----------
+        sID : STRING
+            The subject.
+        reviewer : STRING
+            The reviewer's initials.
+
+        Returns
+        -------
+        None.
+
+        '''
+        with self._transaction():
+            self._db.execute('INSERT OR IGNORE INTO subjects (sID) VALUES (?)', (sID,))
+            inserted = self._db.execute("""INSERT OR IGNORE INTO reviews (sID, reviewer, status, completed)
+                                          VALUES (?, ?, 'done', ?)""", (sID, reviewer, self._now())).rowcount
+            if inserted:
+                self._db.execute('UPDATE subjects SET n_reviews = n_reviews + 1 WHERE sID = ?', (sID,))
+            else:
+                # A claim already counted in n_reviews
+                self._db.execute("""UPDATE reviews SET status = 'done', completed = ?
+                                    WHERE sID = ? AND reviewer = ? AND status = 'claimed'""",
+                                 (self._now(), sID, reviewer))
+
+    def claimNext(self, reviewer):
+        '''
+        Claim the next subject for a reviewer: a subject the reviewer claimed
+        before but did not finish, otherwise the first subject (by sID) that
+        the reviewer has not reviewed and that does not have enough reviewers.
+        Expired claims (see claim_hours) are given back first.
+
+        Parameters
+        ----------
+        reviewer : STRING
+            The reviewer's initials.
+
+        Returns
+        -------
+        STRING of the claimed sID, or None if nothing is left for reviewer.
+
+        '''
+        # The write lock is taken before reading, so no other reviewer can
+        # claim between the SELECT and the INSERT
+        with self._transaction():
+            self._expireClaims()
+            row = self._db.execute("""SELECT sID FROM reviews WHERE reviewer = ? AND status = 'claimed'
+                                      ORDER BY claimed LIMIT 1""", (reviewer,)).fetchone()
+            if row is None:
+                row = self._db.execute("""SELECT sID FROM subjects WHERE n_reviews < ? AND NOT EXISTS
+                                          (SELECT 1 FROM reviews WHERE reviews.sID = subjects.sID AND reviewer = ?)
+                                          ORDER BY sID LIMIT 1""", (self.reviews_per_subject, reviewer)).fetchone()
+                if row is not None:
+                    self._db.execute("""INSERT INTO reviews (sID, reviewer, status, claimed)
+                                        VALUES (?, ?, 'claimed', ?)""", (row[0], reviewer, self._now()))
+                    self._db.execute('UPDATE subjects SET n_reviews = n_reviews + 1 WHERE sID = ?', (row[0],))
+        return None if row is None else row[0]
+
+    def _expireClaims(self):
+        # Inside a transaction. The timestamps are ISO strings, so they sort
+        # in time order
+        cutoff = (datetime.datetime.now()
+                  - datetime.timedelta(hours=self.claim_hours)).isoformat(timespec='seconds')
+        self._db.execute("""UPDATE subjects SET n_reviews = n_reviews - 1 WHERE sID IN
+                            (SELECT sID FROM reviews WHERE status = 'claimed' AND claimed < ?)""", (cutoff,))
+        self._db.execute("DELETE FROM reviews WHERE status = 'claimed' AND claimed < ?", (cutoff,))
+
+    def peekNext(self, reviewer, n=2):
+        '''
+        The subjects claimNext() would most likely give reviewer after the
+        current one (nothing is claimed - another reviewer may take them
+        first). Used to choose what to prefetch.
+
+        Parameters
+        ----------
+        reviewer : STRING
+            The reviewer's initials.
+        n : INT, optional
+            Number of subjects. The default is 2.
+
+        Returns
+        -------
+        LIST of STRING
+
+        '''
+        rows = self._db.execute("""SELECT sID FROM subjects WHERE n_reviews < ? AND NOT EXISTS
+                                   (SELECT 1 FROM reviews WHERE reviews.sID = subjects.sID AND reviewer = ?)
+                                   ORDER BY sID LIMIT ?""", (self.reviews_per_subject, reviewer, n)).fetchall()
+        return [row[0] for row in rows]
+
+    def complete(self, sID, reviewer):
+        '''
+        Mark a claimed subject as reviewed. If the claim expired while the
+        reviewer was still working (see claim_hours), the review is recorded
+        anyway - the subject may then have more than reviews_per_subject
+        reviews, which is printed.
+
+        Parameters
+        ----------
+        sID : STRING
+            The subject.
+        reviewer : STRING
+            The reviewer's initials.
+
+        Returns
+        -------
+        None.
+
+        '''
+        with self._transaction():
+            updated = self._db.execute("""UPDATE reviews SET status = 'done', completed = ?
+                                          WHERE sID = ? AND reviewer = ?""", (self._now(), sID, reviewer)).rowcount
+            if not updated:
+                self._db.execute("""INSERT INTO reviews (sID, reviewer, status, completed)
+                                    VALUES (?, ?, 'done', ?)""", (sID, reviewer, self._now()))
+                self._db.execute('UPDATE subjects SET n_reviews = n_reviews + 1 WHERE sID = ?', (sID,))
+                n_reviews = self._db.execute('SELECT n_reviews FROM subjects WHERE sID = ?', (sID,)).fetchone()[0]
+                print('WARNING: the claim of ' + sID + ' by ' + reviewer + ' had expired - the review is recorded, ' +
+                      sID + ' now has ' + str(n_reviews) + ' reviews (' + str(self.reviews_per_subject) + ' wanted)')
+
+    def release(self, sID, reviewer):
+        '''
+        Give a claimed (not finished) subject back to the queue.
+
+        Parameters
+        ----------
+        sID : STRING
+            The subject.
+        reviewer : STRING
+            The reviewer's initials.
+
+        Returns
+        -------
+        None.
+
+        '''
+        with self._transaction():
+            deleted = self._db.execute("""DELETE FROM reviews WHERE sID = ? AND reviewer = ?
+                                         AND status = 'claimed'""", (sID, reviewer)).rowcount
+            if deleted:
+                self._db.execute('UPDATE subjects SET n_reviews = n_reviews - 1 WHERE sID = ?', (sID,))
+
+    def doneCount(self, reviewer):
+        '''
+        Returns
+        -------
+        INT of the number of subjects reviewer has finished.
+        '''
+        return self._db.execute("""SELECT COUNT(*) FROM reviews WHERE reviewer = ?
+                                   AND status = 'done'""", (reviewer,)).fetchone()[0]
+
+    def close(self):
+        '''
+        Close the database connection.
+        '''
+        self._db.close()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 15:05:31 2026
+
+Cross-subject trial table. 1-Epoching writes one row per epoch for every
+subject (sID, epoch number, condition, voice, response times, correct /
+incorrect and TargetWord, i.e. the epochs metadata) into a single columnar
+file, so trials can be selected across the whole cohort without opening
+every -epo.fif file. For example:
+
+    trials = readTrialTable(os.path.join(epochsFolder, 'trial_table'))
+    trials[(trials['condition'] == 'LowSNR') & (trials['TargetWord'] == 'ship')]
+
+Parquet needs pyarrow (or fastparquet), which is not in the default HANG
+environment (mne-package-list.txt), so there the table is saved as
+trial_table.csv and a warning is given every time. Install pyarrow
+(conda install -c conda-forge pyarrow) to get trial_table.parquet; the .csv
+file is then replaced by the .parquet file the next time 1-Epoching runs.
+
+@author: Francis
+"""
+
+import os
+import warnings
+import importlib.util
+import pandas as pd
+
+def _parquetAvailable():
+    # Either parquet engine pandas can use
+    return any(importlib.util.find_spec(engine) is not None for engine in ['pyarrow', 'fastparquet'])
+
+def trialRows(sID, epochs):
+    '''
+    Make the trial table rows for one subject from its epochs metadata.
+
+    Parameters
+    ----------
+    sID : STRING
+        The subject ID.
+    epochs : mne.Epochs CLASS
+        The subject's epochs (with metadata from 1-Epoching).
+
+    Returns
+    -------
+    A pandas DataFrame with one row per epoch.
+
+    '''
+    trials = epochs.metadata.copy().reset_index(drop=True)
+    trials.insert(0, 'sID', sID)
+    trials.insert(1, 'epoch', range(len(epochs)))
+    trials.insert(2, 'selection', epochs.selection)
+    # event_name is e.g. 'female/HighSNR'
+    trials.insert(3, 'voice', trials['event_name'].str.split('/').str[0])
+    trials.insert(4, 'condition', trials['event_name'].str.split('/').str[1])
+    return trials
+
+def readTrialTable(fname):
+    '''
+    Read the trial table written by writeTrialTable().
+
+    Parameters
+    ----------
+    fname : STRING
+        Path of the table without extension (.parquet or .csv is added).
+
+    Returns
+    -------
+    A pandas DataFrame, or None if no table exists yet.
+
+    '''
+    if os.path.exists(fname + '.parquet'):
+        return pd.read_parquet(fname + '.parquet')
+    if os.path.exists(fname + '.csv'):
+        return pd.read_csv(fname + '.csv')
+    return None
+
+def writeTrialTable(tables, fname):
+    '''
+    Add (or replace) subjects in the trial table and save it.
+
+    Parameters
+    ----------
+    tables : LIST of pandas DataFrame
+        Rows from trialRows() for each subject that was (re)processed. Any
+        rows already in the table for these subjects are replaced.
+    fname : STRING
+        Path of the table without extension (.parquet or .csv is added).
+
+    Returns
+    -------
+    The full trial table as a pandas DataFrame.
+
+    '''
+    tables = [table for table in tables if table is not None]
+    new = pd.concat(tables, ignore_index=True) if tables else None
+    old = readTrialTable(fname)
+    if old is not None and new is not None:
+        old = old[~old['sID'].isin(new['sID'].unique())]
+        trials = pd.concat([old, new], ignore_index=True)
+    else:
+        trials = new if new is not None else old
+    if trials is None:
+        return None
+    trials = trials.sort_values(['sID', 'epoch']).reset_index(drop=True)
+    if _parquetAvailable():
+        trials.to_parquet(fname + '.parquet', index=False)
+        stale_fname = fname + '.csv'
+    else:
+        warnings.warn('Neither pyarrow nor fastparquet is installed - the trial table is saved as ' +
+                      fname + '.csv instead of .parquet. Install pyarrow (conda install -c conda-forge ' +
+                      'pyarrow) for the parquet table.')
+        trials.to_csv(fname + '.csv', index=False)
+        stale_fname = fname + '.parquet'
+    # The table just written has every row of the other file (it was read
+    # above), so remove that one - readTrialTable() would prefer an old
+    # .parquet file over the new .csv file
+    if os.path.exists(stale_fname):
+        os.remove(stale_fname)
+    return trials
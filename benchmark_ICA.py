@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Oct 22 11:05:18 2026
+
+Benchmark of ICA methods and settings on our data, to decide whether
+fastica (what 3-RunICA uses), picard or infomax, or other max_iter /
+n_components settings, would be faster without changing the components.
+
+Every configuration in configs is fit n_repeats times, each time in a fresh
+worker process so the peak memory (RSS) of one fit does not carry over to the
+next. For every fit the wall time, peak RSS, number of iterations and
+convergence are recorded, together with how well the components agree with
+the shipped 2_ICA_set/OT0704-ica.fif (absolute topography correlation of the
+best one-to-one matched components, see HANG_ICA.matchComponents). That file
+is not a fit with the first configuration: read back it has max_iter=1000
+(the file does not store max_iter - only fit_params, with max_iter 800 - nor
+random_state), so the agreement columns compare against a different setting
+than what 3-RunICA uses now, not against a rerun of it.
+
+The epochs used are 2_ICA_set/OT0704-epo.fif if it is there. The repository
+only ships OT0704's ICA (not its epochs), so otherwise synthetic epochs with
+the same shape (229 epochs x 1332 samples on the ICA's 58 channels at 512 Hz)
+are made by mixing random sources with the shipped ICA's own mixing matrix.
+Their "true" components are then the shipped ones, so on these epochs the
+agreement columns only measure how well each method recovers a ground truth
+built from that same ICA - not agreement with fits on real data. The
+topo_corr_against column says which of the two a row is. The sources and
+random_state are fixed, so runs are repeatable.
+
+Results are appended to benchmark_ICA_results.csv with the date, the machine
+and the versions of MNE, NumPy, SciPy, scikit-learn and picard, so the same
+benchmark can be run again after an upgrade and compared against earlier rows.
+
+@author: Francis
+"""
+
+import os
+import sys
+import time
+import datetime
+import platform
+import numpy as np
+import pandas as pd
+import mne
+from concurrent.futures import ProcessPoolExecutor
+from HANG_epochs import saveEpochs, readEpochs, writableEpochs
+from HANG_ICA import fitICA, matchComponents
+from HANG_parallel import limitThreads
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+def peakRSS():
+    '''
+    Returns
+    -------
+    FLOAT of the peak resident memory of this process so far in MB (None if
+    it cannot be measured).
+    '''
+    if resource is not None:
+        # ru_maxrss is in kB on Linux and in bytes on Mac
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1024**2
+    if psutil is not None:
+        # Windows keeps the peak working set
+        return psutil.Process().memory_info().peak_wset / 1024**2
+    return None
+
+def syntheticEpochs(reference, n_epochs=229, n_times=1332, sfreq=512.0, seed=0):
+    '''
+    Make epochs whose independent components are those of a reference ICA.
+
+    Half of the sources are super-Gaussian (Laplace, like most artifacts) and
+    half sub-Gaussian (uniform), all with unit variance, mixed with the
+    reference's sensor-space mixing matrix and scaled by its pre-whitener to
+    volts.
+
+    Parameters
+    ----------
+    reference : mne.preprocessing.ICA CLASS
+        The ICA providing channels and mixing matrix.
+    n_epochs : INT, optional
+        Number of epochs. The default is 229.
+    n_times : INT, optional
+        Samples per epoch. The default is 1332 (-0.5 to 2.1 s at 512 Hz).
+    sfreq : FLOAT, optional
+        Sampling frequency. The default is 512.0.
+    seed : INT, optional
+        Seed of the random sources. The default is 0.
+
+    Returns
+    -------
+    mne.EpochsArray CLASS
+
+    '''
+    rng = np.random.default_rng(seed)
+    n_sources = reference.n_components_
+    n_super = n_sources // 2
+    sources = np.empty((n_epochs, n_sources, n_times))
+    sources[:, :n_super] = rng.laplace(scale=1/np.sqrt(2), size=(n_epochs, n_super, n_times))
+    sources[:, n_super:] = rng.uniform(-np.sqrt(3), np.sqrt(3), size=(n_epochs, n_sources - n_super, n_times))
+    mixing = reference.get_components() * reference.pre_whitener_
+    info = mne.create_info(reference.ch_names, sfreq, 'eeg')
+    return mne.EpochsArray(np.einsum('cs,est->ect', mixing, sources), info, tmin=-0.5, verbose=False)
+
+def benchmarkConfig(config, epochs_fname, reference_fname, blas_threads=None):
+    '''
+    Fit one ICA configuration and measure it (run in its own process).
+
+    Parameters
+    ----------
+    config : DICT
+        Keyword arguments for mne.preprocessing.ICA.
+    epochs_fname : STRING
+        The epochs to fit on.
+    reference_fname : STRING
+        The -ica.fif file to compare the components with.
+    blas_threads : INT, optional
+        Limit the BLAS/OpenMP threads. The default is None (library default).
+
+    Returns
+    -------
+    DICT of the measurements.
+
+    '''
+    mne.set_log_level('ERROR')
+    if blas_threads:
+        limitThreads(blas_threads)
+    epochs = writableEpochs(readEpochs(epochs_fname))
+    rss_before = peakRSS()
+    ica, report = fitICA(epochs, config)
+    report['peak_rss_mb'] = peakRSS()
+    report['fit_rss_mb'] = report['peak_rss_mb'] - rss_before if rss_before is not None else None
+    reference = mne.preprocessing.read_ica(reference_fname)
+    corrs = np.abs([corr for _, corr in matchComponents(reference, ica).values()])
+    report['min_topo_corr'] = round(float(corrs.min()), 3)
+    report['median_topo_corr'] = round(float(np.median(corrs)), 3)
+    report['n_topo_above_0.9'] = int((corrs > 0.9).sum())
+    return report
+
+def versions():
+    '''
+    Returns
+    -------
+    DICT of the machine and the package versions the results depend on.
+    '''
+    result = {'machine': platform.node(), 'cpus': os.cpu_count(),
+              'python': platform.python_version(), 'mne': mne.__version__,
+              'numpy': np.__version__, 'pandas': pd.__version__}
+    for package in ['scipy', 'sklearn', 'picard']:
+        try:
+            result[package] = __import__(package).__version__
+        except ImportError:
+            result[package] = None
+    return result
+
+#######################################
+# Every configuration is passed to mne.preprocessing.ICA (random_state is
+# added). The first one is 3-RunICA's ica_params - not the setting of the
+# shipped reference ICA (see top of file).
+configs = [dict(method='fastica', max_iter=800),
+           dict(method='picard', max_iter=800),
+           dict(method='picard', max_iter=800, fit_params=dict(ortho=False, extended=True)),
+           dict(method='infomax', max_iter=800),
+           dict(method='infomax', max_iter=800, fit_params=dict(extended=True)),
+           dict(method='fastica', max_iter=200),
+           dict(method='fastica', max_iter=800, n_components=30),
+           dict(method='picard', max_iter=800, n_components=30)]
+random_state = 97
+n_repeats = 3
+# None for the library default (all cores), or e.g. 4 to match 3-RunICA's
+# blas_threads
+blas_threads = None
+
+cwd = os.getcwd()
+ICA_folder = '2_ICA_set'
+sID = 'OT0704'
+benchmark_folder = 'benchmark_ICA'
+results_fname = os.path.join(cwd, 'benchmark_ICA_results.csv')
+
+# Main loop is kept under __main__ so that worker processes (which re-import
+# this script on Windows) do not start benchmarking themselves
+if __name__ == '__main__':
+    reference_fname = os.path.join(cwd, ICA_folder, sID + '-ica.fif')
+    epochs_fname = os.path.join(cwd, ICA_folder, sID + '-epo.fif')
+    if os.path.exists(epochs_fname):
+        data = sID + ' epochs'
+        against = 'shipped ' + sID + '-ica.fif'
+    else:
+        # Same synthetic epochs every time (fixed seed), saved once
+        data = 'synthetic (' + sID + ' mixing)'
+        # The shipped ICA is the ground truth of these epochs (see top of file)
+        against = 'synthetic ground truth'
+        if not os.path.exists(benchmark_folder):
+            os.mkdir(benchmark_folder)
+        epochs_fname = os.path.join(cwd, benchmark_folder, sID + '-synthetic-epo.fif')
+        if not os.path.exists(epochs_fname):
+            reference = mne.preprocessing.read_ica(reference_fname, verbose=False)
+            saveEpochs(syntheticEpochs(reference), epochs_fname)
+    print('Benchmarking on ' + data)
+
+    rows = []
+    date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
+    for config in configs:
+        config = dict(config, random_state=random_state)
+        for repeat in range(n_repeats):
+            # New process for every fit, so peak RSS is for this fit only
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                start = time.perf_counter()
+                try:
+                    report = pool.submit(benchmarkConfig, config, epochs_fname,
+                                         reference_fname, blas_threads).result()
+                except Exception as error:
+                    report = {'error': repr(error)}
+                report['total_seconds'] = round(time.perf_counter() - start, 2)
+            row = dict(date=date, data=data, config=str(config), repeat=repeat,
+                       blas_threads=blas_threads, topo_corr_against=against, **report)
+            rows.append(row)
+            print(str(config) + ' #' + str(repeat+1) + ': ' +
+                  (str(report.get('fit_seconds')) + ' s, ' + str(report.get('n_iter')) + ' iterations, min topography correlation with ' + against + ' ' +
+                   str(report.get('min_topo_corr')) if 'error' not in report else report['error']))
+
+    results = pd.DataFrame(rows)
+    for package, version in versions().items():
+        results[package] = version
+    if os.path.exists(results_fname):
+        results = pd.concat([pd.read_csv(results_fname), results], ignore_index=True)
+    results.to_csv(results_fname, index=False)
+
+    # Summary of this run (median over repeats)
+    this_run = results[results['date'] == date]
+    if 'fit_seconds' in this_run:
+        summary = this_run.groupby('config', sort=False)[['fit_seconds', 'peak_rss_mb', 'n_iter', 'min_topo_corr', 'median_topo_corr']].median()
+        print('----------')
+        print(summary.to_string())
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 24 09:41:17 2026
+
+Tests for the warm-started ICA refits in HANG_ICA (run with pytest). The
+epochs are synthetic: independent non-Gaussian sources mixed onto a few
+channels, so the components are known.
+
+@author: Francis
+"""
+
+import numpy as np
+import mne
+from HANG_ICA import fitICA, warmStartICA, carryExclude, matchComponents
+
+ica_params = dict(method='fastica', random_state=97, max_iter=800)
+
+def syntheticEpochs(n_epochs=40, n_channels=8, n_times=256, seed=0):
+    rng = np.random.default_rng(seed)
+    sources = np.empty((n_epochs, n_channels, n_times))
+    sources[:, ::2] = rng.laplace(size=(n_epochs, len(range(0, n_channels, 2)), n_times))
+    sources[:, 1::2] = rng.uniform(-1, 1, size=(n_epochs, len(range(1, n_channels, 2)), n_times))
+    mixing = rng.standard_normal((n_channels, n_channels))
+    info = mne.create_info(['E' + str(ch) for ch in range(n_channels)], 256.0, 'eeg')
+    return mne.EpochsArray(np.einsum('cs,est->ect', mixing, sources) * 1e-6, info, verbose=False)
+
+def topographyCorrelation(ica_a, comp_a, ica_b, comp_b):
+    return abs(np.corrcoef(ica_a.get_components()[:, comp_a], ica_b.get_components()[:, comp_b])[0, 1])
+
+def test_ciac_label_kept_after_warm_start():
+    mne.set_log_level('ERROR')
+    epochs = syntheticEpochs()
+    old_ica, _ = fitICA(epochs, ica_params)
+    # As in the shipped files: no labels in -ica.fif, CIAC's in -CIAC-ica.fif
+    ciac_ica = old_ica.copy()
+    ciac_ica.exclude = [5, 2]
+
+    # A reviewer dropped a few more epochs
+    refit_epochs = epochs.copy().drop([0, 7, 19])
+    ica, report = warmStartICA(refit_epochs, ica_params, old_ica)
+    assert report['warm_start']
+    exclude, not_carried = carryExclude(ciac_ica, ica)
+
+    assert not_carried == []
+    assert len(exclude) == 2
+    for old, new in zip(ciac_ica.exclude, exclude):
+        assert topographyCorrelation(ciac_ica, old, ica, new) > 0.95
+    # The warm start keeps the component numbers, so the labels do too
+    assert exclude == ciac_ica.exclude
+
+def test_carry_exclude_follows_reordered_components():
+    mne.set_log_level('ERROR')
+    epochs = syntheticEpochs()
+    labelled, _ = fitICA(epochs, ica_params)
+    labelled.exclude = [1, 4]
+    # A fit from scratch with another seed finds the components in another order
+    ica, _ = fitICA(epochs, dict(ica_params, random_state=3))
+    matches = matchComponents(labelled, ica)
+    exclude, not_carried = carryExclude(labelled, ica)
+
+    assert not_carried == []
+    assert exclude == [matches[1][0], matches[4][0]]
+    for old, new in zip(labelled.exclude, exclude):
+        assert topographyCorrelation(labelled, old, ica, new) > 0.95
+
+def test_unmatched_label_not_carried():
+    mne.set_log_level('ERROR')
+    labelled, _ = fitICA(syntheticEpochs(seed=0), ica_params)
+    labelled.exclude = [0]
+    # Different mixing - nothing matches
+    ica, _ = fitICA(syntheticEpochs(seed=1), ica_params)
+    exclude, not_carried = carryExclude(labelled, ica, min_corr=0.99)
+
+    assert exclude == []
+    assert not_carried == [0]
+
+def test_warm_start_with_fewer_components():
+    mne.set_log_level('ERROR')
+    epochs = syntheticEpochs()
+    old_ica, _ = fitICA(epochs, ica_params)
+    # Components 6 and 7 cannot keep their numbers in a 6 component ICA
+    old_ica.exclude = [6, 2]
+    ica, report = warmStartICA(epochs, dict(ica_params, n_components=6), old_ica)
+    assert report['warm_start']
+    assert ica.n_components_ == 6
+
+    matches = matchComponents(old_ica, ica)
+    # Excluded components follow their match, and the signs are the old ones
+    assert ica.exclude == [matches[old][0] for old in old_ica.exclude if old in matches]
+    assert all(corr > 0 for _, corr in matches.values())
+    assert report['renumbered'] == any(new != old for old, (new, _) in matches.items())
+    assert report['renumbered']
+    assert len(ica.exclude) == 2
+    assert all(new < 6 for new in ica.exclude)
+    for old, new in zip(old_ica.exclude, ica.exclude):
+        assert topographyCorrelation(old_ica, old, ica, new) > 0.95